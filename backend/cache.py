@@ -0,0 +1,263 @@
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import os
+import json
+import time
+import asyncio
+import logging
+import collections
+import asyncpg
+from sqlalchemy import select, text
+
+import db
+import metrics
+import patterns
+
+INVALIDATION_CHANNEL = 'tiramisu_cache'
+LISTENER_RECONNECT_DELAY = 5
+MAX_CACHED_REPOS = 10000
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))
+
+
+class CachedSubscription(NamedTuple):
+    id: int
+    user_id: int
+    pattern: str
+    telegram_id: str
+    notifications_enabled: bool
+    digest_window: int
+
+
+class SubscriptionCache:
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], List[CachedSubscription]] = {}
+        self._by_user: Dict[int, Set[Tuple[str, str]]] = {}
+        # The compiled patterns of each cached entry, dropped along with it.
+        self._indexes: Dict[Tuple[str, str], Tuple[List[CachedSubscription], patterns.PatternIndex]] = {}
+        self._generation = 0
+
+    async def get(self, owner: str, repo: str) -> List[CachedSubscription]:
+        key = (owner, repo)
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+
+        generation = self._generation
+        async with db.session() as session:
+            rows = (await session.execute(
+                select(
+                    db.Subscription.id,
+                    db.Subscription.user_id,
+                    db.Subscription.pattern,
+                    db.User.telegram_id,
+                    db.User.notifications_enabled,
+                    db.User.digest_window
+                ).join(db.Subscription.user)
+                .where(db.Subscription.owner == owner, db.Subscription.repo == repo)
+                .order_by(db.Subscription.user_id, db.Subscription.id)
+            )).all()
+        entry = [CachedSubscription(*row) for row in rows]
+
+        # Drop the result if an invalidation raced with the query.
+        if generation == self._generation:
+            if len(self._entries) >= MAX_CACHED_REPOS:
+                self._drop(next(iter(self._entries)))
+            self._entries[key] = entry
+            for sub in entry:
+                self._by_user.setdefault(sub.user_id, set()).add(key)
+        return entry
+
+    # Built on first use for an entry returned by get(). An entry that was
+    # not cached, because an invalidation raced with it, gets a fresh index.
+    def index(self, owner: str, repo: str, entry: List[CachedSubscription]) -> patterns.PatternIndex:
+        key = (owner, repo)
+        cached = self._indexes.get(key)
+        if cached is not None and cached[0] is entry:
+            return cached[1]
+
+        index = patterns.PatternIndex(sub.pattern for sub in entry)
+        if self._entries.get(key) is entry:
+            self._indexes[key] = (entry, index)
+        return index
+
+    def _drop(self, key: Tuple[str, str]):
+        self._entries.pop(key, None)
+        self._indexes.pop(key, None)
+
+    def invalidate_repo(self, owner: str, repo: str):
+        self._generation += 1
+        self._drop((owner, repo))
+
+    def invalidate_user(self, user_id: int):
+        self._generation += 1
+        for key in self._by_user.pop(user_id, ()):
+            self._drop(key)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._indexes.clear()
+        self._by_user.clear()
+
+    def stats(self):
+        return {'repos': len(self._entries), 'indexes': len(self._indexes)}
+
+
+class TTLCache:
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        # Bumped by every removal, so a loader can tell a value it read is stale.
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last = False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class CachedUser(NamedTuple):
+    id: int
+    telegram_id: str
+    github_access_token: Optional[str]
+    notifications_enabled: bool
+
+
+subscriptions = SubscriptionCache()
+users = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+metrics.register_stats('tiramisu_user_cache', users.stats,
+    counters = {
+        'hits': 'User cache hits',
+        'misses': 'User cache misses',
+        'evictions': 'User cache evictions'
+    },
+    gauges = {
+        'entries': 'Users in the cache'
+    }
+)
+metrics.register_stats('tiramisu_subscription_cache', subscriptions.stats,
+    gauges = {
+        'repos': 'Repositories with cached subscriptions',
+        'indexes': 'Repositories with compiled subscription patterns'
+    }
+)
+
+def clear():
+    subscriptions.clear()
+    users.clear()
+
+def stats():
+    return {
+        'subscriptions': subscriptions.stats(),
+        'users': users.stats()
+    }
+
+
+# The NOTIFY is part of the caller's transaction, so other replicas only see
+# it once the change is committed. The local entry is dropped right away.
+
+async def _notify(session, message: dict):
+    await session.execute(
+        text('SELECT pg_notify(:channel, :payload)'),
+        {'channel': INVALIDATION_CHANNEL, 'payload': json.dumps(message)}
+    )
+
+def _apply(payload: str):
+    try:
+        message = json.loads(payload)
+        if 'user_id' in message:
+            subscriptions.invalidate_user(message['user_id'])
+            users.pop(message['telegram_id'])
+        else:
+            subscriptions.invalidate_repo(message['owner'], message['repo'])
+    except (ValueError, KeyError, TypeError):
+        logging.warning(f'Bad cache invalidation payload {payload!r}, clearing cache')
+        clear()
+
+async def invalidate_repo(session, owner: str, repo: str):
+    subscriptions.invalidate_repo(owner, repo)
+    await _notify(session, {'owner': owner, 'repo': repo})
+
+async def invalidate_user(session, user_id: int, telegram_id: str):
+    subscriptions.invalidate_user(user_id)
+    users.pop(telegram_id)
+    await _notify(session, {'user_id': user_id, 'telegram_id': telegram_id})
+
+
+async def _listen():
+    global _connected
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(db.conn_string())
+            await conn.add_listener(INVALIDATION_CHANNEL, lambda conn, pid, channel, payload: _apply(payload))
+            # Anything cached before LISTEN took effect may have missed a NOTIFY.
+            clear()
+            _connected = True
+            logging.info('Cache listener connected')
+
+            # Notifications arrive through the callback, this loop only
+            # notices a dropped connection.
+            while True:
+                await asyncio.sleep(LISTENER_RECONNECT_DELAY)
+                await conn.execute('SELECT 1')
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+            logging.warning(f'Cache listener failed: {e}')
+            clear()
+        finally:
+            _connected = False
+            if conn is not None:
+                conn.terminate()
+        await asyncio.sleep(LISTENER_RECONNECT_DELAY)
+
+_listener: Optional[asyncio.Task] = None
+_connected = False
+
+def start_listener():
+    global _listener
+    if _listener is None:
+        _listener = asyncio.create_task(_listen())
+
+def listening() -> bool:
+    return _connected
+
+async def stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.gather(_listener, return_exceptions = True)
+        _listener = None
@@ -1,19 +1,41 @@
 import logging
+import asyncio
+import random
 import time
 import os
 
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
-from sqlalchemy.orm import declarative_base, Session, relationship
-from sqlalchemy.exc import OperationalError
+from typing import Optional
+
+from sqlalchemy import text, update, and_
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql.expression import func
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import metrics
+import migrations
+import profiling
 
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = os.getenv('DB_PORT')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_NAME = os.getenv('DB_NAME')
-DB_CONNECTION_ATTEMPTS = 5
-DB_CONNECTION_DELAY = 5
+DB_CONNECTION_ATTEMPTS = int(os.getenv('DB_CONNECTION_ATTEMPTS', '10'))
+DB_CONNECTION_BASE_DELAY = 0.5
+DB_CONNECTION_MAX_DELAY = 10
+DB_PING_TIMEOUT = 2
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', '10000'))
+
+engine = None
+schema_version = None
 
 Base = declarative_base()
 
@@ -24,11 +46,14 @@ class User(Base):
     telegram_id = Column(String, nullable=False, unique=True)
     github_access_token = Column(String)
     notifications_enabled = Column(Boolean, nullable=False, default=True)
+    last_subscription_id = Column(Integer, nullable=False, default=0)
+    digest_window = Column(Integer, nullable=False, default=30)
+    subscriptions_version = Column(Integer, nullable=False, default=0)
 
-    subscriptions = relationship("Subscription", cascade="all, delete")
+    subscriptions = relationship("Subscription", cascade="all, delete", back_populates="user")
 
     def __repr__(self):
-        return f'User(id={self.id}, telegram_id={self.telegram_id}, notifications_enabled={self.notifications_enabled})'
+        return f'User(id={self.id}, telegram_id={self.telegram_id}, notifications_enabled={self.notifications_enabled}, digest_window={self.digest_window})'
 
 
 class Subscription(Base):
@@ -41,32 +66,242 @@ class Subscription(Base):
     repo = Column(String, nullable=False)
     pattern = Column(String, nullable=False)
 
-    user = relationship('User')
+    user = relationship('User', back_populates='subscriptions')
+
+    __table_args__ = (
+        Index('ix_subscriptions_owner_repo', 'owner', 'repo'),
+        Index('ix_subscriptions_user_id', 'user_id'),
+    )
 
     def __repr__(self):
         return f'Subscription(id={self.id}, user_id={self.user_id}, owner={self.owner}, repo={self.repo}, pattern={self.pattern})'
 
 
-def init():
-    conn_string = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+class Webhook(Base):
+    __tablename__ = 'webhooks'
+
+    owner = Column(String, primary_key=True)
+    repo = Column(String, primary_key=True)
+    hook_id = Column(BigInteger)
+    ref_count = Column(Integer, nullable=False, default=0)
+
+    # The user whose token created or adopted the hook, and can delete it.
+    admin_user_id = Column(Integer)
+    # Set while the hook has to be deleted, or created again, on GitHub.
+    retry_at = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String)
+
+    __table_args__ = (
+        Index('ix_webhooks_retry_at', 'retry_at', postgresql_where=retry_at.isnot(None)),
+    )
+
+    def __repr__(self):
+        return f'Webhook(owner={self.owner}, repo={self.repo}, hook_id={self.hook_id}, ref_count={self.ref_count}, retry_at={self.retry_at})'
+
+
+class WebhookEvent(Base):
+    __tablename__ = 'webhook_events'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    delivery_id = Column(String, nullable=False, unique=True)
+    push_key = Column(String, unique=True)
+
+    owner = Column(String, nullable=False)
+    repo = Column(String, nullable=False)
+    pusher = Column(String, nullable=False)
+    paths = Column(ARRAY(String), nullable=False)
+
+    attempts = Column(Integer, nullable=False, default=0)
+    received_at = Column(DateTime, nullable=False, server_default=func.now())
+    available_at = Column(DateTime, nullable=False, server_default=func.now())
+    processed_at = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_webhook_events_pending', 'available_at', postgresql_where=processed_at.is_(None)),
+    )
+
+    def __repr__(self):
+        return f'WebhookEvent(id={self.id}, delivery_id={self.delivery_id}, owner={self.owner}, repo={self.repo}, attempts={self.attempts})'
+
+
+# Notifications waiting to be delivered to the frontend. The idempotency key
+# is sent along with them, so a batch retried after a timeout is not shown
+# twice.
+class OutboxNotification(Base):
+    __tablename__ = 'notification_outbox'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String, nullable=False, unique=True)
+    chat_id = Column(String, nullable=False)
+    message = Column(String, nullable=False)
+
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    available_at = Column(DateTime, nullable=False, server_default=func.now())
+    sent_at = Column(DateTime)
+    dead_at = Column(DateTime)
+    last_error = Column(String)
+
+    __table_args__ = (
+        Index('ix_notification_outbox_pending', 'available_at', postgresql_where=and_(sent_at.is_(None), dead_at.is_(None))),
+        Index('ix_notification_outbox_dead', 'dead_at', postgresql_where=dead_at.isnot(None)),
+    )
+
+    def __repr__(self):
+        return f'OutboxNotification(id={self.id}, idempotency_key={self.idempotency_key}, chat_id={self.chat_id}, attempts={self.attempts})'
+
+
+# Per chat, when the current digest window closes and whether a digest is
+# due then. Rows that closed more than DIGEST_MAX_WINDOW ago say nothing and
+# are purged.
+class DigestWindow(Base):
+    __tablename__ = 'digest_windows'
+
+    chat_id = Column(String, primary_key=True)
+    closes_at = Column(DateTime, nullable=False)
+    pending = Column(Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        Index('ix_digest_windows_closes_at', 'closes_at'),
+    )
+
+    def __repr__(self):
+        return f'DigestWindow(chat_id={self.chat_id}, closes_at={self.closes_at}, pending={self.pending})'
+
+
+# Matches held back for a digest, merged into one notification at due_at.
+class DigestEntry(Base):
+    __tablename__ = 'digest_entries'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String, nullable=False, unique=True)
+    chat_id = Column(String, nullable=False)
+    repo = Column(String, nullable=False)
+    pusher = Column(String, nullable=False)
+    patterns = Column(ARRAY(String), nullable=False)
+    due_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_digest_entries_due_at', 'due_at'),
+    )
+
+    def __repr__(self):
+        return f'DigestEntry(id={self.id}, chat_id={self.chat_id}, repo={self.repo}, due_at={self.due_at})'
+
+
+class PendingLogin(Base):
+    __tablename__ = 'pending_logins'
+
+    device_code = Column(String, primary_key=True)
+    telegram_id = Column(String, nullable=False, index=True)
+    interval = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    next_poll_at = Column(DateTime, nullable=False, index=True)
+
+    leased_until = Column(DateTime)
+    leased_by = Column(String)
+
+    def __repr__(self):
+        return f'PendingLogin(telegram_id={self.telegram_id}, interval={self.interval}, expires_at={self.expires_at})'
+
+
+class TimedPool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.DB_POOL_WAIT.observe(time.perf_counter() - started)
+
+# Pools log under their class name; keep this one as quiet as SQLAlchemy's own.
+logging.getLogger(f'{__name__}.{TimedPool.__name__}').setLevel(logging.WARNING)
+
+
+def conn_string(driver = 'postgresql'):
+    return f'{driver}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+
+def create_engine():
+    return create_async_engine(
+        conn_string('postgresql+asyncpg'),
+        poolclass = TimedPool,
+        pool_size = DB_POOL_SIZE,
+        max_overflow = DB_MAX_OVERFLOW,
+        pool_timeout = DB_POOL_TIMEOUT,
+        pool_pre_ping = DB_POOL_PRE_PING,
+        connect_args = {
+            'server_settings': {'statement_timeout': str(DB_STATEMENT_TIMEOUT)}
+        }
+    )
+
+async def init():
+    global engine, schema_version
+
+    engine = create_engine()
+    profiling.instrument(engine.sync_engine)
     for i in range(DB_CONNECTION_ATTEMPTS):
         try:
-            engine = create_engine(conn_string)
-            engine.connect()
+            async with engine.connect() as conn:
+                schema_version = await conn.run_sync(migrations.ensure)
             break
-        except OperationalError:
-            logging.info(f'Database connection failed ({i+1}/{DB_CONNECTION_ATTEMPTS}).')
-            if i < DB_CONNECTION_ATTEMPTS - 1:
-                logging.info(f'Retrying in {DB_CONNECTION_DELAY}s.')
-                time.sleep(DB_CONNECTION_DELAY)
-    else:
-        raise RuntimeError(f'Database connection failed for {DB_CONNECTION_ATTEMPTS} attempts. Shutting down')
-
-    Base.metadata.bind = engine
-    Base.metadata.create_all()
+        except (DBAPIError, OSError, asyncio.TimeoutError) as e:
+            if i == DB_CONNECTION_ATTEMPTS - 1:
+                raise RuntimeError(f'Database connection failed for {DB_CONNECTION_ATTEMPTS} attempts') from e
+            # Full jitter, so replicas that restart together do not retry in step.
+            delay = random.uniform(0, min(DB_CONNECTION_MAX_DELAY, DB_CONNECTION_BASE_DELAY * 2 ** i))
+            logging.info(f'Database connection failed ({i+1}/{DB_CONNECTION_ATTEMPTS}): {e}. Retrying in {delay:.1f}s.')
+            await asyncio.sleep(delay)
 
     logging.info('Database initialized')
 
+async def ping() -> bool:
+    if engine is None:
+        return False
+
+    async def select_one():
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+
+    try:
+        await asyncio.wait_for(select_one(), timeout = DB_PING_TIMEOUT)
+        return True
+    except (DBAPIError, OSError, asyncio.TimeoutError):
+        return False
+
+def pool_status() -> Optional[dict]:
+    if engine is None:
+        return None
+    return {
+        'size': engine.pool.size(),
+        'checked_out': engine.pool.checkedout(),
+        'overflow': max(0, engine.pool.overflow())
+    }
+
+async def close():
+    if engine is not None:
+        await engine.dispose()
+
 def session():
-    return Session(Base.metadata.bind)
+    return AsyncSession(engine, expire_on_commit=False)
+
+# Takes a row lock on the user, so concurrent inserts for the same user get
+# distinct ids without scanning their subscriptions.
+async def allocate_subscription_ids(session, user_id, count = 1):
+    last_id = (await session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(
+            last_subscription_id = User.last_subscription_id + count,
+            subscriptions_version = User.subscriptions_version + 1
+        )
+        .returning(User.last_subscription_id)
+    )).scalar()
+    return range(last_id - count + 1, last_id + 1)
+
+# Bumped on every change to a user's subscriptions, it versions their listing.
+async def bump_subscriptions_version(session, user_id):
+    await session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(subscriptions_version = User.subscriptions_version + 1)
+    )
@@ -0,0 +1,231 @@
+from typing import List, Optional
+
+import os
+import uuid
+import asyncio
+import logging
+from datetime import timedelta
+import httpx
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import func
+
+import db
+import cache
+import github
+import github_apikey
+import metrics
+import notifier
+
+DEVICE_FLOW_TICK = float(os.getenv('DEVICE_FLOW_TICK', '1'))
+DEVICE_FLOW_BATCH_SIZE = int(os.getenv('DEVICE_FLOW_BATCH_SIZE', '100'))
+DEVICE_FLOW_CONCURRENCY = int(os.getenv('DEVICE_FLOW_CONCURRENCY', '20'))
+DEVICE_FLOW_LEASE = 30
+
+# Identifies this replica's leases on pending logins.
+POLLER_ID = str(uuid.uuid4())
+
+_task: Optional[asyncio.Task] = None
+
+
+async def begin(tg_chat_id: str) -> dict:
+    resp = await github.client.request(
+        'POST',
+        'https://github.com/login/device/code',
+        json = {
+            'client_id': github_apikey.CLIENT_ID,
+            'scope': 'repo'
+        }
+    )
+    res = resp.json()
+
+    for field in ['device_code', 'user_code', 'verification_uri', 'expires_in', 'interval']:
+        assert field in res
+
+    await _store(tg_chat_id, res)
+
+    return res
+
+async def _store(tg_chat_id: str, res: dict):
+    async with db.session() as session:
+        # A new login from the same chat supersedes the pending one.
+        await session.execute(delete(db.PendingLogin).where(db.PendingLogin.telegram_id == tg_chat_id))
+        await session.execute(
+            insert(db.PendingLogin).values(
+                device_code = res['device_code'],
+                telegram_id = tg_chat_id,
+                interval = res['interval'],
+                expires_at = func.now() + timedelta(seconds = res['expires_in']),
+                next_poll_at = func.now() + timedelta(seconds = res['interval'])
+            )
+        )
+        await session.commit()
+
+
+async def _claim(batch_size: int) -> list:
+    async with db.session() as session:
+        due = select(db.PendingLogin.device_code) \
+            .where(
+                db.PendingLogin.next_poll_at <= func.now(),
+                db.PendingLogin.expires_at > func.now(),
+                (db.PendingLogin.leased_until == None) | (db.PendingLogin.leased_until < func.now())
+            ) \
+            .order_by(db.PendingLogin.next_poll_at) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked = True) \
+            .scalar_subquery()
+
+        logins = (await session.execute(
+            update(db.PendingLogin)
+            .where(db.PendingLogin.device_code.in_(due))
+            .values(
+                leased_until = func.now() + timedelta(seconds = DEVICE_FLOW_LEASE),
+                leased_by = POLLER_ID
+            )
+            .returning(db.PendingLogin.device_code, db.PendingLogin.telegram_id, db.PendingLogin.interval)
+            .execution_options(synchronize_session = False)
+        )).all()
+
+        await session.commit()
+        return logins
+
+async def _expire() -> List[str]:
+    async with db.session() as session:
+        expired = (await session.execute(
+            delete(db.PendingLogin)
+            .where(db.PendingLogin.expires_at <= func.now())
+            .returning(db.PendingLogin.telegram_id)
+            .execution_options(synchronize_session = False)
+        )).scalars().all()
+        await session.commit()
+        return expired
+
+async def _reschedule(device_code: str, interval: int):
+    async with db.session() as session:
+        await session.execute(
+            update(db.PendingLogin)
+            .where(db.PendingLogin.device_code == device_code, db.PendingLogin.leased_by == POLLER_ID)
+            .values(
+                interval = interval,
+                next_poll_at = func.now() + timedelta(seconds = interval),
+                leased_until = None,
+                leased_by = None
+            )
+            .execution_options(synchronize_session = False)
+        )
+        await session.commit()
+
+async def _finish(device_code: str, tg_chat_id: str, access_token: Optional[str]) -> bool:
+    async with db.session() as session:
+        res = await session.execute(
+            delete(db.PendingLogin)
+            .where(db.PendingLogin.device_code == device_code, db.PendingLogin.leased_by == POLLER_ID)
+            .execution_options(synchronize_session = False)
+        )
+        if res.rowcount == 0:
+            # The lease was lost, another replica owns the outcome now.
+            await session.rollback()
+            return False
+
+        if access_token is not None:
+            user = (await session.execute(
+                select(db.User).where(db.User.telegram_id == tg_chat_id)
+            )).scalars().first()
+
+            if user:
+                user.github_access_token = access_token
+            else:
+                user = db.User(
+                    telegram_id = tg_chat_id,
+                    github_access_token = access_token,
+                    notifications_enabled = True
+                )
+                session.add(user)
+                await session.flush()
+
+            await cache.invalidate_user(session, user.id, tg_chat_id)
+
+        await session.commit()
+        return True
+
+
+async def _poll(login, slots: asyncio.Semaphore):
+    interval = login.interval
+
+    async with slots:
+        try:
+            resp = await github.client.request(
+                'POST',
+                'https://github.com/login/oauth/access_token',
+                json = {
+                    'client_id': github_apikey.CLIENT_ID,
+                    'device_code': login.device_code,
+                    'grant_type': 'urn:ietf:params:oauth:grant-type:device_code'
+                }
+            )
+            res = resp.json()
+        except (httpx.HTTPError, ValueError) as e:
+            metrics.AUTH_POLLS.labels('http_error').inc()
+            logging.warning(f'GH auth, got exception {e!r}')
+            await _reschedule(login.device_code, interval)
+            return
+
+    if 'access_token' in res:
+        metrics.AUTH_POLLS.labels('success').inc()
+        access_token = res['access_token']
+        if await _finish(login.device_code, login.telegram_id, access_token):
+            logging.info(f'GH auth success, chat id {login.telegram_id}')
+            notifier.sender.submit(login.telegram_id, 'Logged in successfully.', f'login:{login.device_code}')
+        return
+
+    error = res.get('error')
+    metrics.AUTH_POLLS.labels(error if error in ('slow_down', 'authorization_pending', 'expired_token') else 'error').inc()
+    if error == 'slow_down':
+        interval = res['interval']
+        logging.info(f'GH auth, slowing down, interval {interval}')
+    elif error == 'authorization_pending':
+        logging.info('GH auth, pending')
+    elif error == 'expired_token':
+        if await _finish(login.device_code, login.telegram_id, None):
+            logging.info('GH auth, timed out')
+            notifier.sender.submit(login.telegram_id, 'Login timed out. Please try again.', f'login:{login.device_code}')
+        return
+    else:
+        logging.warning(f'GH auth, error: {res}')
+        if await _finish(login.device_code, login.telegram_id, None):
+            notifier.sender.submit(login.telegram_id, 'Login failed. Please try again.', f'login:{login.device_code}')
+        return
+
+    await _reschedule(login.device_code, interval)
+
+async def _run():
+    slots = asyncio.Semaphore(DEVICE_FLOW_CONCURRENCY)
+
+    while True:
+        try:
+            for tg_chat_id in await _expire():
+                logging.info('GH auth, timed out')
+                notifier.sender.submit(tg_chat_id, 'Login timed out. Please try again.')
+
+            logins = await _claim(DEVICE_FLOW_BATCH_SIZE)
+            if logins:
+                await asyncio.gather(*(_poll(login, slots) for login in logins))
+        except Exception:
+            logging.exception('Device flow poller failed')
+
+        await asyncio.sleep(DEVICE_FLOW_TICK)
+
+
+async def start():
+    global _task
+    _task = asyncio.create_task(_run())
+
+def running() -> bool:
+    return _task is not None and not _task.done()
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions = True)
+        _task = None
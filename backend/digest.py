@@ -0,0 +1,226 @@
+from typing import Dict, List, NamedTuple, Optional
+
+import os
+import asyncio
+import logging
+from datetime import timedelta
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import func
+
+import db
+import metrics
+import notifier
+
+DIGEST_MAX_WINDOW = 3600
+DIGEST_TICK = float(os.getenv('DIGEST_TICK', '1'))
+DIGEST_BATCH_SIZE = int(os.getenv('DIGEST_BATCH_SIZE', '1000'))
+DIGEST_PURGE_INTERVAL = 600
+
+
+class Match(NamedTuple):
+    key: str
+    chat_id: str
+    window: int
+    repo: str
+    pusher: str
+    patterns: List[str]
+
+
+class _Repo:
+    def __init__(self):
+        self.pushes = 0
+        self.pushers: Dict[str, None] = {}
+        self.patterns: Dict[str, None] = {}
+
+
+def _join(names: List[str]) -> str:
+    return ', '.join(names)
+
+def message(repo_full_name: str, pushers: List[str], patterns: List[str], pushes: int = 1) -> str:
+    if pushes == 1:
+        label = 'pattern' if len(patterns) == 1 else 'patterns'
+        return f'New commit by {pushers[0]} on repo {repo_full_name} matching {label} {_join(patterns)}'
+
+    by = pushers[0] if len(pushers) == 1 else f'{len(pushers)} pushers'
+    return f'{pushes} pushes by {by} on {repo_full_name} matching {_join(patterns)}'
+
+
+# The first match for a chat is sent right away and opens a window; matches
+# arriving while it is open are folded into one digest sent when it closes.
+# A digest opens a new window, so a steady stream of pushes produces at most
+# one message per window and a single push is never delayed.
+#
+# Windows and held back matches live in the database and are written in the
+# transaction that marks the pushes processed, so they survive a restart, are
+# shared by every worker process, and a push processed again is not counted
+# twice. A background task merges the matches into the outbox once due.
+class Coalescer:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+        self.matches = 0
+        self.messages = 0
+        self.digests = 0
+
+    # Runs in the caller's transaction. Returns the notifications to send
+    # right away and holds back the rest.
+    async def add(self, session, matches: List[Match]) -> List[notifier.Notification]:
+        notifications = [
+            notifier.Notification(match.key, match.chat_id, message(match.repo, [match.pusher], match.patterns))
+            for match in matches if match.window <= 0
+        ]
+        windowed = [match for match in matches if match.window > 0]
+        if windowed:
+            notifications += await self._hold(session, windowed)
+
+        self.matches += len(matches)
+        self.messages += len(notifications)
+        return notifications
+
+    async def _hold(self, session, matches: List[Match]) -> List[notifier.Notification]:
+        chat_ids = sorted({match.chat_id for match in matches})
+        # A new row reads as a closed window.
+        await session.execute(
+            insert(db.DigestWindow)
+            .values([{'chat_id': chat_id, 'closes_at': func.localtimestamp()} for chat_id in chat_ids])
+            .on_conflict_do_nothing()
+        )
+        rows = (await session.execute(
+            select(db.DigestWindow, func.localtimestamp())
+            .where(db.DigestWindow.chat_id.in_(chat_ids))
+            .order_by(db.DigestWindow.chat_id)
+            .with_for_update()
+        )).all()
+        windows = {window.chat_id: window for window, _ in rows}
+        now = rows[0][1]
+
+        notifications = []
+        entries = []
+        for match in matches:
+            window = windows[match.chat_id]
+            length = timedelta(seconds = match.window)
+            if window.pending and now >= window.closes_at:
+                # The digest due then opened the next window.
+                window.closes_at += length
+                window.pending = False
+
+            if now >= window.closes_at:
+                notifications.append(notifier.Notification(match.key, match.chat_id, message(match.repo, [match.pusher], match.patterns)))
+                window.closes_at = now + length
+            else:
+                window.pending = True
+                entries.append({
+                    'idempotency_key': match.key,
+                    'chat_id': match.chat_id,
+                    'repo': match.repo,
+                    'pusher': match.pusher,
+                    'patterns': match.patterns,
+                    'due_at': window.closes_at
+                })
+
+        if entries:
+            await session.execute(insert(db.DigestEntry).values(entries).on_conflict_do_nothing())
+        return notifications
+
+    # Merges the due matches of each chat into one notification, in the
+    # transaction that removes them. Returns how many matches it took.
+    async def close_due(self) -> int:
+        entries = db.DigestEntry
+        async with db.session() as session:
+            due = select(entries.id) \
+                .where(entries.due_at <= func.localtimestamp()) \
+                .order_by(entries.id) \
+                .limit(DIGEST_BATCH_SIZE) \
+                .with_for_update(skip_locked = True) \
+                .scalar_subquery()
+
+            rows = (await session.execute(
+                delete(entries)
+                .where(entries.id.in_(due))
+                .returning(entries.id, entries.chat_id, entries.repo, entries.pusher, entries.patterns, entries.due_at)
+                .execution_options(synchronize_session = False)
+            )).all()
+            if not rows:
+                return 0
+
+            digests: Dict[tuple, Dict[str, _Repo]] = {}
+            first_ids = {}
+            for row in sorted(rows, key = lambda row: row.id):
+                key = (row.chat_id, row.due_at)
+                first_ids.setdefault(key, row.id)
+                repo = digests.setdefault(key, {}).setdefault(row.repo, _Repo())
+                repo.pushes += 1
+                repo.pushers[row.pusher] = None
+                for pattern in row.patterns:
+                    repo.patterns[pattern] = None
+
+            notifications = [
+                notifier.Notification(f'digest:{first_ids[key]}', key[0], '\n'.join(
+                    message(name, list(repo.pushers), list(repo.patterns), repo.pushes)
+                    for name, repo in repos.items()
+                ))
+                for key, repos in digests.items()
+            ]
+            await notifier.enqueue(session, notifications)
+            await session.commit()
+
+        self.messages += len(notifications)
+        self.digests += len(notifications)
+        notifier.sender.wakeup()
+        return len(rows)
+
+    async def _purge(self):
+        async with db.session() as session:
+            await session.execute(
+                delete(db.DigestWindow)
+                .where(db.DigestWindow.closes_at < func.localtimestamp() - timedelta(seconds = 2 * DIGEST_MAX_WINDOW))
+                .execution_options(synchronize_session = False)
+            )
+            await session.commit()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        purged_at = loop.time()
+
+        while True:
+            try:
+                while await self.close_due() >= DIGEST_BATCH_SIZE:
+                    pass
+                if loop.time() - purged_at > DIGEST_PURGE_INTERVAL:
+                    purged_at = loop.time()
+                    await self._purge()
+            except Exception:
+                logging.exception('Closing digests failed')
+
+            await asyncio.sleep(DIGEST_TICK)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions = True)
+            self._task = None
+
+    def stats(self):
+        return {
+            'matches': self.matches,
+            'messages': self.messages,
+            'digests': self.digests
+        }
+
+
+coalescer = Coalescer()
+
+metrics.register_stats('tiramisu_digest', coalescer.stats,
+    counters = {
+        'matches': 'Matches passed to the coalescer',
+        'messages': 'Messages produced by the coalescer',
+        'digests': 'Digests merged from held back matches'
+    }
+)
@@ -0,0 +1,219 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import collections
+import httpx
+
+import metrics
+
+GITHUB_API_URL = 'https://api.github.com'
+GITHUB_TIMEOUT = float(os.getenv('GITHUB_TIMEOUT', '10'))
+GITHUB_CONNECTIONS = int(os.getenv('GITHUB_CONNECTIONS', '50'))
+# GitHub's secondary rate limits punish concurrent requests with one token.
+GITHUB_TOKEN_CONCURRENCY = int(os.getenv('GITHUB_TOKEN_CONCURRENCY', '4'))
+# Requests left in the hour at which a token stops until its limit resets.
+GITHUB_RATE_RESERVE = int(os.getenv('GITHUB_RATE_RESERVE', '50'))
+# Longer waits fail the request instead of holding up the caller.
+GITHUB_MAX_WAIT = float(os.getenv('GITHUB_MAX_WAIT', '5'))
+GITHUB_CACHE_TTL = float(os.getenv('GITHUB_CACHE_TTL', '300'))
+GITHUB_CACHE_SIZE = int(os.getenv('GITHUB_CACHE_SIZE', '10000'))
+# Repositories that do not exist yet may be created any moment.
+GITHUB_NEGATIVE_TTL = 30
+# Without a Retry-After header GitHub asks for at least a minute.
+SECONDARY_LIMIT_WAIT = 60
+MAX_TOKENS = 10000
+
+
+class RateLimited(httpx.HTTPError):
+    pass
+
+
+class _Token:
+    def __init__(self):
+        self.slots = asyncio.Semaphore(GITHUB_TOKEN_CONCURRENCY)
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self.blocked_until = 0.0
+
+
+class _Cached:
+    def __init__(self, status: int, etag: Optional[str], value: Any, expires: float):
+        self.status = status
+        self.etag = etag
+        self.value = value
+        self.expires = expires
+
+
+# Tokens are only kept as digests, so the rate limit state and the cache do
+# not hold on to credentials.
+def _key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+class Client:
+    def __init__(self):
+        self._http: Optional[httpx.AsyncClient] = None
+        self._tokens: Dict[str, _Token] = collections.OrderedDict()
+        # path -> token digest -> entry, evicted by path.
+        self._cache: Dict[str, Dict[str, _Cached]] = collections.OrderedDict()
+
+        self.requests = 0
+        self.rate_limited = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.revalidated = 0
+
+    async def start(self):
+        self._http = httpx.AsyncClient(
+            base_url = GITHUB_API_URL,
+            headers = {
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            },
+            timeout = GITHUB_TIMEOUT,
+            transport = metrics.transport('github', httpx.Limits(
+                max_connections = GITHUB_CONNECTIONS,
+                max_keepalive_connections = GITHUB_CONNECTIONS
+            ))
+        )
+
+    async def stop(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def _token(self, token: str) -> _Token:
+        key = _key(token)
+        state = self._tokens.get(key)
+        if state is None:
+            state = self._tokens[key] = _Token()
+            while len(self._tokens) > MAX_TOKENS:
+                self._tokens.popitem(last = False)
+        else:
+            self._tokens.move_to_end(key)
+        return state
+
+    async def _wait(self, state: _Token):
+        now = time.time()
+        until = state.blocked_until
+        if state.remaining is not None and state.remaining <= GITHUB_RATE_RESERVE and state.reset_at > now:
+            until = max(until, state.reset_at)
+
+        if until <= now:
+            return
+        if until - now > GITHUB_MAX_WAIT:
+            self.rate_limited += 1
+            raise RateLimited(f'GitHub rate limit, retry in {until - now:.0f}s')
+        await asyncio.sleep(until - now)
+
+    def _account(self, state: _Token, resp: httpx.Response) -> bool:
+        remaining = resp.headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            state.remaining = int(remaining)
+            state.reset_at = float(resp.headers.get('X-RateLimit-Reset', '0'))
+
+        if resp.status_code not in (403, 429):
+            return False
+
+        retry_after = resp.headers.get('Retry-After')
+        if retry_after is not None:
+            state.blocked_until = time.time() + float(retry_after)
+        elif remaining == '0':
+            state.blocked_until = state.reset_at
+        elif 'rate limit' in resp.text.lower():
+            state.blocked_until = time.time() + SECONDARY_LIMIT_WAIT
+        else:
+            return False
+
+        logging.warning(f'GH: rate limited, {resp.status_code} on {resp.request.url.path}')
+        return True
+
+    async def request(self, method: str, url: str, token: Optional[str] = None, **kwargs) -> httpx.Response:
+        self.requests += 1
+        if token is None:
+            return await self._http.request(method, url, **kwargs)
+
+        state = self._token(token)
+        kwargs['headers'] = {**kwargs.get('headers', {}), 'Authorization': f'Bearer {token}'}
+        async with state.slots:
+            # A short Retry-After is waited out once, a long one fails.
+            for _ in range(2):
+                await self._wait(state)
+                resp = await self._http.request(method, url, **kwargs)
+                if not self._account(state, resp):
+                    return resp
+
+        self.rate_limited += 1
+        raise RateLimited(f'GitHub rate limit on {method} {url}')
+
+    # GETs answered from the cache while fresh, then revalidated with the
+    # ETag: a 304 does not count against the rate limit. Only the statuses
+    # that describe the resource are cached, with the part of the body
+    # extract() keeps.
+    async def get(self, path: str, token: str, extract: Callable[[Any], Any] = lambda body: None, ttl: float = GITHUB_CACHE_TTL) -> Tuple[int, Any]:
+        key = _key(token)
+        entries = self._cache.get(path)
+        entry = entries.get(key) if entries is not None else None
+        if entry is not None and entry.expires > time.monotonic():
+            self._cache.move_to_end(path)
+            self.cache_hits += 1
+            return entry.status, entry.value
+
+        self.cache_misses += 1
+        headers = {'If-None-Match': entry.etag} if entry is not None and entry.etag else {}
+        resp = await self.request('GET', path, token, headers = headers)
+
+        if resp.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry.expires = time.monotonic() + ttl
+            return entry.status, entry.value
+
+        if resp.status_code == 200:
+            value = extract(resp.json())
+            self.remember(path, token, 200, value, resp.headers.get('ETag'), ttl)
+            return 200, value
+        if resp.status_code == 404:
+            self.remember(path, token, 404, None, None, min(ttl, GITHUB_NEGATIVE_TTL))
+        return resp.status_code, None
+
+    def remember(self, path: str, token: str, status: int, value: Any = None, etag: Optional[str] = None, ttl: float = GITHUB_CACHE_TTL):
+        entries = self._cache.setdefault(path, {})
+        entries[_key(token)] = _Cached(status, etag, value, time.monotonic() + ttl)
+        self._cache.move_to_end(path)
+        while len(self._cache) > GITHUB_CACHE_SIZE:
+            self._cache.popitem(last = False)
+
+    def invalidate(self, path: str):
+        self._cache.pop(path, None)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'rate_limited': self.rate_limited,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'revalidated': self.revalidated,
+            'cache_entries': len(self._cache),
+            'tokens': len(self._tokens)
+        }
+
+
+client = Client()
+
+metrics.register_stats('tiramisu_github', client.stats,
+    counters = {
+        'requests': 'GitHub API requests made',
+        'rate_limited': 'GitHub requests refused or delayed past the limit',
+        'cache_hits': 'GitHub GETs answered from the cache',
+        'cache_misses': 'GitHub GETs sent to GitHub',
+        'revalidated': 'Cached GitHub GETs confirmed with a 304'
+    },
+    gauges = {
+        'cache_entries': 'Paths in the GitHub cache',
+        'tokens': 'Tokens with tracked rate limits'
+    }
+)
@@ -0,0 +1,348 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import os
+import asyncio
+import logging
+from datetime import timedelta
+import httpx
+from sqlalchemy import select, update, tuple_, case
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import func
+
+import db
+import github
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'http://tiramisu.cf:8000/github_callback')
+HOOKS_SYNC_TICK = float(os.getenv('HOOKS_SYNC_TICK', '60'))
+HOOKS_SYNC_BATCH_SIZE = int(os.getenv('HOOKS_SYNC_BATCH_SIZE', '50'))
+HOOKS_SYNC_MAX_ATTEMPTS = int(os.getenv('HOOKS_SYNC_MAX_ATTEMPTS', '10'))
+HOOKS_SYNC_MAX_BACKOFF = 86400
+HOOKS_SYNC_LEASE = 120
+
+ACQUIRED = 'acquired'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+
+_task: Optional[asyncio.Task] = None
+
+
+def _repo_path(owner: str, repo: str) -> str:
+    return f'/repos/{owner}/{repo}'
+
+def _hooks_path(owner: str, repo: str) -> str:
+    return f'/repos/{owner}/{repo}/hooks'
+
+# Cached per token, so repeat subscriptions to a known repository do not call
+# GitHub until the entry goes stale.
+async def _repo_visible(gh_token: str, owner: str, repo: str) -> bool:
+    status, _ = await github.client.get(_repo_path(owner, repo), gh_token)
+    if status in (200, 403, 404):
+        return status == 200
+    raise httpx.HTTPError(f'GitHub answered {status} for {owner}/{repo}')
+
+async def _create_hook(gh_token: str, owner: str, repo: str) -> Optional[int]:
+    resp = await github.client.request(
+        'POST',
+        _hooks_path(owner, repo),
+        gh_token,
+        json = {
+            'name': 'web',
+            'active': True,
+            'events': ['push'],
+            'config': {
+                'url': WEBHOOK_URL,
+                'content_type': 'json',
+                'insecure_ssl': 1
+            }
+        }
+    )
+
+    if resp.status_code == 201:
+        logging.info(f'GH: created hook on {owner}/{repo}')
+        github.client.invalidate(_hooks_path(owner, repo))
+        github.client.remember(_repo_path(owner, repo), gh_token, 200)
+        return resp.json()['id']
+
+    logging.info(f'GH: creating hook on {owner}/{repo}, {resp.status_code} - {resp.text}')
+    if resp.status_code == 422:
+        # GitHub refuses a second identical hook, adopt the existing one.
+        return await _adopt_hook(gh_token, owner, repo)
+    if resp.status_code in (403, 404):
+        # Missing, or not visible to this token.
+        return None
+    resp.raise_for_status()
+    return None
+
+# Hooks created before the registry existed may be duplicated, one per
+# subscription. Keep the first and remove the rest.
+async def _adopt_hook(gh_token: str, owner: str, repo: str) -> Optional[int]:
+    status, hooks = await github.client.get(
+        _hooks_path(owner, repo),
+        gh_token,
+        extract = lambda body: [(hook['id'], hook.get('config', {}).get('url')) for hook in body]
+    )
+    if status != 200:
+        return None
+
+    ours = [hook_id for hook_id, url in hooks if url == WEBHOOK_URL]
+    if not ours:
+        return None
+
+    for hook_id in ours[1:]:
+        await _delete_hook(gh_token, owner, repo, hook_id)
+    return ours[0]
+
+async def _delete_hook(gh_token: str, owner: str, repo: str, hook_id: int) -> Optional[int]:
+    try:
+        resp = await github.client.request('DELETE', f'{_hooks_path(owner, repo)}/{hook_id}', gh_token)
+        logging.info(f'GH: deleted hook {hook_id} on {owner}/{repo}, {resp.status_code}')
+    except httpx.HTTPError as e:
+        logging.warning(f'GH: deleting hook {hook_id} on {owner}/{repo} failed: {e!r}')
+        return None
+    finally:
+        github.client.invalidate(_hooks_path(owner, repo))
+    return resp.status_code
+
+
+async def _lock(session, repos: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], db.Webhook]:
+    # Always lock in the same order, so concurrent bulk requests cannot deadlock.
+    rows = (await session.execute(
+        select(db.Webhook)
+        .where(tuple_(db.Webhook.owner, db.Webhook.repo).in_(list(repos)))
+        .order_by(db.Webhook.owner, db.Webhook.repo)
+        .with_for_update()
+    )).scalars().all()
+    return {(hook.owner, hook.repo): hook for hook in rows}
+
+
+# Subscribing takes two steps, so that no transaction is open while GitHub is
+# called. register() checks the repository, creating or adopting its hook when
+# the registry does not know a live one, then acquire() counts the new
+# subscriptions in the caller's transaction, next to their inserts. repos maps
+# (owner, repo) to the number of subscriptions added or removed.
+
+class Registration(NamedTuple):
+    status: str
+    hook_id: Optional[int] = None
+    # Whether this token created or adopted the hook, so it can delete it too.
+    admin: bool = False
+
+async def _known_hooks(repos: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+    async with db.session() as session:
+        rows = (await session.execute(
+            select(db.Webhook.owner, db.Webhook.repo, db.Webhook.hook_id)
+            .where(
+                tuple_(db.Webhook.owner, db.Webhook.repo).in_(list(repos)),
+                db.Webhook.hook_id != None,
+                db.Webhook.retry_at == None
+            )
+        )).all()
+    return {(row.owner, row.repo): row.hook_id for row in rows}
+
+async def _register(gh_token: str, owner: str, repo: str, hook_id: Optional[int]) -> Registration:
+    try:
+        if hook_id is not None:
+            found = await _repo_visible(gh_token, owner, repo)
+            return Registration(ACQUIRED, hook_id) if found else Registration(NOT_FOUND)
+        hook_id = await _create_hook(gh_token, owner, repo)
+    except httpx.HTTPError as e:
+        logging.warning(f'GH: registering hook on {owner}/{repo} failed: {e!r}')
+        return Registration(FAILED)
+    return Registration(ACQUIRED, hook_id, True) if hook_id is not None else Registration(NOT_FOUND)
+
+async def register(gh_token: str, repos: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Registration]:
+    repos = list(repos)
+    known = await _known_hooks(repos)
+    results = await asyncio.gather(*(_register(gh_token, owner, repo, known.get((owner, repo))) for owner, repo in repos))
+    return dict(zip(repos, results))
+
+# A repository whose pending delete is cancelled here keeps the hook given by
+# register(); if sync() has deleted it meanwhile, it notices and creates it again.
+async def acquire(session, user_id: int, repos: Dict[Tuple[str, str], int], registrations: Dict[Tuple[str, str], Registration]):
+    rows = [
+        {
+            'owner': owner,
+            'repo': repo,
+            'hook_id': registration.hook_id,
+            'ref_count': repos[(owner, repo)],
+            'admin_user_id': user_id if registration.admin else None
+        }
+        for (owner, repo), registration in sorted(registrations.items())
+        if registration.status == ACQUIRED
+    ]
+    if not rows:
+        return
+
+    stmt = insert(db.Webhook).values(rows)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements = [db.Webhook.owner, db.Webhook.repo],
+        set_ = {
+            'ref_count': db.Webhook.ref_count + stmt.excluded.ref_count,
+            'hook_id': stmt.excluded.hook_id,
+            'admin_user_id': func.coalesce(stmt.excluded.admin_user_id, db.Webhook.admin_user_id),
+            'retry_at': None,
+            'attempts': 0,
+            'last_error': None
+        }
+    ))
+
+# Runs in the caller's transaction, next to the subscription deletes. Hooks
+# left unused are only marked; sync() deletes them once that is committed.
+async def release(session, repos: Dict[Tuple[str, str], int]):
+    for (owner, repo), count in sorted(repos.items()):
+        await session.execute(
+            update(db.Webhook)
+            .where(db.Webhook.owner == owner, db.Webhook.repo == repo)
+            .values(
+                ref_count = db.Webhook.ref_count - count,
+                retry_at = case((db.Webhook.ref_count - count <= 0, func.now()), else_ = db.Webhook.retry_at)
+            )
+            .execution_options(synchronize_session = False)
+        )
+
+
+# Repositories marked by release(), or whose hook was lost, are synced with
+# GitHub in three steps: claim them, call GitHub with no transaction open,
+# then record the outcome. Hooks are deleted with the token of the user who
+# created them; fallback_token is only tried when that one is gone, and then
+# a 404 does not prove the hook is gone. Failures are retried with backoff,
+# and after HOOKS_SYNC_MAX_ATTEMPTS the row is kept with its last error.
+
+class _Claim(NamedTuple):
+    owner: str
+    repo: str
+    hook_id: Optional[int]
+    ref_count: int
+    attempts: int
+    admin_token: Optional[str]
+
+async def _claim(repos: Optional[List[Tuple[str, str]]], batch_size: int) -> List[_Claim]:
+    async with db.session() as session:
+        due = select(db.Webhook.owner, db.Webhook.repo) \
+            .where(db.Webhook.retry_at <= func.now()) \
+            .order_by(db.Webhook.retry_at) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked = True)
+        if repos is not None:
+            due = due.where(tuple_(db.Webhook.owner, db.Webhook.repo).in_(repos))
+
+        rows = (await session.execute(
+            update(db.Webhook)
+            .where(tuple_(db.Webhook.owner, db.Webhook.repo).in_(due))
+            .values(
+                retry_at = func.now() + timedelta(seconds = HOOKS_SYNC_LEASE),
+                attempts = db.Webhook.attempts + 1
+            )
+            .returning(db.Webhook.owner, db.Webhook.repo, db.Webhook.hook_id, db.Webhook.ref_count, db.Webhook.attempts, db.Webhook.admin_user_id)
+            .execution_options(synchronize_session = False)
+        )).all()
+
+        admins = {row.admin_user_id for row in rows if row.admin_user_id is not None}
+        tokens = dict((await session.execute(
+            select(db.User.id, db.User.github_access_token).where(db.User.id.in_(admins))
+        )).all()) if admins else {}
+        await session.commit()
+
+    return [
+        _Claim(row.owner, row.repo, row.hook_id, row.ref_count, row.attempts, tokens.get(row.admin_user_id))
+        for row in rows
+    ]
+
+# Returns whether GitHub now matches the row, the hook id it ended up with,
+# and the error otherwise.
+async def _apply(claim: _Claim, fallback_token: Optional[str]) -> Tuple[bool, Optional[int], Optional[str]]:
+    token = claim.admin_token or fallback_token
+    if token is None:
+        return False, claim.hook_id, 'no token can manage the hook'
+
+    try:
+        if claim.ref_count > 0:
+            hook_id = await _create_hook(token, claim.owner, claim.repo)
+            return hook_id is not None, hook_id, None if hook_id is not None else 'hook not created'
+
+        hook_id = claim.hook_id
+        if hook_id is None:
+            hook_id = await _adopt_hook(token, claim.owner, claim.repo)
+            if hook_id is None:
+                return claim.admin_token is not None, None, 'hook not found'
+    except httpx.HTTPError as e:
+        return False, claim.hook_id, repr(e)
+
+    status = await _delete_hook(token, claim.owner, claim.repo, hook_id)
+    if status == 204 or (status == 404 and claim.admin_token is not None):
+        return True, hook_id, None
+    return False, hook_id, f'delete answered {status}'
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds = min(HOOKS_SYNC_MAX_BACKOFF, HOOKS_SYNC_TICK * 2 ** attempts))
+
+async def _record(claims: List[_Claim], outcomes: List[Tuple[bool, Optional[int], Optional[str]]]):
+    async with db.session() as session:
+        hooks = await _lock(session, [(claim.owner, claim.repo) for claim in claims])
+
+        for claim, (done, hook_id, error) in zip(claims, outcomes):
+            hook = hooks.get((claim.owner, claim.repo))
+            if hook is None:
+                continue
+
+            if done and claim.ref_count <= 0:
+                if hook.ref_count <= 0:
+                    await session.delete(hook)
+                elif hook.hook_id == hook_id:
+                    # Subscribed again while the hook was being deleted.
+                    hook.hook_id = None
+                    hook.retry_at = func.now()
+                    hook.attempts = 0
+                continue
+
+            # acquire() clears retry_at when the repository is subscribed again.
+            if hook.retry_at is None:
+                continue
+
+            if done:
+                hook.hook_id = hook_id
+                hook.retry_at = None if hook.ref_count > 0 else func.now()
+                hook.attempts = 0
+                hook.last_error = None
+            elif claim.attempts >= HOOKS_SYNC_MAX_ATTEMPTS:
+                logging.warning(f'GH: giving up on hook {hook.hook_id} on {hook.owner}/{hook.repo}: {error}')
+                hook.retry_at = None
+                hook.last_error = error
+            else:
+                logging.info(f'GH: syncing hook on {hook.owner}/{hook.repo} failed: {error}')
+                hook.retry_at = func.now() + _backoff(claim.attempts)
+                hook.last_error = error
+
+        await session.commit()
+
+async def sync(repos: Optional[Iterable[Tuple[str, str]]] = None, fallback_token: Optional[str] = None):
+    claims = await _claim(list(repos) if repos is not None else None, HOOKS_SYNC_BATCH_SIZE)
+    if not claims:
+        return
+    outcomes = await asyncio.gather(*(_apply(claim, fallback_token) for claim in claims))
+    await _record(claims, outcomes)
+
+
+async def _run():
+    while True:
+        try:
+            await sync()
+        except Exception:
+            logging.exception('Hook sync failed')
+
+        await asyncio.sleep(HOOKS_SYNC_TICK)
+
+
+async def start():
+    global _task
+    _task = asyncio.create_task(_run())
+
+def running() -> bool:
+    return _task is not None and not _task.done()
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions = True)
+        _task = None
@@ -0,0 +1,162 @@
+from typing import Dict
+
+import os
+import re
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import contextlib
+import contextvars
+import logging.handlers
+
+import metrics
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', '1000'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Per call site sampling rates overriding the ones in the code, e.g.
+# `worker.match=0.1,github_callback=0.5`.
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', '')
+
+TEXT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+SECRETS = [
+    (re.compile(r'\b(gh[pousr]_)[A-Za-z0-9_]{16,}'), r'\1[redacted]'),
+    (re.compile(r'\b((?:access[_ ]token|device[_ ]code|client[_ ]secret|secret)["\']?\s*[:=\s]\s*["\']?)[^\s"\',&}]+', re.IGNORECASE), r'\1[redacted]'),
+    # Authorization header values, `Bearer <token>` or `token <token>`.
+    (re.compile(r'\b((?:bearer|token)\s+)[A-Za-z0-9_\-.~+/:]{16,}=*', re.IGNORECASE), r'\1[redacted]')
+]
+
+_context: contextvars.ContextVar = contextvars.ContextVar('log_context', default = {})
+
+_rates: Dict[str, float] = {}
+for item in filter(None, LOG_SAMPLE.split(',')):
+    site, rate = item.split('=', 1)
+    _rates[site.strip()] = float(rate)
+
+_listener: logging.handlers.QueueListener = None
+_handler: 'QueueHandler' = None
+_sampled_out = 0
+
+
+# Fields such as request and delivery ids, attached to every record logged
+# inside the block, including from tasks it starts.
+@contextlib.contextmanager
+def context(**fields):
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+# Same, for the rest of the current task. Each request runs in its own task.
+def bind(**fields):
+    _context.set({**_context.get(), **fields})
+
+# For call sites on the hot path: `if log.sampled('site', 0.01): logging...`
+# skips formatting the message as well as writing it.
+def sampled(site: str, rate: float = 1.0) -> bool:
+    global _sampled_out
+    rate = _rates.get(site, rate)
+    if rate >= 1 or random.random() < rate:
+        return True
+    _sampled_out += 1
+    return False
+
+def redact(text: str) -> str:
+    for pattern, replacement in SECRETS:
+        text = pattern.sub(replacement, text)
+    return text
+
+def _clip(text: str) -> str:
+    if len(text) <= LOG_MAX_LENGTH:
+        return text
+    return f'{text[:LOG_MAX_LENGTH]}... ({len(text) - LOG_MAX_LENGTH} more characters)'
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = redact(_clip(record.message))
+        line = super().formatMessage(record)
+        if record.context:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in record.context.items())
+        return line
+
+    def formatException(self, exc_info) -> str:
+        return redact(super().formatException(exc_info))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': redact(_clip(record.getMessage())),
+            **record.context
+        }
+        if record.exc_info:
+            entry['exception'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default = str)
+
+
+# The caller only captures the record, formatting and writing happen on the
+# listener thread. When the queue is full records are dropped rather than
+# blocking the event loop.
+class QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.context = _context.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup():
+    global _listener, _handler
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+
+    _handler = QueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(LOG_LEVEL)
+
+def stats():
+    return {
+        'queue_depth': _handler.queue.qsize() if _handler is not None else 0,
+        'dropped': _handler.dropped if _handler is not None else 0,
+        'sampled_out': _sampled_out
+    }
+
+
+metrics.register_stats('tiramisu_log', stats,
+    counters = {
+        'dropped': 'Log records dropped because the queue was full',
+        'sampled_out': 'Log lines skipped by sampling'
+    },
+    gauges = {
+        'queue_depth': 'Log records waiting to be written'
+    }
+)
@@ -1,162 +1,159 @@
-from typing import List
+from typing import List, Optional
 
 import asyncio
-import sys
+import hmac
+import uuid
 import logging
-import requests
-from fastapi import FastAPI, Request
+import collections
+from fastapi import FastAPI, Header, Request, Response
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST
+from sqlalchemy import select, update, delete, insert
 from sqlalchemy.sql.expression import func
-from pathlib import PurePath
 
 import db
-import github_apikey
-
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+import cache
+import device_flow
+import digest
+import github
+import hooks
+import log
+import matching
+import metrics
+import notifier
+import profiling
+import push
+import worker
+
+log.setup()
 
 STATUS_OK = 'success'
 STATUS_ALREADY_LOGGED_IN = 'already_logged_in'
 STATUS_AUTH_FAILED = 'authentication_failed'
 STATUS_FAILURE = 'fail'
 STATUS_REPO_NOT_FOUND = 'repository_not_found'
-
-
-def send_notification(chat_id: str, message: str):
-    requests.post(
-        'http://frontend:5000/notification',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'chat_id': chat_id,
-            'message': message
-        }
-    )
-
-def get_authenticated_user(tg_chat_id):
-    with db.session() as session:
-        user = session.query(db.User).filter_by(telegram_id = tg_chat_id).first()
-        if user is None or user.github_access_token is None:
+STATUS_NOT_FOUND = 'not_found'
+STATUS_UNAVAILABLE = 'unavailable'
+
+BOOT_STARTING = 'starting'
+BOOT_READY = 'ready'
+BOOT_FAILED = 'failed'
+PROBE_PATHS = ('/healthz', '/readyz', '/metrics')
+
+MAX_BULK_ITEMS = 500
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+async def get_authenticated_user(tg_chat_id):
+    user = cache.users.get(tg_chat_id)
+
+    if user is None:
+        generation = cache.users.generation
+        async with db.session() as session:
+            row = (await session.execute(
+                select(
+                    db.User.id,
+                    db.User.telegram_id,
+                    db.User.github_access_token,
+                    db.User.notifications_enabled
+                ).where(db.User.telegram_id == tg_chat_id)
+            )).first()
+        if row is None:
             return None
-        return user
-
-
-def github_auth_begin():
-    res = requests.post(
-        'https://github.com/login/device/code',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'client_id': github_apikey.CLIENT_ID,
-            'scope': 'repo'
-        }
-    ).json()
-
-    for field in ['device_code', 'user_code', 'verification_uri', 'expires_in', 'interval']:
-        assert field in res
-
-    return res
-
-async def github_auth_loop(device_code, interval):
-    while True:
-        res = requests.post(
-            'https://github.com/login/oauth/access_token',
-            headers = {
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            },
-            json = {
-                'client_id': github_apikey.CLIENT_ID,
-                'device_code': device_code,
-                'grant_type': 'urn:ietf:params:oauth:grant-type:device_code'
-            }
-        ).json()
-
-        if 'error' in res:
-
-            if res['error'] == 'slow_down':
-                interval = res['interval']
-                logging.info(f'GH auth, slowing down, interval {interval}')
-            elif res['error'] == 'authorization_pending':
-                logging.info(f'GH auth, pending')
-            else:
-                logging.warn(f'GH auth, error: {res}')
-
-        elif 'access_token' in res:
-            return res['access_token']
+        user = cache.CachedUser(*row)
+        # Skip caching if a logout or toggle raced with the query.
+        if generation == cache.users.generation:
+            cache.users.put(tg_chat_id, user)
 
-        await asyncio.sleep(interval)
+    if user.github_access_token is None:
+        return None
+    return user
 
-async def github_auth_get_token(tg_chat_id, request):
-    device_code = request['device_code']
-    expires_in = request['expires_in']
-    interval = request['interval']
-
-    try:
-        access_token = await asyncio.wait_for(
-            github_auth_loop(device_code, interval),
-            timeout = expires_in
-        )
-    except asyncio.TimeoutError:
-        logging.info(f'GH auth, timed out')
-        send_notification(tg_chat_id, 'Login timed out. Please try again.')
-        return
-    except Exception as e:
-        logging.warn(f'GH auth, got exception {e}')
-        send_notification(tg_chat_id, 'Login failed. Please try again.')
-        return
-
-    with db.session() as session:
-        user = session.query(db.User).filter_by(telegram_id = tg_chat_id).first()
-
-        if user:
-            user.github_access_token = access_token
-        else:
-            user = db.User(
-                telegram_id = tg_chat_id,
-                github_access_token = access_token,
-                notifications_enabled = True
-            )
-            session.add(user)
-
-        session.commit()
-
-    logging.info(f'GH auth success, chat id {tg_chat_id}, access token {access_token}')
-    send_notification(tg_chat_id, 'Logged in successfully.')
-
-
-def add_github_webhook(gh_token: str, owner: str, repo: str):
-    resp = requests.post(
-        f'https://api.github.com/repos/{owner}/{repo}/hooks',
-        headers = {
-            'Authorization': f'Bearer {gh_token}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'name': 'web',
-            'active': True,
-            'events': ['push'],
-            'config': {
-                'url': 'http://tiramisu.cf:8000/github_callback',
-                'content_type': 'json',
-                'insecure_ssl': 1
-            }
-        }
-    )
-
-    logging.info(f'GH: {resp.status_code} - {resp.text}')
-
-    return resp.status_code != 404
 
 app = FastAPI()
 
+_boot: Optional[asyncio.Task] = None
+
+async def boot():
+    await db.init()
+    cache.start_listener()
+    await notifier.sender.start()
+    await github.client.start()
+    await device_flow.start()
+    await hooks.start()
+    matching.start()
+    worker.start(worker.WEBHOOK_WORKERS)
+    digest.coalescer.start()
+    logging.info('Backend ready')
+
+def boot_state() -> str:
+    if _boot is None or not _boot.done():
+        return BOOT_STARTING
+    if _boot.cancelled() or _boot.exception() is not None:
+        return BOOT_FAILED
+    return BOOT_READY
+
+# Boot runs in the background so the server answers probes while the
+# database comes up. Until then, everything but the probes gets a 503.
 @app.on_event('startup')
-def app_startup():
-    db.init()
+async def app_startup():
+    global _boot
+    _boot = asyncio.create_task(boot())
+    _boot.add_done_callback(_boot_done)
+
+def _boot_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f'Backend failed to start: {task.exception()}')
+
+# Plain ASGI rather than @app.middleware, which would buffer every request
+# through an extra task once the backend is up.
+class BootGate:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in PROBE_PATHS or boot_state() == BOOT_READY:
+            await self.app(scope, receive, send)
+            return
+        await JSONResponse({'status': STATUS_UNAVAILABLE}, status_code = 503)(scope, receive, send)
+
+app.add_middleware(BootGate)
+
+class RequestId:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope['headers']:
+            if name == b'x-request-id':
+                request_id = value.decode('latin-1')
+        with log.context(request_id = request_id or uuid.uuid4().hex):
+            await self.app(scope, receive, send)
+
+app.add_middleware(RequestId)
+app.add_middleware(profiling.Middleware)
+
+@app.on_event('shutdown')
+async def app_shutdown():
+    if _boot is not None and not _boot.done():
+        _boot.cancel()
+        await asyncio.gather(_boot, return_exceptions = True)
+    await digest.coalescer.stop()
+    await worker.stop()
+    matching.stop()
+    await hooks.stop()
+    await device_flow.stop()
+    await github.client.stop()
+    await notifier.sender.stop()
+    await cache.stop_listener()
+    await db.close()
 
 
 class ApiRequest(BaseModel):
@@ -168,24 +165,39 @@ class RemoveRequest(ApiRequest): pass
 class NotificationEnableRequest(ApiRequest): pass
 class NotificationDisableRequest(ApiRequest): pass
 
+class NotificationDigestRequest(ApiRequest):
+    window: int
+
 class SubscriptionAddRequest(ApiRequest):
     owner: str
     repo: str
     pattern: str
 
-class SubscriptionListRequest(ApiRequest): pass
+class SubscriptionListRequest(ApiRequest):
+    cursor: Optional[int] = None
+    limit: int = DEFAULT_PAGE_SIZE
 
 class SubscriptionDeleteRequest(ApiRequest):
-    sub_id: str
+    sub_id: int
+
+class SubscriptionItem(BaseModel):
+    owner: str
+    repo: str
+    pattern: str
+
+class SubscriptionBulkAddRequest(ApiRequest):
+    subscriptions: List[SubscriptionItem]
+
+class SubscriptionBulkDeleteRequest(ApiRequest):
+    sub_ids: List[int]
 
 
 @app.post('/user/connect')
 async def api_user_connect(req: ConnectRequest):
-    if get_authenticated_user(req.tg_chat_id):
+    if await get_authenticated_user(req.tg_chat_id):
         return {'status': STATUS_ALREADY_LOGGED_IN}
 
-    gh_request = github_auth_begin()
-    asyncio.create_task(github_auth_get_token(req.tg_chat_id, gh_request))
+    gh_request = await device_flow.begin(req.tg_chat_id)
 
     return {
         'status': STATUS_OK,
@@ -194,55 +206,74 @@ async def api_user_connect(req: ConnectRequest):
     }
 
 @app.post('/user/remove')
-def api_user_remove(req: RemoveRequest):
-    if not (user := get_authenticated_user(req.tg_chat_id)):
+async def api_user_remove(req: RemoveRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
         return {'status': STATUS_AUTH_FAILED}
 
-    with db.session() as session:
-        session.query(db.User).filter_by(id = user.id).first().github_access_token = None
-        session.commit()
+    async with db.session() as session:
+        await session.execute(update(db.User).where(db.User.id == user.id).values(github_access_token = None))
+        await cache.invalidate_user(session, user.id, user.telegram_id)
+        await session.commit()
 
     return {'status': STATUS_OK}
 
 
 @app.get('/notifications/enable')
-def api_notifications_enable(req: NotificationEnableRequest):
-    if not (user := get_authenticated_user(req.tg_chat_id)):
+async def api_notifications_enable(req: NotificationEnableRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
         return {'status': STATUS_AUTH_FAILED}
 
-    with db.session() as session:
-        session.query(db.User).filter_by(id = user.id).first().notifications_enabled = True
-        session.commit()
+    async with db.session() as session:
+        await session.execute(update(db.User).where(db.User.id == user.id).values(notifications_enabled = True))
+        await cache.invalidate_user(session, user.id, user.telegram_id)
+        await session.commit()
 
     return {'status': STATUS_OK}
 
 @app.get('/notifications/disable')
-def api_notifications_enable(req: NotificationDisableRequest):
-    if not (user := get_authenticated_user(req.tg_chat_id)):
+async def api_notifications_enable(req: NotificationDisableRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
         return {'status': STATUS_AUTH_FAILED}
 
-    with db.session() as session:
-        session.query(db.User).filter_by(id = user.id).first().notifications_enabled = False
-        session.commit()
+    async with db.session() as session:
+        await session.execute(update(db.User).where(db.User.id == user.id).values(notifications_enabled = False))
+        await cache.invalidate_user(session, user.id, user.telegram_id)
+        await session.commit()
+
+    return {'status': STATUS_OK}
+
+@app.post('/notifications/digest')
+async def api_notifications_digest(req: NotificationDigestRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
+        return {'status': STATUS_AUTH_FAILED}
+
+    if not 0 <= req.window <= digest.DIGEST_MAX_WINDOW:
+        return {'status': STATUS_FAILURE}
+
+    async with db.session() as session:
+        await session.execute(update(db.User).where(db.User.id == user.id).values(digest_window = req.window))
+        await cache.invalidate_user(session, user.id, user.telegram_id)
+        await session.commit()
 
     return {'status': STATUS_OK}
 
 
 @app.post('/subscription')
-def api_subscription(req: SubscriptionAddRequest):
-    if not (user := get_authenticated_user(req.tg_chat_id)):
+async def api_subscription(req: SubscriptionAddRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
         return {'status': STATUS_AUTH_FAILED}
 
-    if not add_github_webhook(user.github_access_token, req.owner, req.repo):
-        return {'status': STATUS_REPO_NOT_FOUND}
+    repo = (req.owner, req.repo)
+    registrations = await hooks.register(user.github_access_token, [repo])
+    if registrations[repo].status != hooks.ACQUIRED:
+        return {'status': STATUS_REPO_NOT_FOUND if registrations[repo].status == hooks.NOT_FOUND else STATUS_FAILURE}
 
-    with db.session() as session:
-        last_sub_id = session.query(func.max(db.Subscription.id)).filter_by(user_id = user.id).first()[0]
-        if not last_sub_id:
-            last_sub_id = 0
+    async with db.session() as session:
+        await hooks.acquire(session, user.id, {repo: 1}, registrations)
+        sub_id, = await db.allocate_subscription_ids(session, user.id)
 
         sub = db.Subscription(
-            id = last_sub_id + 1,
+            id = sub_id,
             user_id = user.id,
             owner = req.owner,
             repo = req.repo,
@@ -250,80 +281,277 @@ def api_subscription(req: SubscriptionAddRequest):
         )
 
         session.add(sub)
-        session.commit()
+        await cache.invalidate_repo(session, req.owner, req.repo)
+        await session.commit()
 
     return {'status': STATUS_OK}
 
+# Pages are ordered by id; next_cursor is passed back as cursor to get the
+# following page. The ETag changes whenever the user's subscriptions do, so a
+# client holding a page can revalidate it with If-None-Match.
 @app.post('/subscription/list')
-def api_subscription_list(req: SubscriptionListRequest):
-    if not (user := get_authenticated_user(req.tg_chat_id)):
+async def api_subscription_list(req: SubscriptionListRequest, response: Response, if_none_match: Optional[str] = Header(None)):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
         return {'status': STATUS_AUTH_FAILED}
 
-    with db.session() as session:
-        subs = session.query(db.Subscription).filter_by(user_id = user.id).order_by(db.Subscription.id).all()
+    limit = max(1, min(req.limit, MAX_PAGE_SIZE))
+
+    async with db.session() as session:
+        version = await session.scalar(select(db.User.subscriptions_version).where(db.User.id == user.id))
+        etag = f'"{user.id}.{version}.{req.cursor or 0}.{limit}"'
+        if if_none_match == etag:
+            return Response(status_code = 304, headers = {'ETag': etag})
 
-    res = []
-    for sub in subs:
-        res.append({
-            'id': sub.id,
-            'owner': sub.owner,
-            'repo': sub.repo,
-            'pattern': sub.pattern
-        })
+        query = select(db.Subscription.id, db.Subscription.owner, db.Subscription.repo, db.Subscription.pattern) \
+            .where(db.Subscription.user_id == user.id) \
+            .order_by(db.Subscription.id) \
+            .limit(limit + 1)
+        if req.cursor is not None:
+            query = query.where(db.Subscription.id > req.cursor)
+        subs = (await session.execute(query)).all()
 
+    response.headers['ETag'] = etag
     return {
         'status': STATUS_OK,
-        'result': res
+        'result': [sub._asdict() for sub in subs[:limit]],
+        'next_cursor': subs[limit - 1].id if len(subs) > limit else None
     }
 
 @app.post('/subscription/delete')
-def api_subscription_delete(req: SubscriptionDeleteRequest):
-    if not (user := get_authenticated_user(req.tg_chat_id)):
+async def api_subscription_delete(req: SubscriptionDeleteRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
         return {'status': STATUS_AUTH_FAILED}
 
-    with db.session() as session:
-        sub = session.query(db.Subscription).filter_by(user_id = user.id, id = req.sub_id).first()
+    async with db.session() as session:
+        sub = (await session.execute(
+            select(db.Subscription).where(db.Subscription.user_id == user.id, db.Subscription.id == req.sub_id)
+        )).scalars().first()
         if sub:
-            session.delete(sub)
+            await session.delete(sub)
+            await db.bump_subscriptions_version(session, user.id)
+            await hooks.release(session, {(sub.owner, sub.repo): 1})
+            await cache.invalidate_repo(session, sub.owner, sub.repo)
 
-        session.commit()
+        await session.commit()
 
-    return {'status': STATUS_OK}
+    if sub:
+        await hooks.sync([(sub.owner, sub.repo)], user.github_access_token)
 
+    return {'status': STATUS_OK}
 
-@app.post('/github_callback')
-async def github_callback(req: Request):
-    body = await req.json()
-    logging.info(f'Got GH callback, {body}')
 
-    try:
-        repo_full_name: str = body['repository']['full_name']
-        repo_owner, repo_name = repo_full_name.split('/', 1)
-        pusher_name: str = body['pusher']['name']
-        modified_files: List[str] = body['head_commit']['added'] + body['head_commit']['removed'] + body['head_commit']['modified']
-    except KeyError as e:
-        logging.info(f'KeyError in GH callback, {e}')
+@app.post('/subscription/bulk')
+async def api_subscription_bulk(req: SubscriptionBulkAddRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
+        return {'status': STATUS_AUTH_FAILED}
+    if len(req.subscriptions) > MAX_BULK_ITEMS:
         return {'status': STATUS_FAILURE}
 
-    with db.session() as session:
-        subs = session.query(db.Subscription).filter_by(owner = repo_owner, repo = repo_name).all()
-        logging.info(f'Subs: {subs}')
+    repos = collections.Counter((item.owner, item.repo) for item in req.subscriptions if item.pattern)
+    result = []
+
+    registrations = await hooks.register(user.github_access_token, repos) if repos else {}
+    acquired = {key: registration.status for key, registration in registrations.items()}
 
-        sent = set()
+    async with db.session() as session:
+        await hooks.acquire(session, user.id, repos, registrations)
 
-        for sub in subs:
-            if sub.user.telegram_id in sent:
+        accepted = [item for item in req.subscriptions if item.pattern and acquired[(item.owner, item.repo)] == hooks.ACQUIRED]
+        sub_ids = iter(await db.allocate_subscription_ids(session, user.id, len(accepted)) if accepted else ())
+
+        rows = []
+        for item in req.subscriptions:
+            if not item.pattern:
+                result.append({'status': STATUS_FAILURE})
                 continue
 
-            match = False
-            for fname in modified_files:
-                if PurePath(fname).match(sub.pattern):
-                    logging.info(f'Pattern {sub.pattern} matched file {fname}')
-                    match = True
-                    break
+            status = acquired[(item.owner, item.repo)]
+            if status == hooks.ACQUIRED:
+                rows.append({
+                    'id': next(sub_ids),
+                    'user_id': user.id,
+                    'owner': item.owner,
+                    'repo': item.repo,
+                    'pattern': item.pattern
+                })
+                result.append({'status': STATUS_OK, 'id': rows[-1]['id']})
+            else:
+                result.append({'status': STATUS_REPO_NOT_FOUND if status == hooks.NOT_FOUND else STATUS_FAILURE})
+
+        if rows:
+            await session.execute(insert(db.Subscription).values(rows))
+            for owner, repo in {(row['owner'], row['repo']) for row in rows}:
+                await cache.invalidate_repo(session, owner, repo)
+        await session.commit()
+
+    return {
+        'status': STATUS_OK,
+        'result': result
+    }
+
+@app.post('/subscription/bulk/delete')
+async def api_subscription_bulk_delete(req: SubscriptionBulkDeleteRequest):
+    if not (user := await get_authenticated_user(req.tg_chat_id)):
+        return {'status': STATUS_AUTH_FAILED}
+    if len(req.sub_ids) > MAX_BULK_ITEMS:
+        return {'status': STATUS_FAILURE}
+
+    async with db.session() as session:
+        deleted = (await session.execute(
+            delete(db.Subscription)
+            .where(db.Subscription.user_id == user.id, db.Subscription.id.in_(req.sub_ids))
+            .returning(db.Subscription.id, db.Subscription.owner, db.Subscription.repo)
+            .execution_options(synchronize_session = False)
+        )).all()
+
+        repos = collections.Counter((sub.owner, sub.repo) for sub in deleted)
+        if repos:
+            await db.bump_subscriptions_version(session, user.id)
+            await hooks.release(session, repos)
+            for owner, repo in repos:
+                await cache.invalidate_repo(session, owner, repo)
+        await session.commit()
+
+    if repos:
+        await hooks.sync(repos, user.github_access_token)
+
+    deleted_ids = {sub.id for sub in deleted}
+    return {
+        'status': STATUS_OK,
+        'result': [
+            {'id': sub_id, 'status': STATUS_OK if sub_id in deleted_ids else STATUS_NOT_FOUND}
+            for sub_id in req.sub_ids
+        ]
+    }
+
+
+@app.get('/healthz')
+def api_healthz(response: Response):
+    state = boot_state()
+    if state == BOOT_FAILED:
+        response.status_code = 503
+    return {'status': STATUS_OK if state != BOOT_FAILED else STATUS_FAILURE, 'boot': state}
+
+@app.get('/readyz')
+async def api_readyz(response: Response):
+    checks = {
+        'boot': boot_state() == BOOT_READY,
+        'database': await db.ping(),
+        'cache_listener': cache.listening(),
+        'notifier': notifier.sender.running(),
+        'device_flow': device_flow.running(),
+        'hooks': hooks.running(),
+        'digest': digest.coalescer.running(),
+        'workers': worker.running()
+    }
+    ready = all(checks.values())
+    if not ready:
+        response.status_code = 503
+    return {
+        'status': STATUS_OK if ready else STATUS_UNAVAILABLE,
+        'checks': checks,
+        'schema_version': db.schema_version,
+        'pool': db.pool_status()
+    }
+
+@app.get('/cache/stats')
+def api_cache_stats():
+    return {
+        'status': STATUS_OK,
+        'result': cache.stats()
+    }
+
+@app.get('/notifier/stats')
+async def api_notifier_stats():
+    return {
+        'status': STATUS_OK,
+        'result': {
+            **notifier.sender.stats(),
+            'outbox': await notifier.sender.backlog(),
+            'digest': digest.coalescer.stats()
+        }
+    }
+
+
+class ProfilingRequest(BaseModel):
+    rate: Optional[float] = None
+    cprofile: Optional[bool] = None
+    paths: Optional[List[str]] = None
+
+# The endpoints are off unless PROFILING_TOKEN is set.
+def profiling_allowed(token: Optional[str]) -> bool:
+    return profiling.PROFILING_TOKEN is not None and token is not None and hmac.compare_digest(token, profiling.PROFILING_TOKEN)
 
-            if match and sub.user.notifications_enabled:
-                send_notification(sub.user.telegram_id, f'New commit by {pusher_name} on repo {repo_full_name} matching pattern {sub.pattern}')
-                sent.add(sub.user.telegram_id)
+@app.get('/debug/profiling')
+def api_profiling(response: Response, x_profiling_token: Optional[str] = Header(None)):
+    if not profiling_allowed(x_profiling_token):
+        response.status_code = 403
+        return {'status': STATUS_AUTH_FAILED}
+    return {
+        'status': STATUS_OK,
+        'result': {
+            **profiling.profiler.settings(),
+            'traces': list(profiling.profiler.traces)
+        }
+    }
+
+@app.post('/debug/profiling')
+def api_profiling_configure(req: ProfilingRequest, response: Response, x_profiling_token: Optional[str] = Header(None)):
+    if not profiling_allowed(x_profiling_token):
+        response.status_code = 403
+        return {'status': STATUS_AUTH_FAILED}
+    profiling.profiler.configure(req.rate, req.cprofile, req.paths)
+    return {
+        'status': STATUS_OK,
+        'result': profiling.profiler.settings()
+    }
+
+@app.get('/metrics')
+async def api_metrics():
+    # Counted at scrape time, they are not worth tracking on every change.
+    if boot_state() == BOOT_READY:
+        try:
+            async with db.session() as session:
+                metrics.PENDING_LOGINS.set(await session.scalar(select(func.count()).select_from(db.PendingLogin)))
+                metrics.WEBHOOK_BACKLOG.set(await session.scalar(
+                    select(func.count()).select_from(db.WebhookEvent).where(db.WebhookEvent.processed_at.is_(None))
+                ))
+            outbox = await notifier.sender.backlog()
+            metrics.OUTBOX_BACKLOG.set(outbox['pending'])
+            metrics.OUTBOX_DEAD.set(outbox['dead'])
+        except Exception:
+            logging.exception('Counting pending logins, webhook events and notifications failed')
+
+    return Response(metrics.render(), headers = {'Content-Type': CONTENT_TYPE_LATEST})
+
+
+@app.post('/github_callback', status_code = 202)
+async def github_callback(req: Request, response: Response):
+    delivery_id = req.headers.get('X-GitHub-Delivery') or str(uuid.uuid4())
+    log.bind(delivery_id = delivery_id)
+
+    try:
+        with metrics.PARSE.time(), profiling.span('parse'):
+            body = await push.parse(req.stream())
+    except push.PushError as e:
+        metrics.WEBHOOKS.labels('invalid').inc()
+        logging.info(f'Bad GH callback {delivery_id}, {e}')
+        response.status_code = 400
+        return {'status': STATUS_FAILURE}
+
+    if log.sampled('github_callback'):
+        logging.info(f'Got GH callback {delivery_id}, {body.repo_full_name} by {body.pusher}, {len(body.paths)} paths')
+    repo_owner, repo_name = body.repo_full_name.split('/', 1)
+
+    push_key = push.key(body, req.headers.get('X-GitHub-Hook-ID'))
+
+    with metrics.ENQUEUE.time(), profiling.span('enqueue'):
+        if not body.paths or not await cache.subscriptions.get(repo_owner, repo_name):
+            result = 'ignored'
+        elif await worker.enqueue(delivery_id, push_key, repo_owner, repo_name, body.pusher, sorted(body.paths)):
+            result = 'queued'
+        else:
+            result = 'duplicate'
+    metrics.WEBHOOKS.labels(result).inc()
 
     return {'status': STATUS_OK}
@@ -0,0 +1,105 @@
+from typing import Dict, List, Optional, Set, Tuple
+
+import os
+import asyncio
+import logging
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+
+import patterns
+
+# Pushes up to this many paths are matched inline, on the event loop.
+MATCH_INLINE_MAX_PATHS = int(os.getenv('MATCH_INLINE_MAX_PATHS', '2000'))
+# 0 matches every push inline. The pool is only started by the first push
+# over MATCH_INLINE_MAX_PATHS.
+MATCH_PROCESSES = int(os.getenv('MATCH_PROCESSES', '0'))
+# 0 splits each push evenly between the processes.
+MATCH_CHUNK_SIZE = int(os.getenv('MATCH_CHUNK_SIZE', '0'))
+# Pattern indexes kept by each matching process.
+MAX_CACHED_INDEXES = 256
+
+_processes = 0
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+# Runs in the matching processes. The paths of a push are written once to a
+# shared memory block, NUL separated; each task only carries its byte range
+# and the patterns.
+_indexes: Dict[Tuple[str, ...], patterns.PatternIndex] = {}
+
+def _match_chunk(block: str, start: int, end: int, pattern_list: Tuple[str, ...]) -> Set[str]:
+    index = _indexes.get(pattern_list)
+    if index is None:
+        if len(_indexes) >= MAX_CACHED_INDEXES:
+            _indexes.clear()
+        index = _indexes[pattern_list] = patterns.PatternIndex(pattern_list)
+
+    # The pool's processes share the parent's resource tracker, so attaching
+    # does not make them owners of the block: the parent unlinks it.
+    shm = SharedMemory(block)
+    try:
+        paths = bytes(shm.buf[start:end]).decode().split('\0')
+    finally:
+        shm.close()
+    return index.match(paths)
+
+
+def chunk_size(paths: int) -> int:
+    return MATCH_CHUNK_SIZE or max(1, -(-paths // max(1, _processes)))
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Not fork: the parent has an event loop and threads running.
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _pool = ProcessPoolExecutor(_processes, mp_context = multiprocessing.get_context(method))
+        logging.info(f'Started {_processes} matching processes')
+    return _pool
+
+async def match(index: patterns.PatternIndex, paths: List[str]) -> Set[str]:
+    if _processes <= 0 or len(paths) <= MATCH_INLINE_MAX_PATHS:
+        return index.match(paths)
+
+    pool = _get_pool()
+    size = chunk_size(len(paths))
+    data = bytearray()
+    bounds = [0]
+    for n in range(0, len(paths), size):
+        if n:
+            data += b'\0'
+        data += '\0'.join(paths[n:n + size]).encode()
+        bounds.append(len(data))
+
+    shm = SharedMemory(create = True, size = max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+        loop = asyncio.get_running_loop()
+        pattern_list = tuple(index.patterns)
+        results = await asyncio.gather(*(
+            # Chunks after the first start past their separator. Git paths
+            # cannot contain NUL.
+            loop.run_in_executor(pool, _match_chunk, shm.name, start + (i > 0), end, pattern_list)
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:]))
+        ))
+    finally:
+        shm.close()
+        shm.unlink()
+    return set().union(*results)
+
+
+# Most deployments never see a push large enough for the pool, so each
+# server process only starts it when one arrives.
+def start(processes: int = MATCH_PROCESSES):
+    global _processes
+    if _pool is None:
+        _processes = max(0, processes)
+
+# Waits for the processes to exit: on Python 3.8, a pool dropped while it
+# is still shutting down hangs interpreter exit.
+def stop():
+    global _pool, _processes
+    if _pool is not None:
+        _pool.shutdown(wait = True)
+        _pool = None
+    _processes = 0
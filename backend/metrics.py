@@ -0,0 +1,83 @@
+from typing import Callable, Dict
+
+import time
+import httpx
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, generate_latest, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Most of the push path runs in well under a millisecond per phase.
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+WEBHOOK_PHASE = Histogram('tiramisu_webhook_phase_seconds', 'Time spent handling pushes, by phase', ['phase'], buckets = FAST_BUCKETS)
+PARSE = WEBHOOK_PHASE.labels('parse')
+# Looking up subscribers and storing the push, in the callback.
+ENQUEUE = WEBHOOK_PHASE.labels('enqueue')
+# Reading the subscriptions of the pushed repository, in the worker.
+SUBSCRIPTIONS = WEBHOOK_PHASE.labels('subscriptions')
+MATCH = WEBHOOK_PHASE.labels('match')
+NOTIFY = WEBHOOK_PHASE.labels('notify')
+
+WEBHOOKS = Counter('tiramisu_webhooks_total', 'GitHub push deliveries received, by outcome', ['result'])
+MATCHES = Counter('tiramisu_matches_total', 'Pushes matched against a chat\'s subscriptions')
+AUTH_POLLS = Counter('tiramisu_auth_polls_total', 'Device flow polls of GitHub, by outcome', ['result'])
+
+HTTP_CLIENT = Histogram('tiramisu_http_client_seconds', 'Outbound HTTP request latency until the response headers', ['target'])
+HTTP_CLIENT_ERRORS = Counter('tiramisu_http_client_errors_total', 'Outbound HTTP requests that failed without a response', ['target'])
+
+DB_POOL_WAIT = Histogram('tiramisu_db_pool_wait_seconds', 'Time to check a connection out of the pool', buckets = FAST_BUCKETS)
+
+PENDING_LOGINS = Gauge('tiramisu_pending_logins', 'Device flow logins waiting for the user')
+WEBHOOK_BACKLOG = Gauge('tiramisu_webhook_backlog', 'Push events stored but not processed yet')
+OUTBOX_BACKLOG = Gauge('tiramisu_outbox_backlog', 'Notifications in the outbox waiting for delivery')
+OUTBOX_DEAD = Gauge('tiramisu_outbox_dead', 'Notifications in the outbox that were dead-lettered')
+
+
+class TimedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, target: str, transport: httpx.AsyncBaseTransport):
+        self._latency = HTTP_CLIENT.labels(target)
+        self._errors = HTTP_CLIENT_ERRORS.labels(target)
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            self._errors.inc()
+            raise
+        self._latency.observe(time.perf_counter() - started)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def transport(target: str, limits: httpx.Limits = httpx.Limits()) -> TimedTransport:
+    return TimedTransport(target, httpx.AsyncHTTPTransport(limits = limits))
+
+
+# Components already count what they do for their stats() endpoints, this
+# exposes those numbers at scrape time instead of counting twice.
+class StatsCollector:
+    def __init__(self, prefix: str, stats: Callable[[], dict], counters: Dict[str, str], gauges: Dict[str, str]):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = counters
+        self.gauges = gauges
+
+    def collect(self):
+        stats = self.stats()
+        for name, doc in self.counters.items():
+            yield CounterMetricFamily(f'{self.prefix}_{name}', doc, value = stats[name])
+        for name, doc in self.gauges.items():
+            yield GaugeMetricFamily(f'{self.prefix}_{name}', doc, value = stats[name])
+
+def register_stats(prefix: str, stats: Callable[[], dict], counters: Dict[str, str] = {}, gauges: Dict[str, str] = {}):
+    REGISTRY.register(StatsCollector(prefix, stats, counters, gauges))
+
+
+def render() -> bytes:
+    return generate_latest()
+
+# For processes without an HTTP API, such as standalone workers.
+def serve(port: int):
+    start_http_server(port)
@@ -0,0 +1,193 @@
+from typing import List, NamedTuple
+
+import logging
+from sqlalchemy import text
+
+# Serializes upgrades when several replicas start at the same time.
+MIGRATION_LOCK_ID = 7413
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: List[str]
+
+
+# Append new migrations at the end; never edit one that has been released.
+# Version 1 matches the schema that Base.metadata.create_all() used to build,
+# so databases created before migrations existed upgrade in place.
+MIGRATIONS = [
+    Migration(1, 'baseline', [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id SERIAL NOT NULL,
+            telegram_id VARCHAR NOT NULL,
+            github_access_token VARCHAR,
+            notifications_enabled BOOLEAN NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (telegram_id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            owner VARCHAR NOT NULL,
+            repo VARCHAR NOT NULL,
+            pattern VARCHAR NOT NULL,
+            PRIMARY KEY (id, user_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS webhook_events (
+            id BIGSERIAL NOT NULL,
+            delivery_id VARCHAR NOT NULL,
+            owner VARCHAR NOT NULL,
+            repo VARCHAR NOT NULL,
+            pusher VARCHAR NOT NULL,
+            paths VARCHAR[] NOT NULL,
+            attempts INTEGER NOT NULL,
+            received_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+            available_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+            processed_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (id),
+            UNIQUE (delivery_id)
+        )''',
+        'CREATE INDEX IF NOT EXISTS ix_webhook_events_pending ON webhook_events (available_at) WHERE processed_at IS NULL',
+        '''CREATE TABLE IF NOT EXISTS pending_logins (
+            device_code VARCHAR NOT NULL,
+            telegram_id VARCHAR NOT NULL,
+            interval INTEGER NOT NULL,
+            expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            next_poll_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            leased_until TIMESTAMP WITHOUT TIME ZONE,
+            leased_by VARCHAR,
+            PRIMARY KEY (device_code)
+        )''',
+        'CREATE INDEX IF NOT EXISTS ix_pending_logins_telegram_id ON pending_logins (telegram_id)',
+        'CREATE INDEX IF NOT EXISTS ix_pending_logins_next_poll_at ON pending_logins (next_poll_at)',
+    ]),
+    Migration(2, 'subscription indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_subscriptions_owner_repo ON subscriptions (owner, repo)',
+        'CREATE INDEX IF NOT EXISTS ix_subscriptions_user_id ON subscriptions (user_id)',
+    ]),
+    Migration(3, 'per-user subscription id counter', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS last_subscription_id INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE users SET last_subscription_id = s.max_id
+            FROM (SELECT user_id, max(id) AS max_id FROM subscriptions GROUP BY user_id) AS s
+            WHERE users.id = s.user_id''',
+    ]),
+    Migration(4, 'shared webhook registry', [
+        '''CREATE TABLE webhooks (
+            owner VARCHAR NOT NULL,
+            repo VARCHAR NOT NULL,
+            hook_id BIGINT,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (owner, repo)
+        )''',
+        # Hook ids of existing repositories are unknown, they are adopted
+        # from GitHub on the next subscription.
+        '''INSERT INTO webhooks (owner, repo, ref_count)
+            SELECT owner, repo, count(*) FROM subscriptions GROUP BY owner, repo''',
+        'ALTER TABLE webhook_events ADD COLUMN push_key VARCHAR UNIQUE',
+    ]),
+    Migration(5, 'notification digest window', [
+        'ALTER TABLE users ADD COLUMN digest_window INTEGER NOT NULL DEFAULT 30',
+    ]),
+    Migration(6, 'subscription listing version', [
+        'ALTER TABLE users ADD COLUMN subscriptions_version INTEGER NOT NULL DEFAULT 0',
+    ]),
+    Migration(7, 'notification outbox', [
+        '''CREATE TABLE notification_outbox (
+            id BIGSERIAL NOT NULL,
+            idempotency_key VARCHAR NOT NULL,
+            chat_id VARCHAR NOT NULL,
+            message VARCHAR NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+            available_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+            sent_at TIMESTAMP WITHOUT TIME ZONE,
+            dead_at TIMESTAMP WITHOUT TIME ZONE,
+            last_error VARCHAR,
+            PRIMARY KEY (id),
+            UNIQUE (idempotency_key)
+        )''',
+        'CREATE INDEX ix_notification_outbox_pending ON notification_outbox (available_at) WHERE sent_at IS NULL AND dead_at IS NULL',
+        'CREATE INDEX ix_notification_outbox_dead ON notification_outbox (dead_at) WHERE dead_at IS NOT NULL',
+    ]),
+    Migration(8, 'webhook registry sync', [
+        'ALTER TABLE webhooks ADD COLUMN admin_user_id INTEGER',
+        'ALTER TABLE webhooks ADD COLUMN retry_at TIMESTAMP WITHOUT TIME ZONE',
+        'ALTER TABLE webhooks ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE webhooks ADD COLUMN last_error VARCHAR',
+        'CREATE INDEX ix_webhooks_retry_at ON webhooks (retry_at) WHERE retry_at IS NOT NULL',
+        # Unused rows left behind by earlier releases get their hooks deleted.
+        'UPDATE webhooks SET retry_at = now() WHERE ref_count <= 0',
+    ]),
+    Migration(9, 'persistent digests', [
+        '''CREATE TABLE digest_windows (
+            chat_id VARCHAR NOT NULL,
+            closes_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            pending BOOLEAN DEFAULT false NOT NULL,
+            PRIMARY KEY (chat_id)
+        )''',
+        'CREATE INDEX ix_digest_windows_closes_at ON digest_windows (closes_at)',
+        '''CREATE TABLE digest_entries (
+            id BIGSERIAL NOT NULL,
+            idempotency_key VARCHAR NOT NULL,
+            chat_id VARCHAR NOT NULL,
+            repo VARCHAR NOT NULL,
+            pusher VARCHAR NOT NULL,
+            patterns VARCHAR[] NOT NULL,
+            due_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (idempotency_key)
+        )''',
+        'CREATE INDEX ix_digest_entries_due_at ON digest_entries (due_at)',
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(conn) -> int:
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    return conn.execute(text('SELECT max(version) FROM schema_version')).scalar() or 0
+
+def installed_version(conn) -> int:
+    if conn.execute(text("SELECT to_regclass('schema_version')")).scalar() is None:
+        return 0
+    return conn.execute(text('SELECT max(version) FROM schema_version')).scalar() or 0
+
+# Most boots find the schema up to date: that takes one query and no lock, so
+# replicas restarting together do not queue up on the migration lock.
+def ensure(conn) -> int:
+    version = installed_version(conn)
+    conn.commit()
+
+    if version > SCHEMA_VERSION:
+        logging.warning(f'Database schema at version {version}, newer than this release ({SCHEMA_VERSION})')
+    if version >= SCHEMA_VERSION:
+        logging.info(f'Database schema at version {version}')
+        return version
+
+    upgrade(conn)
+    return SCHEMA_VERSION
+
+# Runs on a synchronous connection, see AsyncConnection.run_sync().
+def upgrade(conn):
+    conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+    try:
+        version = current_version(conn)
+        conn.commit()
+
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+
+            logging.info(f'Applying migration {migration.version} ({migration.name})')
+            for statement in migration.statements:
+                conn.execute(text(statement))
+            conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': migration.version})
+            conn.commit()
+    finally:
+        conn.rollback()
+        conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
+        conn.commit()
+
+    logging.info(f'Database schema at version {SCHEMA_VERSION}')
@@ -0,0 +1,347 @@
+from typing import Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+import collections
+from datetime import timedelta
+import httpx
+from sqlalchemy import select, update, delete, cast
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.sql.expression import func
+from sqlalchemy.types import String
+
+import db
+import metrics
+
+FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://frontend:5000')
+# Batches in flight at a time, each drained by its own task.
+NOTIFIER_CONCURRENCY = int(os.getenv('NOTIFIER_CONCURRENCY', '4'))
+NOTIFIER_TIMEOUT = float(os.getenv('NOTIFIER_TIMEOUT', '10'))
+# Each batch takes three statements, larger ones keep up better. The frontend
+# takes up to 1000 at a time.
+NOTIFIER_BATCH_SIZE = int(os.getenv('NOTIFIER_BATCH_SIZE', '500'))
+NOTIFIER_LEASE = int(os.getenv('NOTIFIER_LEASE', '60'))
+NOTIFIER_MAX_ATTEMPTS = int(os.getenv('NOTIFIER_MAX_ATTEMPTS', '10'))
+NOTIFIER_BASE_BACKOFF = float(os.getenv('NOTIFIER_BASE_BACKOFF', '1'))
+NOTIFIER_MAX_BACKOFF = float(os.getenv('NOTIFIER_MAX_BACKOFF', '300'))
+NOTIFIER_POLL_INTERVAL = float(os.getenv('NOTIFIER_POLL_INTERVAL', '1'))
+NOTIFIER_RETENTION = int(os.getenv('NOTIFIER_RETENTION', '86400'))
+NOTIFIER_PURGE_INTERVAL = 600
+NOTIFIER_SHUTDOWN_GRACE = 10
+LATENCY_WINDOW = 1000
+# Frontend rejections that a retry cannot fix.
+PERMANENT_REJECTIONS = ('empty_message', 'message_too_long')
+
+
+class Notification(NamedTuple):
+    key: str
+    chat_id: str
+    message: str
+
+
+# Adds the notifications to the outbox as part of the caller's transaction.
+# It is a single statement however many there are; keys already in the
+# outbox are skipped, so a push processed twice notifies once.
+async def enqueue(session, notifications: List[Notification]):
+    if not notifications:
+        return
+    keys, chat_ids, messages = zip(*notifications)
+    await session.execute(
+        insert(db.OutboxNotification).from_select(
+            ['idempotency_key', 'chat_id', 'message'],
+            select(
+                func.unnest(cast(list(keys), ARRAY(String))),
+                func.unnest(cast(list(chat_ids), ARRAY(String))),
+                func.unnest(cast(list(messages), ARRAY(String)))
+            )
+        ).on_conflict_do_nothing()
+    )
+
+
+# Notifications are delivered from the outbox table to the frontend in
+# batches, by concurrency tasks that each lease up to batch_size of them.
+# Failed notifications are retried with exponential backoff and dead-lettered
+# after max_attempts; a lease that runs out, because its process died, makes
+# them available again.
+class Notifier:
+    def __init__(self, base_url: str, concurrency: int, timeout: float,
+                 batch_size: int = NOTIFIER_BATCH_SIZE, max_attempts: int = NOTIFIER_MAX_ATTEMPTS):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._drainers: List[asyncio.Task] = []
+        self._storing: Set[asyncio.Task] = set()
+        self._stopping = False
+        self._in_flight = 0
+
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retried = 0
+        self.dead = 0
+        self.lost = 0
+        self.batches = 0
+        self._latencies: Deque[float] = collections.deque(maxlen=LATENCY_WINDOW)
+
+    async def start(self):
+        self._client = httpx.AsyncClient(
+            base_url = self.base_url,
+            headers = {
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            },
+            timeout = self.timeout,
+            transport = metrics.transport('frontend', httpx.Limits(
+                max_connections = self.concurrency,
+                max_keepalive_connections = self.concurrency
+            ))
+        )
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._drainers = [asyncio.create_task(self._drain(n)) for n in range(self.concurrency)]
+        logging.info(f'Notifier started, {self.concurrency} concurrent batches of up to {self.batch_size}')
+
+    def running(self) -> bool:
+        return bool(self._drainers) and not any(task.done() for task in self._drainers)
+
+    # Batches being sent are given a grace period to settle. Whatever is
+    # left stays in the outbox for the next start.
+    async def stop(self):
+        if self._client is None:
+            return
+        await asyncio.gather(*self._storing, return_exceptions = True)
+
+        self._stopping = True
+        self._wakeup.set()
+        _, pending = await asyncio.wait(self._drainers, timeout = NOTIFIER_SHUTDOWN_GRACE)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._drainers, return_exceptions = True)
+        await self._client.aclose()
+        self._drainers = []
+        self._client = None
+
+    def wakeup(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # For notifications produced outside a transaction: they are written to
+    # the outbox in the background. Without a key, the notification is not
+    # deduplicated against others.
+    def submit(self, chat_id: str, message: str, key: Optional[str] = None):
+        task = asyncio.create_task(self._store([Notification(key or uuid.uuid4().hex, chat_id, message)]))
+        self._storing.add(task)
+        task.add_done_callback(self._storing.discard)
+
+    async def _store(self, notifications: List[Notification]):
+        try:
+            async with db.session() as session:
+                await enqueue(session, notifications)
+                await session.commit()
+        except Exception:
+            self.lost += len(notifications)
+            logging.exception(f'Storing {len(notifications)} notifications failed')
+            return
+        self.wakeup()
+
+    async def _drain(self, n: int):
+        loop = asyncio.get_running_loop()
+        purged_at = loop.time()
+
+        while not self._stopping:
+            try:
+                rows = await self._claim()
+            except Exception:
+                logging.exception(f'Notifier {n}, claim failed')
+                rows = []
+
+            if not rows:
+                if n == 0 and loop.time() - purged_at > NOTIFIER_PURGE_INTERVAL:
+                    purged_at = loop.time()
+                    try:
+                        await self._purge()
+                    except Exception:
+                        logging.exception('Purging sent notifications failed')
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout = NOTIFIER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._in_flight += 1
+            try:
+                sent, failed = await self._deliver(rows)
+                await self._settle(sent, failed)
+            except Exception:
+                logging.exception(f'Notifier {n}, settling {len(rows)} notifications failed')
+            finally:
+                self._in_flight -= 1
+
+    async def _claim(self) -> list:
+        outbox = db.OutboxNotification
+        async with db.session() as session:
+            pending = select(outbox.id) \
+                .where(outbox.sent_at.is_(None), outbox.dead_at.is_(None), outbox.available_at <= func.now()) \
+                .order_by(outbox.available_at) \
+                .limit(self.batch_size) \
+                .with_for_update(skip_locked = True) \
+                .scalar_subquery()
+
+            rows = (await session.execute(
+                update(outbox)
+                .where(outbox.id.in_(pending))
+                .values(
+                    attempts = outbox.attempts + 1,
+                    available_at = func.now() + timedelta(seconds = NOTIFIER_LEASE)
+                )
+                .returning(
+                    outbox.id, outbox.idempotency_key, outbox.chat_id, outbox.message, outbox.attempts,
+                    func.extract('epoch', func.now() - outbox.created_at).label('age')
+                )
+                .execution_options(synchronize_session = False)
+            )).all()
+
+            await session.commit()
+            return rows
+
+    # Returns the ids accepted by the frontend and, by reason, the ids that
+    # were not.
+    async def _deliver(self, rows: list) -> Tuple[List[int], Dict[str, List[int]]]:
+        started = time.monotonic()
+        try:
+            resp = await self._client.post('/notifications/batch', json = [
+                {'chat_id': row.chat_id, 'message': row.message, 'key': row.idempotency_key}
+                for row in rows
+            ])
+            resp.raise_for_status()
+            results = resp.json()['result']
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            self.failed += len(rows)
+            logging.warning(f'Batch of {len(rows)} notifications failed: {e!r}')
+            return [], {repr(e): [row.id for row in rows]}
+
+        self.batches += 1
+        elapsed = time.monotonic() - started
+        sent = []
+        failed: Dict[str, List[int]] = {}
+        for row, result in zip(rows, results + [{}] * (len(rows) - len(results))):
+            if result.get('status') == 'accepted':
+                sent.append(row.id)
+                self._latencies.append(float(row.age) + elapsed)
+            else:
+                self.rejected += 1
+                failed.setdefault(result.get('reason', 'no_result'), []).append(row.id)
+        self.sent += len(sent)
+        return sent, failed
+
+    async def _settle(self, sent: List[int], failed: Dict[str, List[int]]):
+        outbox = db.OutboxNotification
+        # Equal jitter: at least half the backoff, so retries keep spreading out.
+        backoff = func.least(NOTIFIER_MAX_BACKOFF, NOTIFIER_BASE_BACKOFF * func.power(2, outbox.attempts - 1))
+        retry_at = func.now() + backoff * (0.5 + func.random() / 2) * timedelta(seconds = 1)
+
+        async with db.session() as session:
+            if sent:
+                await session.execute(
+                    update(outbox)
+                    .where(outbox.id.in_(sent))
+                    .values(sent_at = func.now())
+                    .execution_options(synchronize_session = False)
+                )
+
+            for reason, ids in failed.items():
+                error = reason[:200]
+                dead = outbox.id.in_(ids)
+                if reason not in PERMANENT_REJECTIONS:
+                    res = await session.execute(
+                        update(outbox)
+                        .where(outbox.id.in_(ids), outbox.attempts < self.max_attempts)
+                        .values(available_at = retry_at, last_error = error)
+                        .execution_options(synchronize_session = False)
+                    )
+                    self.retried += res.rowcount
+                    dead = dead & (outbox.attempts >= self.max_attempts)
+
+                res = await session.execute(
+                    update(outbox)
+                    .where(dead)
+                    .values(dead_at = func.now(), last_error = error)
+                    .execution_options(synchronize_session = False)
+                )
+                if res.rowcount:
+                    self.dead += res.rowcount
+                    logging.warning(f'Dead-lettered {res.rowcount} notifications: {error}')
+
+            await session.commit()
+
+    async def _purge(self):
+        async with db.session() as session:
+            res = await session.execute(
+                delete(db.OutboxNotification)
+                .where(db.OutboxNotification.sent_at < func.now() - timedelta(seconds = NOTIFIER_RETENTION))
+                .execution_options(synchronize_session = False)
+            )
+            await session.commit()
+        logging.info(f'Purged {res.rowcount} sent notifications')
+
+    # Counted in the database, so it covers every process draining the outbox.
+    async def backlog(self) -> dict:
+        outbox = db.OutboxNotification
+        async with db.session() as session:
+            pending = await session.scalar(
+                select(func.count()).select_from(outbox).where(outbox.sent_at.is_(None), outbox.dead_at.is_(None))
+            )
+            dead = await session.scalar(select(func.count()).select_from(outbox).where(outbox.dead_at.isnot(None)))
+        return {'pending': pending, 'dead': dead}
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            'batches_in_flight': self._in_flight,
+            'storing': len(self._storing),
+            'batches': self.batches,
+            'sent': self.sent,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'retried': self.retried,
+            'dead': self.dead,
+            'lost': self.lost,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else None
+        }
+
+
+sender = Notifier(FRONTEND_URL, NOTIFIER_CONCURRENCY, NOTIFIER_TIMEOUT)
+
+metrics.register_stats('tiramisu_notifications', sender.stats,
+    counters = {
+        'sent': 'Notifications accepted by the frontend',
+        'failed': 'Notifications in batches that failed to reach the frontend',
+        'rejected': 'Notifications rejected by the frontend',
+        'retried': 'Notifications scheduled for another attempt',
+        'dead': 'Notifications dead-lettered',
+        'lost': 'Notifications that could not be written to the outbox',
+        'batches': 'Notification batches delivered to the frontend'
+    },
+    gauges = {
+        'batches_in_flight': 'Notification batches being sent',
+        'storing': 'Notifications being written to the outbox'
+    }
+)
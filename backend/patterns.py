@@ -0,0 +1,98 @@
+from typing import Dict, Iterable, List, Set, Tuple
+
+import re
+import logging
+from fnmatch import translate
+from pathlib import PurePosixPath
+
+# Matches the path semantics of PurePath(fname).match(pattern) on a POSIX
+# host. Relative patterns are compared against the last k components of a
+# relative path, so every pattern with k components is compiled into one
+# regex over those components joined by '/'. Wildcards can never consume a
+# '/' there: the k-1 literal separators already use up every '/' in the key.
+
+_TRANSLATE_TAIL = re.compile(r'\\[Zz]$')
+
+
+def _split(path: str) -> Tuple[str, List[str]]:
+    if path.startswith('/'):
+        root = '//' if path.startswith('//') and not path.startswith('///') else '/'
+    else:
+        root = ''
+    return root, [x for x in path.split('/') if x and x != '.']
+
+def _part_regex(part: str) -> str:
+    return _TRANSLATE_TAIL.sub('', translate(part))
+
+
+class _Group:
+    def __init__(self, k: int, patterns: List[str], parts: List[List[str]]):
+        self.k = k
+        self.patterns = patterns
+
+        regexes = ['/'.join(_part_regex(p) for p in pat_parts) for pat_parts in parts]
+        self.any = re.compile('(?:' + '|'.join(f'(?:{r})' for r in regexes) + r')\Z')
+
+        # Regenerate the regexes: translate() may emit named groups, which
+        # must be unique within a single compiled expression.
+        regexes = ['/'.join(_part_regex(p) for p in pat_parts) for pat_parts in parts]
+        self.each = re.compile(''.join(f'(?:(?=(?:{r})\\Z(?P<_m{i}>)))?' for i, r in enumerate(regexes)))
+        self.marks = [self.each.groupindex[f'_m{i}'] - 1 for i in range(len(regexes))]
+
+
+class PatternIndex:
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = sorted(set(patterns))
+        self._anchored: List[str] = []
+
+        by_k: Dict[int, Tuple[List[str], List[List[str]]]] = {}
+        for pattern in self.patterns:
+            root, parts = _split(pattern)
+            if root:
+                self._anchored.append(pattern)
+            elif not parts:
+                logging.warning(f'Ignoring empty subscription pattern {pattern!r}')
+            else:
+                group = by_k.setdefault(len(parts), ([], []))
+                group[0].append(pattern)
+                group[1].append(parts)
+
+        self._groups = [_Group(k, *by_k[k]) for k in sorted(by_k)]
+
+    def match(self, files: Iterable[str]) -> Set[str]:
+        matched: Set[str] = set()
+        remaining = len(self.patterns)
+
+        for fname in files:
+            if remaining == 0:
+                break
+
+            root, parts = _split(fname)
+            if root:
+                # Absolute paths are rare enough to take the reference path.
+                path = PurePosixPath(fname)
+                for pattern in self.patterns:
+                    if pattern not in matched and _reference_match(path, pattern):
+                        matched.add(pattern)
+                remaining = len(self.patterns) - len(matched)
+                continue
+
+            for group in self._groups:
+                if group.k > len(parts):
+                    break
+                key = '/'.join(parts[-group.k:])
+                if not group.any.match(key):
+                    continue
+                hits = group.each.match(key).groups()
+                for pattern, mark in zip(group.patterns, group.marks):
+                    if hits[mark] is not None and pattern not in matched:
+                        matched.add(pattern)
+                        remaining -= 1
+
+        return matched
+
+def _reference_match(path: PurePosixPath, pattern: str) -> bool:
+    try:
+        return path.match(pattern)
+    except ValueError:
+        return False
@@ -0,0 +1,202 @@
+from typing import Deque, List, Optional
+
+import os
+import io
+import time
+import json
+import random
+import pstats
+import asyncio
+import cProfile
+import logging
+import collections
+import contextvars
+from sqlalchemy import event
+
+# Off unless PROFILING_RATE is set, and adjustable at runtime through the
+# /debug/profiling endpoint.
+PROFILING_RATE = float(os.getenv('PROFILING_RATE', '0'))
+PROFILING_CPROFILE = os.getenv('PROFILING_CPROFILE', 'false').lower() == 'true'
+PROFILING_DIR = os.getenv('PROFILING_DIR')
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN') or None
+PROFILING_KEEP = 50
+PROFILE_LINES = 40
+
+
+class Span:
+    __slots__ = ('name', 'started', 'duration', 'statements', 'children')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.statements = 0
+        self.children: List['Span'] = []
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'statements': _statements(self),
+            'children': [child.to_dict(origin) for child in self.children]
+        }
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar('profiling_span', default = None)
+
+
+class _NoSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_no_span = _NoSpan()
+
+
+class _Span:
+    def __init__(self, name: str, parent: Span):
+        self.span = Span(name)
+        parent.children.append(self.span)
+
+    def __enter__(self):
+        self._token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        self.span.duration = time.perf_counter() - self.span.started
+        _current.reset(self._token)
+
+
+# A child of the current span, or nothing at all outside a sampled trace.
+def span(name: str):
+    parent = _current.get()
+    if parent is None:
+        return _no_span
+    return _Span(name, parent)
+
+
+class Profiler:
+    def __init__(self):
+        self.rate = PROFILING_RATE
+        self.cprofile = PROFILING_CPROFILE
+        self.paths: List[str] = []
+        self.traces: Deque[dict] = collections.deque(maxlen = PROFILING_KEEP)
+        # cProfile can only run once per thread, so only one request at a
+        # time is profiled. It also sees other requests running on the loop.
+        self._profiling = False
+
+    def configure(self, rate: Optional[float] = None, cprofile: Optional[bool] = None, paths: Optional[List[str]] = None):
+        if rate is not None:
+            self.rate = min(max(rate, 0.0), 1.0)
+        if cprofile is not None:
+            self.cprofile = cprofile
+        if paths is not None:
+            self.paths = paths
+        logging.info(f'Profiling rate {self.rate}, cProfile {self.cprofile}, paths {self.paths or "all"}')
+
+    def settings(self) -> dict:
+        return {
+            'rate': self.rate,
+            'cprofile': self.cprofile,
+            'paths': self.paths,
+            'kept': len(self.traces)
+        }
+
+    def sampled(self, name: str) -> bool:
+        if self.rate <= 0 or self.rate < 1 and random.random() >= self.rate:
+            return False
+        return not self.paths or any(name.startswith(path) for path in self.paths)
+
+    # Runs `call` under a root span, and under cProfile if enabled and free.
+    async def trace(self, name: str, call, fields: dict):
+        root = Span(name)
+        token = _current.set(root)
+
+        profile = None
+        if self.cprofile and not self._profiling:
+            self._profiling = True
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            return await call()
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+            root.duration = time.perf_counter() - root.started
+            _current.reset(token)
+            self._record(root, profile, fields)
+
+    def _record(self, root: Span, profile: Optional[cProfile.Profile], fields: dict):
+        trace = {
+            'time': time.time(),
+            **fields,
+            **root.to_dict(root.started)
+        }
+        if profile is not None:
+            out = io.StringIO()
+            pstats.Stats(profile, stream = out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            trace['profile'] = out.getvalue()
+        self.traces.append(trace)
+
+        if PROFILING_DIR is not None:
+            asyncio.get_running_loop().run_in_executor(None, _dump, trace, profile)
+
+
+def _statements(span: Span) -> int:
+    return span.statements + sum(_statements(child) for child in span.children)
+
+def _dump(trace: dict, profile: Optional[cProfile.Profile]):
+    base = os.path.join(PROFILING_DIR, f'{trace["time"]:.6f}-{trace["name"].strip("/").replace("/", "_")}')
+    try:
+        with open(f'{base}.json', 'w') as f:
+            json.dump(trace, f, indent = 2)
+        if profile is not None:
+            profile.dump_stats(f'{base}.prof')
+    except OSError as e:
+        logging.warning(f'Writing profile {base} failed: {e}')
+
+
+profiler = Profiler()
+
+
+# Plain ASGI, when profiling is off a request costs one comparison.
+class Middleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or profiler.rate <= 0 or not profiler.sampled(scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        fields = {'method': scope['method'], 'status': None}
+
+        async def send_status(message):
+            if message['type'] == 'http.response.start':
+                fields['status'] = message['status']
+            await send(message)
+
+        await profiler.trace(scope['path'], lambda: self.app(scope, receive, send_status), fields)
+
+
+# Records each statement as a span under the one it ran in.
+def instrument(sync_engine):
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            context._profiling_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        current = _current.get()
+        started = getattr(context, '_profiling_started', None)
+        if current is not None and started is not None:
+            sql = Span('sql')
+            sql.started = started
+            sql.duration = time.perf_counter() - started
+            sql.statements = 1
+            current.children.append(sql)
@@ -0,0 +1,100 @@
+from typing import AsyncIterator, NamedTuple, Optional, Set
+
+import os
+import logging
+import ijson
+
+PUSH_MAX_PATHS = int(os.getenv('PUSH_MAX_PATHS', '10000'))
+
+CHANGE_LISTS = ('added', 'removed', 'modified')
+PATH_PREFIXES = {
+    f'{commit}.{change}.item'
+    for commit in ('commits.item', 'head_commit')
+    for change in CHANGE_LISTS
+}
+FIELDS = {
+    'repository.full_name': 'repo_full_name',
+    'pusher.name': 'pusher',
+    'ref': 'ref',
+    'before': 'before',
+    'after': 'after',
+}
+
+
+class Push(NamedTuple):
+    repo_full_name: str
+    pusher: str
+    ref: Optional[str]
+    before: Optional[str]
+    after: Optional[str]
+    paths: Set[str]
+    truncated: bool
+
+
+class PushError(ValueError): pass
+
+
+# Parses a push event as it is received, keeping only the fields we use and
+# the set of paths changed by any commit of the push. Large force pushes can
+# be several megabytes, most of which (diff stats, messages, authors) is never
+# looked at.
+async def parse(chunks: AsyncIterator[bytes], max_paths: int = PUSH_MAX_PATHS) -> Push:
+    fields = {}
+    paths = set()
+    truncated = False
+
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+
+    def consume():
+        nonlocal truncated
+        for prefix, event, value in events:
+            if event != 'string':
+                continue
+            if prefix in PATH_PREFIXES:
+                if len(paths) < max_paths:
+                    paths.add(value)
+                elif value not in paths:
+                    truncated = True
+            elif prefix in FIELDS:
+                fields[FIELDS[prefix]] = value
+        del events[:]
+
+    try:
+        async for chunk in chunks:
+            # An empty chunk would end the parser early.
+            if not chunk:
+                continue
+            parser.send(chunk)
+            consume()
+        parser.close()
+        consume()
+    except (ijson.JSONError, ValueError) as e:
+        raise PushError(f'Malformed payload, {e}')
+
+    for field in ('repo_full_name', 'pusher'):
+        if field not in fields:
+            raise PushError(f'Missing {field}')
+    if '/' not in fields['repo_full_name']:
+        raise PushError(f'Bad repository name {fields["repo_full_name"]}')
+
+    if truncated:
+        logging.warning(f'Push to {fields["repo_full_name"]} changed more than {max_paths} paths, ignoring the rest')
+
+    return Push(
+        repo_full_name = fields['repo_full_name'],
+        pusher = fields['pusher'],
+        ref = fields.get('ref'),
+        before = fields.get('before'),
+        after = fields.get('after'),
+        paths = paths,
+        truncated = truncated
+    )
+
+# Identifies a push as delivered by one hook, so that copies of it arriving
+# within the dedupe window are dropped. A later push of the same transition,
+# such as a force push back and forth, is a new push.
+def key(push: Push, hook_id: Optional[str]) -> Optional[str]:
+    if push.ref is None or push.after is None:
+        return None
+    return f'{hook_id or ""}:{push.repo_full_name}:{push.ref}:{push.before}..{push.after}'
@@ -0,0 +1,39 @@
+import os
+import sys
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+# The tests run against a real Postgres, named by the same DB_* variables as
+# the backend, and empty its tables. Point TEST_DB_NAME at a scratch database.
+TEST_DB_NAME = os.getenv('TEST_DB_NAME')
+if TEST_DB_NAME:
+    os.environ['DB_NAME'] = TEST_DB_NAME
+os.environ.setdefault('MATCH_PROCESSES', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import cache
+
+TABLES = ('digest_entries', 'digest_windows', 'notification_outbox', 'webhook_events', 'subscriptions', 'webhooks', 'users')
+
+
+@pytest.fixture
+def run():
+    if not TEST_DB_NAME:
+        pytest.skip('TEST_DB_NAME is not set')
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(db.init())
+    loop.run_until_complete(_truncate())
+    cache.clear()
+    yield loop.run_until_complete
+    loop.run_until_complete(db.close())
+    loop.close()
+
+async def _truncate():
+    async with db.session() as session:
+        await session.execute(text(f'TRUNCATE {", ".join(TABLES)} RESTART IDENTITY'))
+        await session.commit()
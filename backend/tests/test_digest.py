@@ -0,0 +1,53 @@
+from sqlalchemy import select, update, func
+
+import db
+import digest
+
+
+def match(key: str, pusher: str = 'alice', repo: str = 'owner/repo', window: int = 60) -> digest.Match:
+    return digest.Match(key, 'chat', window, repo, pusher, ['*.py'])
+
+async def add(matches, commit: bool = True) -> list:
+    async with db.session() as session:
+        notifications = await digest.coalescer.add(session, matches)
+        if commit:
+            await session.commit()
+    return notifications
+
+async def close_all() -> list:
+    async with db.session() as session:
+        await session.execute(update(db.DigestEntry).values(due_at = func.localtimestamp()))
+        await session.commit()
+    await digest.coalescer.close_due()
+    async with db.session() as session:
+        return (await session.execute(
+            select(db.OutboxNotification.idempotency_key, db.OutboxNotification.message)
+            .order_by(db.OutboxNotification.id)
+        )).all()
+
+
+def test_first_match_is_sent_and_the_rest_held(run):
+    assert [n.key for n in run(add([match('1'), match('2')]))] == ['1']
+    assert run(add([match('3', pusher = 'bob')])) == []
+
+    digests = run(close_all())
+    assert len(digests) == 1
+    assert digests[0].message == '2 pushes by 2 pushers on owner/repo matching *.py'
+
+def test_no_window_sends_everything(run):
+    assert len(run(add([match('1', window = 0), match('2', window = 0)]))) == 2
+
+def test_rolled_back_matches_are_not_counted(run):
+    run(add([match('1')]))
+    run(add([match('2')], commit = False))
+    run(add([match('2')]))
+
+    digests = run(close_all())
+    assert digests[0].message == 'New commit by alice on repo owner/repo matching pattern *.py'
+
+def test_repeated_match_is_held_once(run):
+    run(add([match('1')]))
+    run(add([match('2')]))
+    run(add([match('2')]))
+
+    assert run(close_all())[0].message.startswith('New commit by alice')
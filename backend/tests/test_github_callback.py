@@ -0,0 +1,35 @@
+import json
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+import main
+
+PUSH = {
+    'ref': 'refs/heads/main',
+    'before': 'a',
+    'after': 'b',
+    'repository': {'full_name': 'owner/repo'},
+    'pusher': {'name': 'pusher'},
+    'head_commit': {'added': ['a.py'], 'removed': [], 'modified': []}
+}
+
+
+async def callback(body: bytes) -> Response:
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    request = Request({'type': 'http', 'method': 'POST', 'path': '/github_callback', 'headers': []}, receive)
+    response = Response()
+    response.status_code = None
+    await main.github_callback(request, response)
+    return response
+
+
+def test_malformed_body_is_rejected(run):
+    assert run(callback(b'{"ref": ')).status_code == 400
+    assert run(callback(json.dumps({'ref': 'refs/heads/main'}).encode())).status_code == 400
+
+def test_ignored_push_is_accepted(run):
+    # Nobody subscribes to the repository: the default 202 stands.
+    assert run(callback(json.dumps(PUSH).encode())).status_code is None
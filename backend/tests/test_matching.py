@@ -0,0 +1,38 @@
+import asyncio
+
+import matching
+import patterns
+
+PATTERNS = ['src/**/*.py', 'docs/*', '**/test_*.py']
+
+
+def test_pool_starts_on_first_large_push(monkeypatch):
+    monkeypatch.setattr(matching, 'MATCH_INLINE_MAX_PATHS', 10)
+    index = patterns.PatternIndex(PATTERNS)
+    small = [f'src/{n}.py' for n in range(10)]
+    large = [f'src/{n}/test_{n}.py' for n in range(50)] + ['docs/a.md', 'other/b.py']
+
+    matching.start(2)
+    try:
+        assert asyncio.run(matching.match(index, small)) == index.match(small)
+        assert matching._pool is None
+
+        assert matching.chunk_size(len(large)) == 26
+        assert asyncio.run(matching.match(index, large)) == index.match(large)
+        assert matching._pool is not None
+    finally:
+        matching.stop()
+    assert matching._pool is None
+
+
+def test_no_pool_when_disabled(monkeypatch):
+    monkeypatch.setattr(matching, 'MATCH_INLINE_MAX_PATHS', 10)
+    index = patterns.PatternIndex(PATTERNS)
+    large = [f'src/{n}.py' for n in range(50)]
+
+    matching.start(0)
+    try:
+        assert asyncio.run(matching.match(index, large)) == index.match(large)
+        assert matching._pool is None
+    finally:
+        matching.stop()
@@ -0,0 +1,35 @@
+from pathlib import PurePosixPath
+
+import pytest
+
+import patterns
+
+PATTERNS = [
+    '*', '*.py', '**', '**/*.py', 'src/**', 'src/**/*.py', '**/test_*.py',
+    '?.py', 'src/?/x.py', '[ab].py', '[!a]*.py', 'src/[a-c]*/*.md', 'docs/*',
+    'a/b', 'b', 'src/a/b.py', '/src/*.py', '/*', 'a/*/c/*', '*/*/*/*',
+]
+
+PATHS = [
+    'a.py', 'b.py', 'c.py', '.py', 'a', 'b', 'a/b', 'x/a/b', 'src/a.py',
+    'src/a/b.py', 'src/a/x.py', 'src/b/c/d.py', 'src/bb/x.md', 'src/z/x.md',
+    'docs/index.md', 'docs/api/index.md', 'tests/test_push.py', 'a/b/c/d',
+    'x/a/y/c/z', '/src/a.py', '/a.py', 'src//a.py', './a.py', 'a/./b',
+]
+
+
+def reference(path: str, pattern: str) -> bool:
+    try:
+        return PurePosixPath(path).match(pattern)
+    except ValueError:
+        return False
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_index_matches_purepath(path):
+    expected = {pattern for pattern in PATTERNS if reference(path, pattern)}
+    assert patterns.PatternIndex(PATTERNS).match([path]) == expected
+
+def test_index_matches_across_paths():
+    expected = {pattern for pattern in PATTERNS if any(reference(path, pattern) for path in PATHS)}
+    assert patterns.PatternIndex(PATTERNS).match(PATHS) == expected
@@ -0,0 +1,14 @@
+import main
+import profiling
+
+
+def test_endpoints_are_off_without_a_token(monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILING_TOKEN', None)
+    assert not main.profiling_allowed(None)
+    assert not main.profiling_allowed('anything')
+
+def test_endpoints_need_the_token(monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILING_TOKEN', 'secret')
+    assert main.profiling_allowed('secret')
+    assert not main.profiling_allowed('wrong')
+    assert not main.profiling_allowed(None)
@@ -0,0 +1,115 @@
+import json
+import random
+import asyncio
+
+import pytest
+
+import push
+
+PAYLOAD = {
+    'ref': 'refs/heads/main',
+    'before': 'a' * 40,
+    'after': 'b' * 40,
+    'repository': {'full_name': 'octo/repo', 'name': 'repo'},
+    'pusher': {'name': 'octocat', 'email': 'octocat@example.com'},
+    'commits': [
+        {'id': '1', 'message': 'First', 'added': ['src/a.py'], 'removed': [], 'modified': ['README.md']},
+        {'id': '2', 'message': 'Second', 'added': ['docs/é.md'], 'removed': ['src/old.py'], 'modified': ['src/a.py']},
+    ],
+    'head_commit': {'id': '2', 'added': ['docs/é.md'], 'removed': ['src/old.py'], 'modified': ['src/a.py']},
+}
+PATHS = {'src/a.py', 'README.md', 'docs/é.md', 'src/old.py'}
+
+
+def parse(body: bytes, sizes = None, **kwargs) -> push.Push:
+    async def chunks():
+        n = 0
+        for size in sizes or [len(body)]:
+            yield body[n:n + size]
+            n += size
+        yield body[n:]
+    return asyncio.run(push.parse(chunks(), **kwargs))
+
+
+def test_parse():
+    result = parse(json.dumps(PAYLOAD).encode())
+    assert result == push.Push(
+        repo_full_name = 'octo/repo',
+        pusher = 'octocat',
+        ref = 'refs/heads/main',
+        before = 'a' * 40,
+        after = 'b' * 40,
+        paths = PATHS,
+        truncated = False
+    )
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_parse_split_at_any_byte(seed):
+    body = json.dumps(PAYLOAD, ensure_ascii = False).encode()
+    rng = random.Random(seed)
+    sizes = [rng.choice([0, 1, 2, 3, 7, 64]) for _ in range(len(body))]
+    assert parse(body, sizes) == parse(body)
+
+def test_parse_one_byte_chunks():
+    body = json.dumps(PAYLOAD, ensure_ascii = False).encode()
+    assert parse(body, [1] * len(body)).paths == PATHS
+
+
+def test_parse_unions_commits():
+    payload = dict(PAYLOAD, head_commit = None, commits = [
+        {'added': [f'dir/{n}.py'], 'removed': [], 'modified': ['shared.py']}
+        for n in range(20)
+    ])
+    result = parse(json.dumps(payload).encode())
+    assert result.paths == {f'dir/{n}.py' for n in range(20)} | {'shared.py'}
+
+def test_parse_null_head_commit():
+    payload = dict(PAYLOAD, commits = [], head_commit = None)
+    result = parse(json.dumps(payload).encode())
+    assert result.paths == set()
+    assert result.repo_full_name == 'octo/repo'
+    assert not result.truncated
+
+
+def test_parse_max_paths():
+    payload = dict(PAYLOAD, head_commit = None, commits = [
+        {'added': [f'{n}.py' for n in range(10)], 'removed': [], 'modified': ['0.py']}
+    ])
+    body = json.dumps(payload).encode()
+
+    result = parse(body, max_paths = 4)
+    assert result.paths == {'0.py', '1.py', '2.py', '3.py'}
+    assert result.truncated
+
+    result = parse(body, max_paths = 10)
+    assert len(result.paths) == 10
+    assert not result.truncated
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'{"ref": "refs/heads/main", ',
+    b'{"repository": {"full_name": "octo/repo"}, "pusher": {"name": "x"}} trailing',
+    b'{"commits": [}',
+    b'not json',
+])
+def test_parse_malformed(body):
+    with pytest.raises(push.PushError):
+        parse(body)
+
+@pytest.mark.parametrize('payload', [
+    {'pusher': {'name': 'octocat'}},
+    {'repository': {'full_name': 'octo/repo'}},
+    {'repository': {'full_name': 'repo'}, 'pusher': {'name': 'octocat'}},
+])
+def test_parse_missing_fields(payload):
+    with pytest.raises(push.PushError):
+        parse(json.dumps(payload).encode())
+
+
+def test_key():
+    result = parse(json.dumps(PAYLOAD).encode())
+    assert push.key(result, '42') == f'42:octo/repo:refs/heads/main:{"a" * 40}..{"b" * 40}'
+    assert push.key(result, None) != push.key(result, '42')
+    assert push.key(result._replace(after = None), '42') is None
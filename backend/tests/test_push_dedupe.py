@@ -0,0 +1,35 @@
+from sqlalchemy import update, func
+from datetime import timedelta
+
+import db
+import push
+import worker
+
+PUSH = push.Push('owner/repo', 'pusher', 'refs/heads/main', 'a', 'b', {'a.py'}, False)
+
+
+async def enqueue(delivery_id: str, push_key: str) -> bool:
+    return await worker.enqueue(delivery_id, push_key, 'owner', 'repo', 'pusher', ['a.py'])
+
+async def age_events(seconds: int):
+    async with db.session() as session:
+        await session.execute(update(db.WebhookEvent).values(received_at = func.now() - timedelta(seconds = seconds)))
+        await session.commit()
+
+
+def test_key_is_per_hook():
+    assert push.key(PUSH, '1') != push.key(PUSH, '2')
+    assert push.key(PUSH._replace(after = None), '1') is None
+
+def test_copies_within_the_window_are_dropped(run):
+    key = push.key(PUSH, '1')
+    assert run(enqueue('d1', key))
+    assert not run(enqueue('d2', key))
+    assert not run(enqueue('d1', push.key(PUSH, '2')))
+
+def test_repeated_push_after_the_window_is_queued(run):
+    key = push.key(PUSH, '1')
+    assert run(enqueue('d1', key))
+    run(age_events(worker.PUSH_DEDUPE_WINDOW + 1))
+    assert run(enqueue('d2', key))
+    assert not run(enqueue('d3', key))
@@ -0,0 +1,23 @@
+import db
+import cache
+
+
+async def subscribe(pattern: str):
+    async with db.session() as session:
+        user = db.User(telegram_id = 'chat', github_access_token = 'token', last_subscription_id = 1)
+        session.add(user)
+        await session.flush()
+        session.add(db.Subscription(id = 1, user_id = user.id, owner = 'owner', repo = 'repo', pattern = pattern))
+        await session.commit()
+
+
+def test_index_is_kept_with_its_entry(run):
+    run(subscribe('*.py'))
+    entry = run(cache.subscriptions.get('owner', 'repo'))
+    index = cache.subscriptions.index('owner', 'repo', entry)
+    assert cache.subscriptions.index('owner', 'repo', run(cache.subscriptions.get('owner', 'repo'))) is index
+
+    cache.subscriptions.invalidate_repo('owner', 'repo')
+    assert cache.subscriptions.stats()['indexes'] == 0
+    entry = run(cache.subscriptions.get('owner', 'repo'))
+    assert cache.subscriptions.index('owner', 'repo', entry) is not index
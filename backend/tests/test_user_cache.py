@@ -0,0 +1,31 @@
+from sqlalchemy import event
+
+import db
+import cache
+import main
+
+
+async def add_user(telegram_id: str):
+    async with db.session() as session:
+        session.add(db.User(telegram_id = telegram_id, github_access_token = 'token'))
+        await session.commit()
+
+
+def test_lookup_is_cached(run):
+    run(add_user('chat'))
+    user = run(main.get_authenticated_user('chat'))
+    assert cache.users.get('chat') == user
+
+def test_lookup_racing_an_invalidation_is_not_cached(run):
+    run(add_user('chat'))
+
+    # A logout on another request lands while the lookup's query runs.
+    def before_cursor_execute(*args):
+        cache.users.pop('chat')
+
+    event.listen(db.engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        assert run(main.get_authenticated_user('chat')) is not None
+    finally:
+        event.remove(db.engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    assert cache.users.get('chat') is None
@@ -0,0 +1,56 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+import db
+import worker
+
+PUSH_PATHS = ['src/main.py', 'docs/index.md']
+
+
+@contextmanager
+def count_statements():
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+
+# Users get every push right away, rather than in a digest.
+async def seed(repo: str, users: int):
+    async with db.session() as session:
+        for n in range(users):
+            user = db.User(telegram_id = f'{repo}-{n}', github_access_token = 'token', last_subscription_id = 1, digest_window = 0)
+            session.add(user)
+            await session.flush()
+            session.add(db.Subscription(id = 1, user_id = user.id, owner = 'owner', repo = repo, pattern = '*.py'))
+        await session.commit()
+
+# One delivery, from the callback storing it to its notifications being queued.
+async def deliver(repo: str) -> int:
+    await worker.enqueue(f'delivery-{repo}', None, 'owner', repo, 'pusher', PUSH_PATHS)
+    events = await worker.claim(worker.WEBHOOK_BATCH_SIZE)
+    notifications = []
+    for e in events:
+        notifications += await worker.process(e)
+    await worker.complete([e.id for e in events], notifications)
+    return len(notifications)
+
+def statements_per_webhook(run, repo: str, users: int) -> int:
+    run(seed(repo, users))
+    with count_statements() as statements:
+        assert run(deliver(repo)) == users
+    return len(statements)
+
+
+def test_statements_per_webhook(run):
+    # enqueue, claim, the joined subscriptions lookup, then the notifications
+    # and the processed mark in one transaction.
+    assert statements_per_webhook(run, 'repo', 1) <= 5
+
+def test_statements_do_not_grow_with_subscribers(run):
+    assert statements_per_webhook(run, 'few', 1) == statements_per_webhook(run, 'many', 50)
@@ -0,0 +1,246 @@
+from typing import List, Optional
+
+import os
+import asyncio
+import logging
+from datetime import timedelta
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import func
+
+import db
+import cache
+import digest
+import log
+import matching
+import metrics
+import notifier
+import profiling
+
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '2'))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', '50'))
+WEBHOOK_LEASE = int(os.getenv('WEBHOOK_LEASE', '60'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '5'))
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', '1'))
+WEBHOOK_RETENTION = int(os.getenv('WEBHOOK_RETENTION', '86400'))
+WEBHOOK_PURGE_INTERVAL = 600
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', '0'))
+WORKER_LOG_SAMPLE = float(os.getenv('WORKER_LOG_SAMPLE', '0.01'))
+PUSH_DEDUPE_WINDOW = int(os.getenv('PUSH_DEDUPE_WINDOW', '300'))
+
+
+# push_key only dedupes within PUSH_DEDUPE_WINDOW: an older event holding it
+# gives it up, so the same transition pushed again later is queued.
+async def enqueue(delivery_id: str, push_key: Optional[str], owner: str, repo: str, pusher: str, paths: List[str]) -> bool:
+    async with db.session() as session:
+        if push_key is not None:
+            await session.execute(
+                update(db.WebhookEvent)
+                .where(
+                    db.WebhookEvent.push_key == push_key,
+                    db.WebhookEvent.received_at < func.now() - timedelta(seconds = PUSH_DEDUPE_WINDOW)
+                )
+                .values(push_key = None)
+                .execution_options(synchronize_session = False)
+            )
+        res = await session.execute(
+            insert(db.WebhookEvent).values(
+                delivery_id = delivery_id,
+                push_key = push_key,
+                owner = owner,
+                repo = repo,
+                pusher = pusher,
+                paths = paths
+            ).on_conflict_do_nothing()
+        )
+        await session.commit()
+
+    if res.rowcount == 0:
+        logging.info(f'Duplicate delivery {delivery_id}, ignored')
+        return False
+
+    wakeup()
+    return True
+
+# Claimed events are leased rather than deleted: if a worker dies before
+# completing them they become available again when the lease runs out.
+async def claim(batch_size: int) -> list:
+    async with db.session() as session:
+        pending = select(db.WebhookEvent.id) \
+            .where(db.WebhookEvent.processed_at.is_(None), db.WebhookEvent.available_at <= func.now()) \
+            .order_by(db.WebhookEvent.available_at) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked = True) \
+            .scalar_subquery()
+
+        events = (await session.execute(
+            update(db.WebhookEvent)
+            .where(db.WebhookEvent.id.in_(pending))
+            .values(
+                attempts = db.WebhookEvent.attempts + 1,
+                available_at = func.now() + timedelta(seconds = WEBHOOK_LEASE)
+            )
+            .returning(*db.WebhookEvent.__table__.c)
+            .execution_options(synchronize_session = False)
+        )).all()
+
+        await session.commit()
+        return events
+
+# The notifications of a batch are stored in the same transaction that
+# marks its events processed: either both happen or the events are retried.
+async def complete(event_ids: List[int], matches: List[digest.Match]):
+    if not event_ids:
+        return
+    async with db.session() as session:
+        with metrics.NOTIFY.time():
+            notifications = await digest.coalescer.add(session, matches)
+        await notifier.enqueue(session, notifications)
+        await session.execute(
+            update(db.WebhookEvent)
+            .where(db.WebhookEvent.id.in_(event_ids))
+            .values(processed_at = func.now())
+            .execution_options(synchronize_session = False)
+        )
+        await session.commit()
+    if notifications:
+        notifier.sender.wakeup()
+
+async def purge():
+    async with db.session() as session:
+        res = await session.execute(
+            delete(db.WebhookEvent)
+            .where(db.WebhookEvent.processed_at < func.now() - timedelta(seconds = WEBHOOK_RETENTION))
+            .execution_options(synchronize_session = False)
+        )
+        await session.commit()
+    logging.info(f'Purged {res.rowcount} processed webhook events')
+
+
+# Returns the notifications to send now. Their key is the delivery and the
+# chat, so processing a delivery again does not notify twice.
+async def process(event) -> List[digest.Match]:
+    repo_full_name = f'{event.owner}/{event.repo}'
+
+    with metrics.SUBSCRIPTIONS.time(), profiling.span('subscriptions'):
+        subs = await cache.subscriptions.get(event.owner, event.repo)
+    if not subs:
+        return []
+
+    with metrics.MATCH.time(), profiling.span('match'):
+        index = cache.subscriptions.index(event.owner, event.repo, subs)
+        matched = await matching.match(index, event.paths)
+    if log.sampled('worker.match', WORKER_LOG_SAMPLE):
+        logging.info(f'Matched {len(matched)} of {len(subs)} subscriptions on {repo_full_name}')
+
+    # One notification per chat, listing every pattern of the chat that matched.
+    chats = {}
+    windows = {}
+    for sub in subs:
+        if sub.pattern in matched and sub.notifications_enabled:
+            chats.setdefault(sub.telegram_id, {})[sub.pattern] = None
+            windows[sub.telegram_id] = sub.digest_window
+
+    metrics.MATCHES.inc(len(chats))
+    return [
+        digest.Match(f'{event.delivery_id}:{telegram_id}', telegram_id, windows[telegram_id], repo_full_name, event.pusher, list(chat_patterns))
+        for telegram_id, chat_patterns in chats.items()
+    ]
+
+
+_wakeup: asyncio.Event = None
+_workers: List[asyncio.Task] = []
+
+def wakeup():
+    if _wakeup is not None:
+        _wakeup.set()
+
+async def _worker(n: int):
+    loop = asyncio.get_running_loop()
+    purged_at = loop.time()
+
+    while True:
+        try:
+            events = await claim(WEBHOOK_BATCH_SIZE)
+        except Exception:
+            logging.exception(f'Webhook worker {n}, claim failed')
+            events = []
+
+        if not events:
+            if n == 0 and loop.time() - purged_at > WEBHOOK_PURGE_INTERVAL:
+                purged_at = loop.time()
+                try:
+                    await purge()
+                except Exception:
+                    logging.exception('Purging webhook events failed')
+
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout = WEBHOOK_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        done = []
+        matches = []
+        for event in events:
+            if event.attempts > WEBHOOK_MAX_ATTEMPTS:
+                logging.warning(f'Giving up on delivery {event.delivery_id} after {WEBHOOK_MAX_ATTEMPTS} attempts')
+                done.append(event.id)
+                continue
+            with log.context(delivery_id = event.delivery_id):
+                try:
+                    if profiling.profiler.sampled('worker'):
+                        matches += await profiling.profiler.trace('worker', lambda: process(event), {'delivery_id': event.delivery_id})
+                    else:
+                        matches += await process(event)
+                    done.append(event.id)
+                except Exception:
+                    logging.exception(f'Webhook worker {n}, processing delivery {event.delivery_id} failed')
+
+        try:
+            await complete(done, matches)
+        except Exception:
+            logging.exception(f'Webhook worker {n}, completing {len(done)} deliveries failed')
+
+def start(count: int):
+    global _wakeup
+    _wakeup = asyncio.Event()
+    for n in range(count):
+        _workers.append(asyncio.create_task(_worker(n)))
+    logging.info(f'Started {count} webhook workers')
+
+def running() -> bool:
+    return bool(_workers) and not any(task.done() for task in _workers)
+
+async def stop():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions = True)
+    _workers.clear()
+
+
+# Standalone mode: `python worker.py` drains the queue without serving HTTP,
+# so processing can be scaled separately from the API replicas.
+async def main():
+    if WORKER_METRICS_PORT:
+        metrics.serve(WORKER_METRICS_PORT)
+    await db.init()
+    cache.start_listener()
+    await notifier.sender.start()
+    matching.start()
+    start(WEBHOOK_WORKERS)
+    digest.coalescer.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await digest.coalescer.stop()
+        await stop()
+        matching.stop()
+        await notifier.sender.stop()
+        await cache.stop_listener()
+        await db.close()
+
+if __name__ == '__main__':
+    log.setup()
+    asyncio.run(main())
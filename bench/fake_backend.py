@@ -0,0 +1,92 @@
+from typing import Dict, List, Optional
+
+import asyncio
+from fastapi import FastAPI, Header, Request, Response
+
+# Stands in for the backend behind the frontend's commands, keeping every
+# chat logged in and its subscriptions in memory. `delay` adds latency to
+# every call.
+
+app = FastAPI()
+
+delay = 0.0
+subscriptions: Dict[str, List[dict]] = {}
+next_ids: Dict[str, int] = {}
+calls = 0
+
+
+async def body(request: Request) -> dict:
+    global calls
+    calls += 1
+    if delay:
+        await asyncio.sleep(delay)
+    return await request.json()
+
+def add(chat_id: str, item: dict) -> dict:
+    next_ids[chat_id] = next_ids.get(chat_id, 0) + 1
+    subscription = {'id': next_ids[chat_id], 'owner': item['owner'], 'repo': item['repo'], 'pattern': item['pattern']}
+    subscriptions.setdefault(chat_id, []).append(subscription)
+    return subscription
+
+def remove(chat_id: str, sub_ids: List[int]) -> List[int]:
+    current = subscriptions.get(chat_id, [])
+    removed = [s['id'] for s in current if s['id'] in sub_ids]
+    subscriptions[chat_id] = [s for s in current if s['id'] not in sub_ids]
+    return removed
+
+@app.post('/user/connect')
+async def api_user_connect(request: Request):
+    await body(request)
+    return {'status': 'success', 'verification_uri': 'https://github.com/login/device', 'user_code': 'BENC-HMRK'}
+
+@app.post('/user/remove')
+async def api_user_remove(request: Request):
+    await body(request)
+    return {'status': 'success'}
+
+@app.get('/notifications/enable')
+@app.get('/notifications/disable')
+@app.post('/notifications/digest')
+async def api_notifications(request: Request):
+    await body(request)
+    return {'status': 'success'}
+
+@app.post('/subscription')
+async def api_subscription(request: Request):
+    req = await body(request)
+    add(str(req['tg_chat_id']), req)
+    return {'status': 'success'}
+
+@app.post('/subscription/bulk')
+async def api_subscription_bulk(request: Request):
+    req = await body(request)
+    return {
+        'status': 'success',
+        'result': [{'status': 'success', 'id': add(str(req['tg_chat_id']), item)['id']} for item in req['subscriptions']]
+    }
+
+@app.post('/subscription/list')
+async def api_subscription_list(request: Request, response: Response, if_none_match: Optional[str] = Header(None)):
+    req = await body(request)
+    chat_id = str(req['tg_chat_id'])
+    etag = f'"{chat_id}.{next_ids.get(chat_id, 0)}.{len(subscriptions.get(chat_id, []))}"'
+    if req.get('cursor') is None and if_none_match == etag:
+        return Response(status_code = 304, headers = {'ETag': etag})
+
+    response.headers['ETag'] = etag
+    return {'status': 'success', 'result': subscriptions.get(chat_id, []), 'next_cursor': None}
+
+@app.post('/subscription/delete')
+async def api_subscription_delete(request: Request):
+    req = await body(request)
+    removed = remove(str(req['tg_chat_id']), [req['sub_id']])
+    return {'status': 'success' if removed else 'not_found'}
+
+@app.post('/subscription/bulk/delete')
+async def api_subscription_bulk_delete(request: Request):
+    req = await body(request)
+    removed = remove(str(req['tg_chat_id']), req['sub_ids'])
+    return {
+        'status': 'success',
+        'result': [{'id': sub_id, 'status': 'success' if sub_id in removed else 'not_found'} for sub_id in req['sub_ids']]
+    }
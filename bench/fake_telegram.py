@@ -0,0 +1,159 @@
+from typing import Dict, List, Tuple
+
+import time
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Stands in for the Bot API: serves getUpdates from updates the harness
+# queues, and records sendMessage calls. Sends over the rate limits are
+# refused with a 429 and retry_after, the way Telegram does.
+
+NOTIFICATION_PREFIX = 'bench notification '
+MAX_UPDATES = 100
+
+app = FastAPI()
+
+
+class Bucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class State:
+    def __init__(self):
+        self.global_bucket = Bucket(30, 30)
+        self.chat_rate = 1.0
+        self.chat_burst = 3.0
+        self.retry_after = 1
+        self.chat_buckets: Dict[int, Bucket] = {}
+
+        self.updates: List[dict] = []
+        self.next_update_id = 1
+        self.new_updates: asyncio.Event = None
+
+        self.replies: Dict[int, asyncio.Queue] = {}
+        self.notifications: List[Tuple[float, int, str]] = []
+        self.sent = 0
+        self.limited = 0
+        self.get_updates = 0
+
+    def configure(self, global_rate: float, chat_rate: float, chat_burst: float, retry_after: int):
+        self.global_bucket = Bucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retry_after = retry_after
+
+    def reply_queue(self, chat_id: int) -> asyncio.Queue:
+        queue = self.replies.get(chat_id)
+        if queue is None:
+            queue = self.replies[chat_id] = asyncio.Queue()
+        return queue
+
+    def message(self, chat_id: int, text: str) -> dict:
+        self.next_update_id += 1
+        return {
+            'update_id': self.next_update_id,
+            'message': {
+                'message_id': self.next_update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'chat{chat_id}'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+            }
+        }
+
+    # For polling: the update is returned by the next getUpdates.
+    def push(self, update: dict):
+        if self.new_updates is None:
+            self.new_updates = asyncio.Event()
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def stats(self) -> dict:
+        return {
+            'sent': self.sent,
+            'rate_limited': self.limited,
+            'get_updates': self.get_updates,
+            'queued_updates': len(self.updates)
+        }
+
+
+state = State()
+
+
+def ok(result):
+    return {'ok': True, 'result': result}
+
+def error(code: int, description: str, parameters: dict = None):
+    body = {'ok': False, 'error_code': code, 'description': description}
+    if parameters:
+        body['parameters'] = parameters
+    return JSONResponse(body, status_code = code)
+
+async def get_updates(params: dict):
+    state.get_updates += 1
+    if state.new_updates is None:
+        state.new_updates = asyncio.Event()
+
+    offset = int(params.get('offset') or 0)
+    state.updates = [update for update in state.updates if update['update_id'] >= offset]
+    if not state.updates:
+        state.new_updates.clear()
+        try:
+            await asyncio.wait_for(state.new_updates.wait(), timeout = float(params.get('timeout') or 0))
+        except asyncio.TimeoutError:
+            pass
+    return ok(state.updates[:int(params.get('limit') or MAX_UPDATES)])
+
+def send_message(params: dict):
+    chat_id = int(params['chat_id'])
+    bucket = state.chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = state.chat_buckets[chat_id] = Bucket(state.chat_rate, state.chat_burst)
+
+    if not bucket.take() or not state.global_bucket.take():
+        state.limited += 1
+        return error(429, f'Too Many Requests: retry after {state.retry_after}', {'retry_after': state.retry_after})
+
+    state.sent += 1
+    text = params.get('text', '')
+    now = time.perf_counter()
+    if text.startswith(NOTIFICATION_PREFIX):
+        state.notifications.append((now, chat_id, text))
+    else:
+        state.reply_queue(chat_id).put_nowait((now, text))
+    return ok({
+        'message_id': state.sent,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'text': text
+    })
+
+@app.post('/bot{token}/{method}')
+async def api_method(token: str, method: str, request: Request):
+    body = await request.body()
+    params = await request.json() if body else {}
+
+    if method == 'getUpdates':
+        return await get_updates(params)
+    if method == 'sendMessage':
+        return send_message(params)
+    if method == 'getMe':
+        return ok({'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'})
+    if method in ('setWebhook', 'deleteWebhook'):
+        return ok(True)
+    return error(400, f'Bad Request: {method} is not faked')
@@ -0,0 +1,302 @@
+from typing import Dict, List, Optional
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import subprocess
+import httpx
+import uvicorn
+
+import fake_backend
+import fake_telegram
+from webhook import ROOT, percentiles, git_commit
+
+FRONTEND_DIR = os.path.join(ROOT, 'frontend')
+FRONTEND_STARTUP_TIMEOUT = 60
+DRAIN_TIMEOUT = 300
+WEBHOOK_SECRET = 'bench'
+
+
+def rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Soak:
+    def __init__(self, args, client: httpx.AsyncClient):
+        self.args = args
+        self.client = client
+        self.rng = random.Random(args.seed)
+
+        self.latencies: Dict[str, List[float]] = {}
+        self.lost: Dict[str, int] = {}
+        self.flows = 0
+        self.failed_flows = 0
+
+        self.notifications_sent: Dict[int, float] = {}
+        self.notifications_rejected = 0
+        self.samples: List[dict] = []
+
+    async def send(self, chat_id: int, text: str):
+        update = fake_telegram.state.message(chat_id, text)
+        if self.args.mode == 'webhook':
+            await self.client.post('/telegram/updates', json = update, headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET})
+        else:
+            fake_telegram.state.push(update)
+
+    # Sends one message and waits for the replies it should get. The latency
+    # is until the first reply.
+    async def step(self, chat_id: int, label: str, text: str, replies: int = 1) -> Optional[List[str]]:
+        queue = fake_telegram.state.reply_queue(chat_id)
+        while not queue.empty():
+            queue.get_nowait()
+
+        sent_at = time.perf_counter()
+        await self.send(chat_id, text)
+        texts = []
+        try:
+            for _ in range(replies):
+                received_at, reply = await asyncio.wait_for(queue.get(), timeout = self.args.reply_timeout)
+                if not texts:
+                    self.latencies.setdefault(label, []).append(received_at - sent_at)
+                texts.append(reply)
+        except asyncio.TimeoutError:
+            self.lost[label] = self.lost.get(label, 0) + 1
+            return None
+        await asyncio.sleep(self.args.think)
+        return texts
+
+    # /start, /login, the /subscribe conversation, /subscriptions and the
+    # /unsubscribe conversation, as a user would go through them.
+    async def flow(self, chat_id: int) -> bool:
+        steps = [
+            ('start', '/start', 1),
+            ('login', '/login', 1),
+            ('subscribe', '/subscribe', 1),
+            ('owner', 'octo', 1),
+            ('repo', f'repo{chat_id % 100}', 1),
+            ('pattern', '*.py', 1),
+            ('subscriptions', '/subscriptions', 1),
+            ('unsubscribe', '/unsubscribe', 2)
+        ]
+        replies = None
+        for label, text, count in steps:
+            replies = await self.step(chat_id, label, text, count)
+            if replies is None:
+                return False
+
+        listing = replies[0].strip().split('\n')
+        sub_id = listing[-1].split(':')[0] if len(listing) > 1 else '0'
+        return await self.step(chat_id, 'sub_id', sub_id) is not None
+
+    async def run_chats(self, chats, deadline: float):
+        while time.monotonic() < deadline:
+            chat_id = next(chats)
+            self.flows += 1
+            if not await self.flow(chat_id):
+                self.failed_flows += 1
+                # Leave any half finished conversation before the chat is reused.
+                await self.send(chat_id, '/cancel')
+
+    async def bursts(self, deadline: float):
+        counter = itertools.count()
+        while time.monotonic() < deadline:
+            batch = []
+            for _ in range(self.args.burst_size):
+                n = next(counter)
+                chat_id = self.args.chat_base + self.rng.randrange(self.args.chats)
+                batch.append({'chat_id': str(chat_id), 'message': f'{fake_telegram.NOTIFICATION_PREFIX}{n}'})
+                self.notifications_sent[n] = time.perf_counter()
+
+            res = (await self.client.post('/notifications/batch', json = batch)).json()
+            for notification, result in zip(batch, res['result']):
+                if result['status'] != 'accepted':
+                    self.notifications_rejected += 1
+                    del self.notifications_sent[int(notification['message'][len(fake_telegram.NOTIFICATION_PREFIX):])]
+            await asyncio.sleep(self.args.burst_interval)
+
+    async def sample(self, pid: int, started: float, deadline: float):
+        while True:
+            stats = (await self.client.get('/dispatcher/stats')).json()['result']
+            self.samples.append({'t_s': round(time.monotonic() - started, 1), 'rss_kb': rss_kb(pid), **stats})
+            if time.monotonic() >= deadline:
+                return
+            await asyncio.sleep(self.args.sample_interval)
+
+    async def drain(self) -> dict:
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline:
+            stats = (await self.client.get('/sender/stats')).json()['result']
+            if stats['queued'] == 0:
+                return stats
+            await asyncio.sleep(0.5)
+        return stats
+
+
+async def wait_frontend(client: httpx.AsyncClient, frontend: subprocess.Popen, mode: str):
+    deadline = time.monotonic() + FRONTEND_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if frontend.poll() is not None:
+            raise RuntimeError(f'Frontend exited with code {frontend.returncode}')
+        try:
+            if (await client.get('/sender/stats')).status_code == 200 and (mode == 'webhook' or fake_telegram.state.get_updates):
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError('Frontend did not start')
+
+async def run(args) -> dict:
+    if not os.path.exists(os.path.join(FRONTEND_DIR, 'telegram_apikey.py')):
+        raise RuntimeError('frontend/telegram_apikey.py is missing, copy it from telegram_apikey.py.template')
+
+    fake_backend.delay = args.backend_delay / 1000
+    fake_telegram.state.configure(args.telegram_rate, args.chat_rate, args.chat_burst, args.retry_after)
+
+    servers = [
+        uvicorn.Server(uvicorn.Config(fake_telegram.app, host = '127.0.0.1', port = args.telegram_port, log_level = 'warning')),
+        uvicorn.Server(uvicorn.Config(fake_backend.app, host = '127.0.0.1', port = args.backend_port, log_level = 'warning'))
+    ]
+    server_tasks = [asyncio.create_task(server.serve()) for server in servers]
+
+    env = dict(
+        os.environ,
+        BACKEND_URL = f'http://127.0.0.1:{args.backend_port}',
+        TELEGRAM_API_URL = f'http://127.0.0.1:{args.telegram_port}/bot',
+        UPDATES_MODE = args.mode,
+        TELEGRAM_WEBHOOK_URL = f'http://127.0.0.1:{args.frontend_port}',
+        TELEGRAM_WEBHOOK_SECRET = WEBHOOK_SECRET
+    )
+    log = open(args.frontend_log, 'w') if args.frontend_log else subprocess.DEVNULL
+    frontend = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(args.frontend_port)],
+        cwd = FRONTEND_DIR, env = env, stdout = log, stderr = subprocess.STDOUT
+    )
+
+    try:
+        async with httpx.AsyncClient(
+            base_url = f'http://127.0.0.1:{args.frontend_port}',
+            timeout = 60,
+            limits = httpx.Limits(max_connections = args.concurrency + 4)
+        ) as client:
+            await wait_frontend(client, frontend, args.mode)
+
+            soak = Soak(args, client)
+            started = time.monotonic()
+            deadline = started + args.duration
+            chats = itertools.cycle(range(args.chat_base, args.chat_base + args.chats))
+            await asyncio.gather(
+                *(soak.run_chats(chats, deadline) for _ in range(args.concurrency)),
+                soak.bursts(deadline) if args.burst_size else asyncio.sleep(0),
+                soak.sample(frontend.pid, started, deadline)
+            )
+            soak_time = time.monotonic() - started
+            sender_stats = await soak.drain()
+            await soak.sample(frontend.pid, started, time.monotonic())
+    finally:
+        frontend.terminate()
+        # The frontend's shutdown waits on a getUpdates served by this loop.
+        await asyncio.get_running_loop().run_in_executor(None, frontend.wait)
+        for server in servers:
+            server.should_exit = True
+        await asyncio.gather(*server_tasks)
+
+    delivered: Dict[int, float] = {}
+    for received_at, _, text in fake_telegram.state.notifications:
+        delivered.setdefault(int(text[len(fake_telegram.NOTIFICATION_PREFIX):]), received_at)
+    notification_latency = [delivered[n] - sent_at for n, sent_at in soak.notifications_sent.items() if n in delivered]
+
+    first, last = soak.samples[0], soak.samples[-1]
+    return {
+        'commit': git_commit(),
+        'config': {
+            'mode': args.mode,
+            'chats': args.chats,
+            'concurrency': args.concurrency,
+            'duration_s': args.duration,
+            'think_s': args.think,
+            'burst_size': args.burst_size,
+            'burst_interval_s': args.burst_interval,
+            'backend_delay_ms': args.backend_delay,
+            'telegram_rate': args.telegram_rate,
+            'chat_rate': args.chat_rate,
+            'seed': args.seed
+        },
+        'commands': {
+            'flows': soak.flows,
+            'failed_flows': soak.failed_flows,
+            'flows_per_s': round(soak.flows / soak_time, 2),
+            'round_trip': {label: percentiles(values) for label, values in soak.latencies.items()},
+            'lost_replies': soak.lost
+        },
+        'notifications': {
+            'accepted': len(soak.notifications_sent),
+            'rejected': soak.notifications_rejected,
+            'delivered': sum(1 for n in soak.notifications_sent if n in delivered),
+            'dropped': sum(1 for n in soak.notifications_sent if n not in delivered),
+            'latency': percentiles(notification_latency)
+        },
+        'telegram': fake_telegram.state.stats(),
+        'sender': sender_stats,
+        'dispatcher': {
+            'backlog_max': max(sample['backlog'] for sample in soak.samples),
+            'conversations_end': last['conversations']
+        },
+        'memory': {
+            'rss_kb_start': first['rss_kb'],
+            'rss_kb_end': last['rss_kb'],
+            'rss_kb_max': max((sample['rss_kb'] or 0) for sample in soak.samples),
+            'users_start': first['users'],
+            'users_end': last['users'],
+            'user_data_keys_start': first['user_data_keys'],
+            'user_data_keys_end': last['user_data_keys']
+        },
+        'samples': soak.samples if args.samples else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Drive simulated Telegram chats and notification bursts through the frontend against a fake Bot API and backend, and report latency, backlog, drops and memory as JSON.')
+    parser.add_argument('--mode', choices = ['polling', 'webhook'], default = 'polling', help = 'how the frontend receives updates')
+    parser.add_argument('--chats', type = int, default = 2000)
+    parser.add_argument('--chat-base', type = int, default = 100000, help = 'first simulated chat id')
+    parser.add_argument('--concurrency', type = int, default = 100, help = 'chats going through commands at once')
+    parser.add_argument('--duration', type = float, default = 60, help = 'seconds to soak for')
+    parser.add_argument('--think', type = float, default = 1, help = 'seconds a chat waits after each reply')
+    parser.add_argument('--reply-timeout', type = float, default = 30)
+    parser.add_argument('--burst-size', type = int, default = 500, help = 'notifications per burst, 0 for none')
+    parser.add_argument('--burst-interval', type = float, default = 10)
+    parser.add_argument('--backend-delay', type = float, default = 5, help = 'milliseconds added to every backend call')
+    parser.add_argument('--telegram-rate', type = float, default = 30, help = 'messages per second the fake Bot API accepts')
+    parser.add_argument('--chat-rate', type = float, default = 1, help = 'messages per second per chat')
+    parser.add_argument('--chat-burst', type = float, default = 3)
+    parser.add_argument('--retry-after', type = int, default = 1, help = 'retry_after of the 429 responses')
+    parser.add_argument('--sample-interval', type = float, default = 5)
+    parser.add_argument('--samples', action = 'store_true', help = 'include every dispatcher and memory sample in the report')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--frontend-port', type = int, default = 5200)
+    parser.add_argument('--backend-port', type = int, default = 8200)
+    parser.add_argument('--telegram-port', type = int, default = 8300)
+    parser.add_argument('--frontend-log', help = 'write the frontend output to this file')
+    parser.add_argument('--output', help = 'write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent = 2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+from typing import List, Tuple
+
+import time
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+# Stands in for the frontend: accepts notifications the way frontend/main.py
+# does and records when each one arrived instead of sending it to Telegram.
+
+class Notification(BaseModel):
+    message: str
+    chat_id: str
+
+app = FastAPI()
+
+received: List[Tuple[float, str, str]] = []
+
+@app.post('/notification')
+async def api_notification(notification: Notification):
+    received.append((time.perf_counter(), notification.chat_id, notification.message))
+    return {'status': 'success'}
+
+@app.post('/notifications/batch')
+async def api_notifications_batch(notifications: List[Notification]):
+    now = time.perf_counter()
+    for notification in notifications:
+        received.append((now, notification.chat_id, notification.message))
+    return {
+        'status': 'success',
+        'result': [{'status': 'accepted'}] * len(notifications)
+    }
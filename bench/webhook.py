@@ -0,0 +1,373 @@
+from typing import Dict, List, Optional
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import subprocess
+import asyncpg
+import httpx
+import uvicorn
+
+import sink
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+BACKEND_STARTUP_TIMEOUT = 60
+DRAIN_TIMEOUT = 300
+MATCH_ROUNDS = 3
+
+# Roughly the mix of patterns users subscribe with.
+PATTERNS = [
+    '*.py', '*.md', '*.yml', 'README*', 'Dockerfile', 'docs/*', 'docs/*/*.md',
+    'src/*', 'src/*/*.py', 'src/core/*', 'src/api/*.py', 'tests/*/*.py',
+    '.github/workflows/*', 'frontend/*.js', 'backend/*.py', 'migrations/*.sql',
+]
+DIRS = ['src/core', 'src/api', 'src/util', 'docs', 'docs/guide', 'tests/unit', 'tests/e2e',
+        'frontend', 'backend', 'migrations', '.github/workflows', '']
+EXTENSIONS = ['py', 'md', 'yml', 'js', 'sql', 'txt', 'json']
+PUSHER = re.compile(r'by (bench-\d+)')
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+
+    def at(p: float) -> Optional[float]:
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 3)
+
+    return {
+        'count': len(values),
+        'p50_ms': at(0.5),
+        'p95_ms': at(0.95),
+        'p99_ms': at(0.99),
+        'max_ms': round(values[-1] * 1000, 3) if values else None
+    }
+
+def random_path(rng: random.Random) -> str:
+    directory = rng.choice(DIRS)
+    name = f'file{rng.randrange(1000)}.{rng.choice(EXTENSIONS)}'
+    return f'{directory}/{name}' if directory else name
+
+def push_payload(rng: random.Random, n: int, repo: str, commits: int, paths: int) -> dict:
+    changes = [
+        {
+            'id': uuid.uuid4().hex,
+            'message': 'bench commit',
+            'added': [random_path(rng) for _ in range(paths // 3)],
+            'removed': [],
+            'modified': [random_path(rng) for _ in range(paths - paths // 3)]
+        }
+        for _ in range(commits)
+    ]
+    return {
+        'ref': 'refs/heads/main',
+        'before': uuid.uuid4().hex,
+        'after': uuid.uuid4().hex,
+        'repository': {'full_name': f'bench/{repo}', 'name': repo},
+        'pusher': {'name': f'bench-{n}'},
+        'commits': changes,
+        'head_commit': changes[-1]
+    }
+
+
+async def seed(conn, rng: random.Random, users: int, subscriptions: int, repos: int):
+    await conn.execute('TRUNCATE users, subscriptions, webhooks, webhook_events, pending_logins, notification_outbox, digest_windows, digest_entries')
+
+    await conn.copy_records_to_table(
+        'users',
+        columns = ['id', 'telegram_id', 'github_access_token', 'notifications_enabled', 'last_subscription_id', 'digest_window'],
+        records = [(u + 1, f'bench{u}', 'bench', True, subscriptions, 0) for u in range(users)]
+    )
+    await conn.execute("SELECT setval('users_id_seq', $1)", users)
+    await conn.copy_records_to_table(
+        'subscriptions',
+        columns = ['id', 'user_id', 'owner', 'repo', 'pattern'],
+        records = [
+            (s + 1, u + 1, 'bench', f'repo{rng.randrange(repos)}', rng.choice(PATTERNS))
+            for u in range(users)
+            for s in range(subscriptions)
+        ]
+    )
+    await conn.execute('ANALYZE')
+
+async def db_counters(conn) -> dict:
+    await conn.execute('SELECT pg_stat_clear_snapshot()')
+    counters = dict(await conn.fetchrow(
+        'SELECT xact_commit + xact_rollback AS transactions, tup_returned + tup_fetched AS rows_read, '
+        'tup_inserted + tup_updated + tup_deleted AS rows_written '
+        'FROM pg_stat_database WHERE datname = current_database()'
+    ))
+    # Only available when the extension is installed on the server.
+    try:
+        counters['statements'] = await conn.fetchval('SELECT sum(calls)::bigint FROM pg_stat_statements WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())')
+    except asyncpg.PostgresError:
+        counters['statements'] = None
+    return counters
+
+def delta(before: dict, after: dict) -> dict:
+    return {
+        key: after[key] - before[key] if after[key] is not None and before[key] is not None else None
+        for key in after
+    }
+
+
+async def wait_backend(client: httpx.AsyncClient, backend: subprocess.Popen):
+    deadline = time.monotonic() + BACKEND_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if backend.poll() is not None:
+            raise RuntimeError(f'Backend exited with code {backend.returncode}')
+        try:
+            if (await client.get('/cache/stats')).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError('Backend did not start')
+
+async def wait_drained(conn, client: httpx.AsyncClient):
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while time.monotonic() < deadline:
+        pending = await conn.fetchval('SELECT count(*) FROM webhook_events WHERE processed_at IS NULL')
+        stats = (await client.get('/notifier/stats')).json()['result']
+        if pending == 0 and stats['outbox']['pending'] == 0 and stats['storing'] == 0:
+            return
+        await asyncio.sleep(0.1)
+    raise RuntimeError('Backend did not drain the webhook queue')
+
+
+async def replay(client: httpx.AsyncClient, payloads: List[bytes], concurrency: int) -> tuple:
+    sent_at: Dict[str, float] = {}
+    latencies: List[float] = []
+    errors = 0
+    slots = asyncio.Semaphore(concurrency)
+
+    async def post(n: int, body: bytes):
+        nonlocal errors
+        async with slots:
+            started = time.perf_counter()
+            sent_at[f'bench-{n}'] = started
+            try:
+                resp = await client.post('/github_callback', content = body, headers = {
+                    'Content-Type': 'application/json',
+                    'X-GitHub-Event': 'push',
+                    'X-GitHub-Delivery': str(uuid.uuid4())
+                })
+                resp.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(post(n, body) for n, body in enumerate(payloads)))
+    return sent_at, latencies, errors, time.perf_counter() - started
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = ROOT, text = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Matching a monorepo-sized push inline and in the process pool. Patterns
+# naming single files rarely match, so neither side stops early.
+async def match_benchmark(args) -> Optional[dict]:
+    if args.match_paths <= 0:
+        return None
+
+    sys.path.insert(0, BACKEND_DIR)
+    import matching
+    import patterns
+
+    rng = random.Random(args.seed)
+    paths = [random_path(rng) for _ in range(args.match_paths)]
+    subscribed = PATTERNS + [random_path(rng).replace('file', 'other') for _ in range(max(0, args.match_patterns - len(PATTERNS)))]
+    index = patterns.PatternIndex(subscribed)
+
+    def best(times: List[float]) -> float:
+        return round(min(times) * 1000, 3)
+
+    inline = []
+    for _ in range(MATCH_ROUNDS):
+        started = time.perf_counter()
+        expected = index.match(paths)
+        inline.append(time.perf_counter() - started)
+
+    matching.start(args.match_processes)
+    try:
+        # The first round also starts the processes and compiles the index there.
+        pooled = []
+        for _ in range(MATCH_ROUNDS + 1):
+            started = time.perf_counter()
+            result = await matching.match(index, paths)
+            pooled.append(time.perf_counter() - started)
+        chunk_size = matching.chunk_size(len(paths))
+    finally:
+        matching.stop()
+    if result != expected:
+        raise RuntimeError('Pooled matching disagrees with inline matching')
+
+    return {
+        'paths': len(paths),
+        'patterns': len(index.patterns),
+        'processes': args.match_processes,
+        'chunk_size': chunk_size,
+        'inline_ms': best(inline),
+        'pool_ms': best(pooled[1:]),
+        'speedup': round(min(inline) / min(pooled[1:]), 2)
+    }
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    dsn = f'postgresql://{args.db_user}:{args.db_password}@{args.db_host}:{args.db_port}/{args.db_name}'
+
+    server = uvicorn.Server(uvicorn.Config(sink.app, host = '127.0.0.1', port = args.sink_port, log_level = 'warning'))
+    sink_task = asyncio.create_task(server.serve())
+
+    env = dict(
+        os.environ,
+        DB_HOST = args.db_host,
+        DB_PORT = str(args.db_port),
+        DB_USER = args.db_user,
+        DB_PASSWORD = args.db_password,
+        DB_NAME = args.db_name,
+        FRONTEND_URL = f'http://127.0.0.1:{args.sink_port}'
+    )
+    log = open(args.backend_log, 'w') if args.backend_log else subprocess.DEVNULL
+    backend = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(args.backend_port)],
+        cwd = BACKEND_DIR, env = env, stdout = log, stderr = subprocess.STDOUT
+    )
+
+    conn = None
+    try:
+        async with httpx.AsyncClient(
+            base_url = f'http://127.0.0.1:{args.backend_port}',
+            timeout = 60,
+            limits = httpx.Limits(max_connections = args.concurrency)
+        ) as client:
+            await wait_backend(client, backend)
+
+            conn = await asyncpg.connect(dsn)
+            await seed(conn, rng, args.users, args.subscriptions, args.repos)
+
+            payloads = [
+                json.dumps(push_payload(rng, n, f'repo{rng.randrange(args.repos)}', args.commits, args.paths)).encode()
+                for n in range(args.pushes)
+            ]
+
+            # Warm up connections and caches so the run measures steady state.
+            for n in range(min(args.warmup, args.pushes)):
+                body = json.dumps(push_payload(rng, -1, f'repo{n % args.repos}', 1, 1)).encode()
+                await client.post('/github_callback', content = body)
+            await wait_drained(conn, client)
+            sink.received.clear()
+
+            before = await db_counters(conn)
+            sent_at, latencies, errors, ingest_time = await replay(client, payloads, args.concurrency)
+            await wait_drained(conn, client)
+            finished = time.perf_counter()
+            # pg_stat_database is updated asynchronously by the server.
+            await asyncio.sleep(1)
+            after = await db_counters(conn)
+
+            cache_stats = (await client.get('/cache/stats')).json()['result']
+            notifier_stats = (await client.get('/notifier/stats')).json()['result']
+    finally:
+        if conn is not None:
+            await conn.close()
+        backend.terminate()
+        backend.wait()
+        server.should_exit = True
+        await sink_task
+
+    first_seen: Dict[str, float] = {}
+    for received_at, _, message in sink.received:
+        match = PUSHER.search(message)
+        if match and match.group(1) not in first_seen:
+            first_seen[match.group(1)] = received_at
+    end_to_end = [first_seen[pusher] - sent_at[pusher] for pusher in first_seen if pusher in sent_at]
+
+    start = min(sent_at.values()) if sent_at else finished
+    duration = finished - start
+    notifications = len(sink.received)
+    db = delta(before, after)
+
+    return {
+        'commit': git_commit(),
+        'config': {
+            'users': args.users,
+            'subscriptions_per_user': args.subscriptions,
+            'repos': args.repos,
+            'pushes': args.pushes,
+            'commits_per_push': args.commits,
+            'paths_per_commit': args.paths,
+            'payload_bytes': sum(len(body) for body in payloads) // max(1, len(payloads)),
+            'concurrency': args.concurrency,
+            'seed': args.seed
+        },
+        'ingest': {
+            **percentiles(latencies),
+            'errors': errors,
+            'requests_per_s': round(len(latencies) / ingest_time, 2) if ingest_time else None
+        },
+        'end_to_end': percentiles(end_to_end),
+        'notifications': {
+            'total': notifications,
+            'per_s': round(notifications / duration, 2) if duration else None,
+            'pushes_notified': len(first_seen)
+        },
+        'db': {
+            **db,
+            'statements_per_push': round(db['statements'] / args.pushes, 2) if db['statements'] is not None else None,
+            'transactions_per_push': round(db['transactions'] / args.pushes, 2)
+        },
+        'duration_s': round(duration, 3),
+        'backend': {
+            'cache': cache_stats,
+            'notifier': notifier_stats
+        },
+        'matching': await match_benchmark(args)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replay synthetic GitHub pushes against the backend and report latency and throughput as JSON.')
+    parser.add_argument('--users', type = int, default = 1000)
+    parser.add_argument('--subscriptions', type = int, default = 5, help = 'subscriptions per user')
+    parser.add_argument('--repos', type = int, default = 50)
+    parser.add_argument('--pushes', type = int, default = 500)
+    parser.add_argument('--commits', type = int, default = 3, help = 'commits per push')
+    parser.add_argument('--paths', type = int, default = 10, help = 'changed paths per commit')
+    parser.add_argument('--concurrency', type = int, default = 20)
+    parser.add_argument('--warmup', type = int, default = 20, help = 'pushes sent before measuring')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--match-paths', type = int, default = 50000, help = 'paths in the large push matched inline and in the pool, 0 to skip')
+    parser.add_argument('--match-patterns', type = int, default = 500)
+    parser.add_argument('--match-processes', type = int, default = min(4, os.cpu_count() or 1))
+    parser.add_argument('--backend-port', type = int, default = 8100)
+    parser.add_argument('--sink-port', type = int, default = 5100)
+    parser.add_argument('--backend-log', help = 'write the backend output to this file')
+    parser.add_argument('--output', help = 'write the JSON report to this file as well')
+    parser.add_argument('--db-host', default = os.getenv('DB_HOST', '127.0.0.1'))
+    parser.add_argument('--db-port', type = int, default = int(os.getenv('DB_PORT', '5432')))
+    parser.add_argument('--db-user', default = os.getenv('DB_USER', 'postgres'))
+    parser.add_argument('--db-password', default = os.getenv('DB_PASSWORD', 'postgres'))
+    parser.add_argument('--db-name', default = os.getenv('DB_NAME', 'tiramisu_bench'))
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent = 2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+if __name__ == '__main__':
+    main()
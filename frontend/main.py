@@ -1,13 +1,99 @@
+from telegram import Bot
 from telegram.ext import *
+from telegram.utils.request import Request
 
 from telegram_apikey import API_KEY
 
-import requests
-from fastapi import FastAPI
+from typing import List, Optional
+
+import os
+import asyncio
+import hmac
+import logging
+import threading
+import contextvars
+import collections
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from fastapi import FastAPI, Header, Response
 from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST
+from telegram import Update
+
+import metrics
+import profiling
+import sender
 
 print("Bot started...")
 
+BACKEND_URL = os.getenv('BACKEND_URL', 'http://backend:8000')
+BACKEND_TIMEOUT = float(os.getenv('BACKEND_TIMEOUT', '10'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+UPDATES_MODE = os.getenv('UPDATES_MODE', 'polling')
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))
+UPDATER_WORKERS = 4
+POLL_TIMEOUT = 30
+MAX_MESSAGE_LENGTH = 4096
+MAX_BATCH_SIZE = 1000
+# Idempotency keys of recently accepted notifications, so a batch the backend
+# retries after a timeout is not sent twice.
+RECENT_KEYS = 100000
+LISTING_PAGE_SIZE = 100
+LISTING_CACHE_SIZE = 1000
+
+# One bot, and one HTTP connection pool, shared by the notification sender
+# and the updater.
+bot = Bot(API_KEY, base_url=TELEGRAM_API_URL, request=Request(con_pool_size=int(sender.GLOBAL_RATE) + max(UPDATER_WORKERS, UPDATE_WORKERS) + 4))
+notification_sender = sender.TelegramSender(bot, sender.GLOBAL_RATE, sender.CHAT_RATE, sender.MAX_RETRIES)
+
+metrics.register_stats('tiramisu_sender', notification_sender.stats,
+    counters = {
+        'sent': 'Messages sent to Telegram',
+        'throttled': 'Messages delayed by the rate limits',
+        'retried': 'Messages retried after a Telegram error',
+        'dropped': 'Messages given up on',
+        'rejected': 'Messages refused because the chat queue was full',
+        'replies': 'Command replies sent through the rate limit',
+        'replies_retried': 'Command replies retried after a Telegram rate limit'
+    },
+    gauges = {
+        'queued': 'Messages waiting to be sent'
+    }
+)
+
+# Command handlers run in threads, httpx.Client is safe to share between them.
+backend = httpx.Client(
+    base_url=BACKEND_URL,
+    headers={
+        'Content-Type': 'application/json',
+        'Accept': 'application/json'
+    },
+    timeout=BACKEND_TIMEOUT,
+    transport=metrics.TimedTransport('backend', httpx.HTTPTransport(
+        limits=httpx.Limits(max_connections=max(UPDATER_WORKERS, UPDATE_WORKERS))
+    ))
+)
+
+# Replies share the notification sender's rate limit, ahead of notifications.
+def send_reply(update, text: str, **kwargs):
+    return notification_sender.reply(update.effective_chat.id, partial(update.message.reply_text, text, **kwargs))
+
+def call_backend(update, method: str, path: str, payload: Optional[dict] = None, headers: Optional[dict] = None) -> dict:
+    try:
+        with profiling.span(f'backend {method} {path}'):
+            res = backend.request(method, path, json={'tg_chat_id': update.message.chat.id, **(payload or {})}, headers=headers)
+        if res.status_code == 304:
+            return {'status': 'not_modified'}
+        res.raise_for_status()
+        return {**res.json(), 'etag': res.headers.get('ETag')}
+    except (httpx.HTTPError, ValueError) as e:
+        logging.warning(f'Backend request {method} {path} failed: {e!r}')
+        send_reply(update, "The service is not available right now, please try again later")
+        return {'status': 'unavailable'}
+
 #----------------------------------
 # Fast API
 #----------------------------------
@@ -15,13 +101,176 @@ print("Bot started...")
 class Notification(BaseModel):
     message: str
     chat_id: str
+    key: Optional[str] = None
 
 app = FastAPI()
+app.add_middleware(profiling.Middleware)
+
+@app.on_event('startup')
+async def start_sender():
+    await notification_sender.start()
+
+@app.on_event('shutdown')
+async def stop_sender():
+    await notification_sender.stop()
 
 @app.post('/notification')
 async def api_notification(notification: Notification):
-    updater = Updater(API_KEY)
-    updater.bot.sendMessage(chat_id=notification.chat_id, text=notification.message)
+    accepted = notification_sender.submit(notification.chat_id, notification.message)
+    metrics.NOTIFICATIONS.labels('accepted' if accepted else 'queue_full').inc()
+    return {'status': 'success'}
+
+recent_keys = collections.OrderedDict()
+
+def queue_notification(notification: Notification):
+    if notification.key is not None and notification.key in recent_keys:
+        return {'status': 'accepted'}
+    if not notification.message:
+        return {'status': 'rejected', 'reason': 'empty_message'}
+    if len(notification.message) > MAX_MESSAGE_LENGTH:
+        return {'status': 'rejected', 'reason': 'message_too_long'}
+    if not notification_sender.submit(notification.chat_id, notification.message):
+        return {'status': 'rejected', 'reason': 'queue_full'}
+    if notification.key is not None:
+        recent_keys[notification.key] = None
+        if len(recent_keys) > RECENT_KEYS:
+            recent_keys.popitem(last=False)
+    return {'status': 'accepted'}
+
+# Results are in the same order as the notifications.
+@app.post('/notifications/batch')
+async def api_notifications_batch(notifications: List[Notification]):
+    result = [queue_notification(notification) for notification in notifications[:MAX_BATCH_SIZE]]
+    result += [{'status': 'rejected', 'reason': 'batch_too_large'}] * len(notifications[MAX_BATCH_SIZE:])
+    for item in result:
+        metrics.NOTIFICATIONS.labels(item.get('reason', 'accepted')).inc()
+    return {
+        'status': 'success',
+        'result': result
+    }
+
+@app.get('/sender/stats')
+async def api_sender_stats():
+    return {
+        'status': 'success',
+        'result': notification_sender.stats()
+    }
+
+@app.get('/dispatcher/stats')
+async def api_dispatcher_stats():
+    return {
+        'status': 'success',
+        'result': dispatcher_stats()
+    }
+
+# Webhook mode: Telegram posts updates here. Handlers are blocking, they run
+# on UPDATE_WORKERS threads; updates from the same chat run one at a time and
+# in order, so conversations see their messages in sequence.
+dispatcher: Optional[Dispatcher] = None
+update_executor: Optional[ThreadPoolExecutor] = None
+chat_tails = {}
+pending_updates = 0
+updater: Optional[Updater] = None
+
+async def process_update(previous: Optional[asyncio.Future], update: Update):
+    if previous is not None:
+        with profiling.span('queued'):
+            await asyncio.gather(previous, return_exceptions=True)
+    # The copied context carries the trace, if any, into the handler thread.
+    with profiling.span('handler'):
+        context = contextvars.copy_context()
+        await asyncio.get_running_loop().run_in_executor(update_executor, context.run, dispatcher.process_update, update)
+
+async def traced_update(previous: Optional[asyncio.Future], update: Update):
+    if not profiling.profiler.sampled('update'):
+        await process_update(previous, update)
+        return
+    await profiling.profiler.trace('update', lambda: process_update(previous, update), {'update_id': update.update_id})
+
+def dispatch_update(update: Update):
+    global pending_updates
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    # Started outside the request's context, so it is not part of its trace.
+    task = contextvars.Context().run(asyncio.ensure_future, traced_update(chat_tails.get(chat_id), update))
+    chat_tails[chat_id] = task
+
+    pending_updates += 1
+
+    def done(task):
+        global pending_updates
+        pending_updates -= 1
+        if chat_tails.get(chat_id) is task:
+            del chat_tails[chat_id]
+    task.add_done_callback(done)
+
+# Updates received but not handled yet, and what the handlers keep per user
+# and per conversation.
+def dispatcher_stats():
+    dp = dispatcher or (updater.dispatcher if updater is not None else None)
+    if dp is None:
+        return {'backlog': 0, 'users': 0, 'user_data_keys': 0, 'conversations': 0}
+    return {
+        'backlog': pending_updates if dp is dispatcher else dp.update_queue.qsize(),
+        'users': len(dp.user_data),
+        'user_data_keys': sum(len(data) for data in list(dp.user_data.values())),
+        'conversations': sum(
+            len(handler.conversations)
+            for group in dp.handlers.values()
+            for handler in group
+            if isinstance(handler, ConversationHandler)
+        )
+    }
+
+metrics.register_stats('tiramisu_dispatcher', dispatcher_stats,
+    gauges = {
+        'backlog': 'Telegram updates waiting for a handler',
+        'users': 'Users with handler data',
+        'user_data_keys': 'Keys stored in user data',
+        'conversations': 'Conversations in progress'
+    }
+)
+
+@app.post('/telegram/updates')
+async def api_telegram_updates(body: dict, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+    if dispatcher is None or x_telegram_bot_api_secret_token != TELEGRAM_WEBHOOK_SECRET:
+        return Response(status_code=403)
+
+    dispatch_update(Update.de_json(body, bot))
+    return {'status': 'success'}
+
+class ProfilingRequest(BaseModel):
+    rate: Optional[float] = None
+    paths: Optional[List[str]] = None
+
+# The endpoints are off unless PROFILING_TOKEN is set.
+def profiling_allowed(token: Optional[str]) -> bool:
+    return profiling.PROFILING_TOKEN is not None and token is not None and hmac.compare_digest(token, profiling.PROFILING_TOKEN)
+
+@app.get('/debug/profiling')
+async def api_profiling(x_profiling_token: Optional[str] = Header(None)):
+    if not profiling_allowed(x_profiling_token):
+        return Response(status_code=403)
+    return {
+        'status': 'success',
+        'result': {
+            **profiling.profiler.settings(),
+            'traces': list(profiling.profiler.traces)
+        }
+    }
+
+@app.post('/debug/profiling')
+async def api_profiling_configure(req: ProfilingRequest, x_profiling_token: Optional[str] = Header(None)):
+    if not profiling_allowed(x_profiling_token):
+        return Response(status_code=403)
+    profiling.profiler.configure(req.rate, req.paths)
+    return {
+        'status': 'success',
+        'result': profiling.profiler.settings()
+    }
+
+@app.get('/metrics')
+async def api_metrics():
+    return Response(metrics.render(), headers = {'Content-Type': CONTENT_TYPE_LATEST})
 
 
 #---------------------------------
@@ -29,27 +278,33 @@ async def api_notification(notification: Notification):
 #---------------------------------
 
 def start_command(update, context):
-    update.message.reply_text(
+    send_reply(update, 
         "Hello. I will help you manage your GitHub notifications. If you need it, use the command /help \n"
         "These are the commands you can use:\n"
         "- To login to your GitHub account: /login \n"
         "- To log off your GitHub account: /logout \n"
         "- To start receiving notifications: /enable \n"
         "- To disable the service: /disable \n"
+        "- To group notifications sent within some seconds: /digest <seconds> \n"
         "- To add a new subscription: /subscribe \n"
+        "- To add several at once, one per line: /subscribe owner/repo pattern \n"
         "- To delete some subscription: /unsubscribe \n"
+        "- To delete several at once: /unsubscribe <id> <id> ... \n"
         "- To get a list of your current subscriptions: /subscriptions \n"
     )
 
 def help_command(update, context):
-    update.message.reply_text(
+    send_reply(update, 
         "These are the commands you can use:\n"
         "- To login to your GitHub account: /login \n"
         "- To log off your GitHub account: /logout \n"
         "- To start receiving notifications: /enable \n"
         "- To disable the service: /disable \n"
+        "- To group notifications sent within some seconds: /digest <seconds> \n"
         "- To add a new subscription: /subscribe \n"
+        "- To add several at once, one per line: /subscribe owner/repo pattern \n"
         "- To delete some subscription: /unsubscribe \n"
+        "- To delete several at once: /unsubscribe <id> <id> ... \n"
         "- To get a list of your current subscriptions: /subscriptions \n"
     )
 
@@ -60,45 +315,27 @@ def help_command(update, context):
 
 def login_command(update, context):
 
-    res = requests.post(
-        'http://backend:8000/user/connect',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'tg_chat_id': update.message.chat.id
-        }
-    ).json()
+    res = call_backend(update, 'POST', '/user/connect')
 
     if res['status'] == 'success':
         uri = res['verification_uri']
         code = "`" + res['user_code'] + "`"
-        update.message.reply_text("Follow the link " + uri 
-                                  + " and insert the following code (tap to copy): "
-                                  + code, parse_mode="Markdown")
+        send_reply(update, "Follow the link " + uri 
+                           + " and insert the following code (tap to copy): "
+                           + code, parse_mode="Markdown")
     
     if res['status'] == 'already_logged_in':
-        update.message.reply_text("You are already logged in")
+        send_reply(update, "You are already logged in")
 
 def logout_command(update, context):
     
-    res = requests.post(
-        'http://backend:8000/user/remove',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'tg_chat_id': update.message.chat.id
-        }
-    ).json()
+    res = call_backend(update, 'POST', '/user/remove')
 
     if res['status'] == 'success':
-        update.message.reply_text("Successfully logged out")
+        send_reply(update, "Successfully logged out")
     
     if res['status'] == 'authentication_failed':
-        update.message.reply_text("Log out failed: you are not logged in")
+        send_reply(update, "Log out failed: you are not logged in")
 
 
 #----------------------------------
@@ -106,38 +343,41 @@ def logout_command(update, context):
 #----------------------------------
 
 def enable_command(update, context):
-    response = requests.get(
-        'http://backend:8000/notifications/enable',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'tg_chat_id': update.message.chat.id
-        }
-    ).json()
+    response = call_backend(update, 'GET', '/notifications/enable')
 
     if response['status'] == 'success':
-        update.message.reply_text("Now the service is enabled")    
+        send_reply(update, "Now the service is enabled")    
     if response['status'] == 'authentication_failed':
-        update.message.reply_text("Authentication failed")
+        send_reply(update, "Authentication failed")
 
 def disable_command(update, context):
-    response = requests.get(
-        'http://backend:8000/notifications/disable',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'tg_chat_id': update.message.chat.id
-        }
-    ).json()
+    response = call_backend(update, 'GET', '/notifications/disable')
 
     if response['status'] == 'success':
-        update.message.reply_text("Now the service is disabled")    
+        send_reply(update, "Now the service is disabled")    
     if response['status'] == 'authentication_failed':
-        update.message.reply_text("Authentication failed")
+        send_reply(update, "Authentication failed")
+
+def digest_command(update, context):
+    try:
+        window = int(context.args[0])
+    except (IndexError, ValueError):
+        send_reply(update, "Usage: /digest <seconds>, 0 sends every notification right away")
+        return
+
+    response = call_backend(update, 'POST', '/notifications/digest', {
+        'window': window
+    })
+
+    if response['status'] == 'success':
+        if window == 0:
+            send_reply(update, "Notifications will be sent right away")
+        else:
+            send_reply(update, f"Notifications within {window} seconds will be grouped together")
+    if response['status'] == 'fail':
+        send_reply(update, "Invalid number of seconds")
+    if response['status'] == 'authentication_failed':
+        send_reply(update, "Authentication failed")
 
 
 #----------------------------------
@@ -147,94 +387,214 @@ def disable_command(update, context):
 OWNER, REPO, PATTERN, COMPLETE = range(4)
 
 def subscribe_command(update, context):
-    update.message.reply_text("Let's add a new subscription. Which is the owner?")
+    lines = update.message.text.split('\n')
+    lines[0] = lines[0].partition(' ')[2]
+    lines = [line.strip() for line in lines if line.strip()]
+
+    if lines:
+        bulk_subscribe(update, lines)
+        return ConversationHandler.END
+
+    send_reply(update, "Let's add a new subscription. Which is the owner?")
     return OWNER
 
+# /subscribe followed by one "owner/repo pattern" per line
+def bulk_subscribe(update, lines):
+    items = []
+    replies = []
+    for line in lines:
+        full_name, _, pattern = line.partition(' ')
+        owner, _, repo = full_name.partition('/')
+        if not owner or not repo or '/' in repo or not pattern.strip():
+            replies.append(line + ": invalid, expected owner/repo pattern")
+            continue
+        items.append({'owner': owner, 'repo': repo, 'pattern': pattern.strip()})
+        replies.append(None)
+
+    if items:
+        response = call_backend(update, 'POST', '/subscription/bulk', {
+            'subscriptions': items
+        })
+        if response['status'] == 'authentication_failed':
+            send_reply(update, "Authentication failed")
+            return
+        if response['status'] != 'success':
+            if response['status'] != 'unavailable':
+                send_reply(update, "Subscriptions could not be added")
+            return
+        forget_subscriptions(update.message.chat.id)
+
+        results = iter(zip(items, response['result']))
+        for i, reply in enumerate(replies):
+            if reply is not None:
+                continue
+            item, result = next(results)
+            line = item['owner'] + '/' + item['repo'] + ' ' + item['pattern']
+            if result['status'] == 'success':
+                replies[i] = line + ": added with id " + str(result['id'])
+            elif result['status'] == 'repository_not_found':
+                replies[i] = line + ": repository not found"
+            else:
+                replies[i] = line + ": failed"
+
+    send_reply(update, "\n".join(replies))
+
 def get_owner(update, context):
     context.user_data['owner'] = update.message.text
-    update.message.reply_text("Which is the repo?")
+    send_reply(update, "Which is the repo?")
     return REPO
 
 def get_repo(update, context):
     context.user_data['repo'] = update.message.text
-    update.message.reply_text("Which is the pattern?")
+    send_reply(update, "Which is the pattern?")
     return PATTERN
 
 def get_pattern(update, context):
     context.user_data['pattern'] = update.message.text
 
-    response = requests.post(
-        'http://backend:8000/subscription',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'tg_chat_id': update.message.chat.id,
-            'owner': context.user_data['owner'],
-            'repo': context.user_data['repo'],
-            'pattern': context.user_data['pattern']
-        }
-    ).json()
+    response = call_backend(update, 'POST', '/subscription', {
+        'owner': context.user_data['owner'],
+        'repo': context.user_data['repo'],
+        'pattern': context.user_data['pattern']
+    })
 
     if response['status'] == 'success':
-        update.message.reply_text("Subscription successfully added")    
-    if response['status'] == 'authentication_failed':
-        update.message.reply_text("Authentication failed")
-    if response['status'] == 'repository_not_found':
-        update.message.reply_text("Repository not found")
+        forget_subscriptions(update.message.chat.id)
+        send_reply(update, "Subscription successfully added")    
+    elif response['status'] == 'authentication_failed':
+        send_reply(update, "Authentication failed")
+    elif response['status'] == 'repository_not_found':
+        send_reply(update, "Repository not found")
+    elif response['status'] != 'unavailable':
+        # call_backend already replied when the backend was unreachable.
+        send_reply(update, "The subscription could not be created right now, please try again later")
     
     return ConversationHandler.END
        
 def unsubscribe_command(update, context):
+    if context.args:
+        bulk_unsubscribe(update, context.args)
+        return ConversationHandler.END
+
     subscriptions_command(update, context)
-    update.message.reply_text("Write the id of the subscription you'd like to delete")
+    send_reply(update, "Write the id of the subscription you'd like to delete")
     return COMPLETE
 
 def complete_unsubscription(update, context):
-    sub_id = int(update.message.text)
-
-    response = requests.post(
-        'http://backend:8000/subscription/delete',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'tg_chat_id': update.message.chat.id,
-            'sub_id': sub_id
-        }
-    ).json()
+    try:
+        sub_id = int(update.message.text)
+    except ValueError:
+        send_reply(update, "That is not a subscription id")
+        return ConversationHandler.END
+
+    # The listing was just shown by unsubscribe_command.
+    subscriptions = cached_subscriptions(update.message.chat.id)
+    if subscriptions is not None and sub_id not in {s['id'] for s in subscriptions}:
+        send_reply(update, "There is no subscription with id " + str(sub_id))
+        return ConversationHandler.END
+
+    response = call_backend(update, 'POST', '/subscription/delete', {
+        'sub_id': sub_id
+    })
 
     if response['status'] == 'success':
-        update.message.reply_text("Subscription successfully deleted")    
-    if response['status'] == 'authentication_failed':
-        update.message.reply_text("Authentication failed")
+        forget_subscriptions(update.message.chat.id)
+        send_reply(update, "Subscription successfully deleted")    
+    elif response['status'] == 'authentication_failed':
+        send_reply(update, "Authentication failed")
+    elif response['status'] != 'unavailable':
+        send_reply(update, "The subscription could not be deleted right now, please try again later")
     
     return ConversationHandler.END        
 
-def subscriptions_command(update, context):
-    response = requests.post(
-        'http://backend:8000/subscription/list',
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        },
-        json = {
-            'tg_chat_id': update.message.chat.id
-        }
-    ).json()
+# /unsubscribe followed by one or more subscription ids
+def bulk_unsubscribe(update, args):
+    try:
+        sub_ids = [int(arg) for arg in args]
+    except ValueError:
+        send_reply(update, "Usage: /unsubscribe <id> <id> ...")
+        return
+
+    response = call_backend(update, 'POST', '/subscription/bulk/delete', {
+        'sub_ids': sub_ids
+    })
+
     if response['status'] == 'success':
+        forget_subscriptions(update.message.chat.id)
+        deleted = [str(r['id']) for r in response['result'] if r['status'] == 'success']
+        missing = [str(r['id']) for r in response['result'] if r['status'] != 'success']
+        reply = "Deleted subscriptions: " + (', '.join(deleted) or 'none')
+        if missing:
+            reply += "\nNot found: " + ', '.join(missing)
+        send_reply(update, reply)
+    elif response['status'] == 'authentication_failed':
+        send_reply(update, "Authentication failed")
+    elif response['status'] != 'unavailable':
+        send_reply(update, "Subscriptions could not be deleted")
+
+# Listings are kept per chat and revalidated against the backend's ETag for
+# the first page, which changes with any change to the subscriptions.
+listings = collections.OrderedDict()
+listings_lock = threading.Lock()
+
+def cached_subscriptions(chat_id) -> Optional[list]:
+    with listings_lock:
+        cached = listings.get(chat_id)
+    return cached[1] if cached else None
+
+def forget_subscriptions(chat_id):
+    with listings_lock:
+        listings.pop(chat_id, None)
+
+def fetch_subscriptions(update):
+    chat_id = update.message.chat.id
+    with listings_lock:
+        cached = listings.get(chat_id)
+
+    subscriptions = []
+    etag = None
+    cursor = None
+    while True:
+        headers = {'If-None-Match': cached[0]} if cached and cursor is None else None
+        response = call_backend(update, 'POST', '/subscription/list', {
+            'cursor': cursor,
+            'limit': LISTING_PAGE_SIZE
+        }, headers)
+
+        if response['status'] == 'not_modified':
+            with listings_lock:
+                if chat_id in listings:
+                    listings.move_to_end(chat_id)
+            return 'success', cached[1]
+        if response['status'] != 'success':
+            return response['status'], None
+
+        subscriptions += response['result']
+        etag = etag or response['etag']
+        cursor = response['next_cursor']
+        if cursor is None:
+            break
+
+    with listings_lock:
+        listings[chat_id] = (etag, subscriptions)
+        listings.move_to_end(chat_id)
+        while len(listings) > LISTING_CACHE_SIZE:
+            listings.popitem(last=False)
+    return 'success', subscriptions
+
+def subscriptions_command(update, context):
+    status, subscriptions = fetch_subscriptions(update)
+    if status == 'success':
         string = "These are your current subscriptions:\n"
-        for s in response['result']:
+        for s in subscriptions:
             string += str(s['id'])+':'+s['owner']+':'+s['repo']+':'+s['pattern']
             string += "\n"
-        update.message.reply_text(string)
-    if response['status'] == 'authentication_failed':
-        update.message.reply_text('Authentication failed')
+        send_reply(update, string)
+    if status == 'authentication_failed':
+        send_reply(update, 'Authentication failed')
 
 def cancel(update, context):
-    update.message.reply_text("Conversation concluded")
+    send_reply(update, "Conversation concluded")
     return ConversationHandler.END
 
 #----------------------------------
@@ -244,17 +604,14 @@ def cancel(update, context):
 def error(update, context):
     print(f"Update {update} caused error {context.error}")
 
-@app.on_event('startup')
-def init_telegram_bot():
-    updater = Updater(API_KEY, use_context=True)
-    dp = updater.dispatcher
-
+def add_handlers(dp):
     dp.add_handler(CommandHandler("start", start_command))
     dp.add_handler(CommandHandler("help", help_command))
     dp.add_handler(CommandHandler("login", login_command))
     dp.add_handler(CommandHandler("logout", logout_command))
     dp.add_handler(CommandHandler("enable", enable_command))
     dp.add_handler(CommandHandler("disable", disable_command))
+    dp.add_handler(CommandHandler("digest", digest_command))
     dp.add_handler(CommandHandler("subscriptions", subscriptions_command))
 
     conversation_handler_sub = ConversationHandler(
@@ -277,4 +634,32 @@ def init_telegram_bot():
     )    
     dp.add_handler(conversation_handler_unsub)
 
-    updater.start_polling(1)
\ No newline at end of file
+@app.on_event('startup')
+def init_telegram_bot():
+    global dispatcher, update_executor, updater
+
+    if UPDATES_MODE == 'webhook':
+        if not TELEGRAM_WEBHOOK_URL or not TELEGRAM_WEBHOOK_SECRET:
+            raise RuntimeError('Webhook mode needs TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET')
+
+        dispatcher = Dispatcher(bot, None, workers=0, use_context=True)
+        add_handlers(dispatcher)
+        update_executor = ThreadPoolExecutor(UPDATE_WORKERS, thread_name_prefix='updates')
+        bot.set_webhook(
+            url=f'{TELEGRAM_WEBHOOK_URL}/telegram/updates',
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            max_connections=UPDATE_WORKERS
+        )
+    else:
+        updater = Updater(bot=bot, workers=UPDATER_WORKERS, use_context=True)
+        add_handlers(updater.dispatcher)
+        # Long polling: getUpdates returns as soon as there is an update.
+        updater.start_polling(poll_interval=0, timeout=POLL_TIMEOUT)
+
+@app.on_event('shutdown')
+def stop_telegram_bot():
+    # Returns once the current getUpdates does, at most POLL_TIMEOUT.
+    if updater is not None:
+        updater.stop()
+    if update_executor is not None:
+        update_executor.shutdown(wait=True)
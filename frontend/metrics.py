@@ -0,0 +1,55 @@
+from typing import Callable, Dict
+
+import time
+import httpx
+from prometheus_client import Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+TELEGRAM_SEND = Histogram('tiramisu_telegram_send_seconds', 'Time to send a message through the Bot API')
+NOTIFICATIONS = Counter('tiramisu_notifications_received_total', 'Notifications received from the backend, by outcome', ['result'])
+HTTP_CLIENT = Histogram('tiramisu_http_client_seconds', 'Outbound HTTP request latency until the response headers', ['target'])
+HTTP_CLIENT_ERRORS = Counter('tiramisu_http_client_errors_total', 'Outbound HTTP requests that failed without a response', ['target'])
+
+
+# The sender already counts what it does for /sender/stats, this exposes
+# those numbers at scrape time instead of counting twice.
+class StatsCollector:
+    def __init__(self, prefix: str, stats: Callable[[], dict], counters: Dict[str, str], gauges: Dict[str, str]):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = counters
+        self.gauges = gauges
+
+    def collect(self):
+        stats = self.stats()
+        for name, doc in self.counters.items():
+            yield CounterMetricFamily(f'{self.prefix}_{name}', doc, value = stats[name])
+        for name, doc in self.gauges.items():
+            yield GaugeMetricFamily(f'{self.prefix}_{name}', doc, value = stats[name])
+
+def register_stats(prefix: str, stats: Callable[[], dict], counters: Dict[str, str] = {}, gauges: Dict[str, str] = {}):
+    REGISTRY.register(StatsCollector(prefix, stats, counters, gauges))
+
+
+def render() -> bytes:
+    return generate_latest()
+
+
+class TimedTransport(httpx.BaseTransport):
+    def __init__(self, target: str, transport: httpx.BaseTransport):
+        self._latency = HTTP_CLIENT.labels(target)
+        self._errors = HTTP_CLIENT_ERRORS.labels(target)
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            self._errors.inc()
+            raise
+        self._latency.observe(time.perf_counter() - started)
+        return response
+
+    def close(self):
+        self._transport.close()
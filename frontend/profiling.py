@@ -0,0 +1,132 @@
+from typing import Deque, List, Optional
+
+import os
+import time
+import random
+import logging
+import collections
+import contextvars
+
+# The backend's spans and sampling, without cProfile or traces on disk: off
+# unless PROFILING_RATE is set, and adjustable at runtime through the
+# /debug/profiling endpoint, which needs PROFILING_TOKEN.
+PROFILING_RATE = float(os.getenv('PROFILING_RATE', '0'))
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN') or None
+PROFILING_KEEP = 50
+
+
+class Span:
+    __slots__ = ('name', 'started', 'duration', 'children')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.children: List['Span'] = []
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'children': [child.to_dict(origin) for child in self.children]
+        }
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar('profiling_span', default=None)
+
+
+class _NoSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_no_span = _NoSpan()
+
+
+class _Span:
+    def __init__(self, name: str, parent: Span):
+        self.span = Span(name)
+        parent.children.append(self.span)
+
+    def __enter__(self):
+        self._token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        self.span.duration = time.perf_counter() - self.span.started
+        _current.reset(self._token)
+
+
+# A child of the current span, or nothing at all outside a sampled trace.
+def span(name: str):
+    parent = _current.get()
+    if parent is None:
+        return _no_span
+    return _Span(name, parent)
+
+
+class Profiler:
+    def __init__(self):
+        self.rate = PROFILING_RATE
+        self.paths: List[str] = []
+        self.traces: Deque[dict] = collections.deque(maxlen=PROFILING_KEEP)
+
+    def configure(self, rate: Optional[float] = None, paths: Optional[List[str]] = None):
+        if rate is not None:
+            self.rate = min(max(rate, 0.0), 1.0)
+        if paths is not None:
+            self.paths = paths
+        logging.info(f'Profiling rate {self.rate}, paths {self.paths or "all"}')
+
+    def settings(self) -> dict:
+        return {
+            'rate': self.rate,
+            'paths': self.paths,
+            'kept': len(self.traces)
+        }
+
+    def sampled(self, name: str) -> bool:
+        if self.rate <= 0 or self.rate < 1 and random.random() >= self.rate:
+            return False
+        return not self.paths or any(name.startswith(path) for path in self.paths)
+
+    # Runs `call` under a root span.
+    async def trace(self, name: str, call, fields: dict):
+        root = Span(name)
+        token = _current.set(root)
+        try:
+            return await call()
+        finally:
+            root.duration = time.perf_counter() - root.started
+            _current.reset(token)
+            self.traces.append({
+                'time': time.time(),
+                **fields,
+                **root.to_dict(root.started)
+            })
+
+
+profiler = Profiler()
+
+
+# Plain ASGI, when profiling is off a request costs one comparison.
+class Middleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or profiler.rate <= 0 or not profiler.sampled(scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        fields = {'method': scope['method'], 'status': None}
+
+        async def send_status(message):
+            if message['type'] == 'http.response.start':
+                fields['status'] = message['status']
+            await send(message)
+
+        await profiler.trace(scope['path'], lambda: self.app(scope, receive, send_status), fields)
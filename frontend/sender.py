@@ -0,0 +1,244 @@
+import os
+import time
+import heapq
+import threading
+import asyncio
+import logging
+import collections
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Bot
+from telegram.error import RetryAfter, TimedOut, NetworkError, TelegramError
+
+import metrics
+
+# Telegram allows roughly 30 messages per second overall and one message
+# per second to the same chat.
+GLOBAL_RATE = float(os.getenv('SENDER_GLOBAL_RATE', '30'))
+CHAT_RATE = float(os.getenv('SENDER_CHAT_RATE', '1'))
+MAX_RETRIES = int(os.getenv('SENDER_MAX_RETRIES', '5'))
+CHAT_QUEUE_LIMIT = int(os.getenv('SENDER_CHAT_QUEUE_LIMIT', '100'))
+# Part of the global budget that notifications leave to command replies.
+REPLY_RESERVE = float(os.getenv('SENDER_REPLY_RESERVE', '5'))
+RETRY_DELAY = 1
+IDLE_CHATS_LIMIT = 10000
+
+
+# Shared by the dispatcher and the handler threads. Takers with a reserve
+# wait until that many tokens are left for the others.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, reserve: float = 0) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            self.tokens -= 1
+            if self.tokens >= reserve:
+                return 0
+            return (reserve - self.tokens) / self.rate
+
+
+class _Chat:
+    def __init__(self):
+        self.messages = collections.deque()
+        self.next_at = 0.0
+        self.busy = False
+
+
+class TelegramSender:
+    def __init__(self, bot: Bot, global_rate: float, chat_rate: float, max_retries: int, reply_reserve: float = REPLY_RESERVE):
+        self.bot = bot
+        self.concurrency = max(1, int(global_rate))
+        self.chat_interval = 1 / chat_rate
+        self.max_retries = max_retries
+        self.reply_reserve = min(reply_reserve, global_rate - 1)
+
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []
+        self._seq = 0
+        self._loop = None
+        self._wakeup = None
+        self._slots = None
+        self._executor = None
+        self._task = None
+        self._in_flight = set()
+
+        self.sent = 0
+        self.throttled = 0
+        self.retried = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.replies = 0
+        self.replies_retried = 0
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='sender')
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+
+    def submit(self, chat_id: str, text: str) -> bool:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= IDLE_CHATS_LIMIT:
+                self._purge()
+            chat = self._chats[chat_id] = _Chat()
+
+        # A chat only drains at CHAT_RATE, past this backlog it would take
+        # minutes for a new message to go out.
+        if len(chat.messages) >= CHAT_QUEUE_LIMIT:
+            self.rejected += 1
+            return False
+
+        chat.messages.append((text, 0))
+        if len(chat.messages) == 1 and not chat.busy:
+            self._schedule(chat_id, chat)
+        return True
+
+    # Called from the command handler threads with the call that sends the
+    # reply. Replies go ahead of notifications: they can use the reserve of
+    # the global budget, and push back the chat's next notification.
+    def reply(self, chat_id, send):
+        delay = self._bucket.take()
+        if delay > 0:
+            time.sleep(delay)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._replied, str(chat_id))
+
+        self.replies += 1
+        try:
+            return send()
+        except RetryAfter as e:
+            logging.info(f'Telegram rate limit replying to chat {chat_id}, retry after {e.retry_after}s')
+            self.replies_retried += 1
+            time.sleep(e.retry_after)
+            return send()
+
+    def _replied(self, chat_id: str):
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.next_at = max(chat.next_at, time.monotonic() + self.chat_interval)
+
+    def stats(self):
+        return {
+            'queued': sum(len(chat.messages) for chat in self._chats.values()),
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+            'replies': self.replies,
+            'replies_retried': self.replies_retried
+        }
+
+    def _schedule(self, chat_id: str, chat: _Chat):
+        now = time.monotonic()
+        if chat.next_at > now:
+            self.throttled += 1
+        self._seq += 1
+        heapq.heappush(self._ready, (max(now, chat.next_at), self._seq, chat_id))
+        self._wakeup.set()
+
+    # A reply to the chat since it was scheduled moves its next message back.
+    def _pushed_back(self, chat_id: str, chat: _Chat, at: float) -> bool:
+        if chat.next_at <= at:
+            return False
+        self._seq += 1
+        heapq.heappush(self._ready, (chat.next_at, self._seq, chat_id))
+        return True
+
+    def _purge(self):
+        now = time.monotonic()
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.messages and not chat.busy and chat.next_at <= now:
+                del self._chats[chat_id]
+
+    async def _dispatch(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            ready_at = self._ready[0][0]
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            if self._pushed_back(chat_id, chat, ready_at):
+                continue
+
+            delay = self._bucket.take(self.reply_reserve)
+            if delay > 0:
+                self.throttled += 1
+                await asyncio.sleep(delay)
+
+            await self._slots.acquire()
+            if self._pushed_back(chat_id, chat, time.monotonic()):
+                self._slots.release()
+                continue
+            chat.busy = True
+            chat.next_at = time.monotonic() + self.chat_interval
+            text, attempt = chat.messages.popleft()
+            task = asyncio.create_task(self._send(chat_id, chat, text, attempt))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, chat_id: str, chat: _Chat, text: str, attempt: int):
+        loop = asyncio.get_running_loop()
+        retry_in = None
+        started = time.perf_counter()
+        try:
+            await loop.run_in_executor(self._executor, partial(self.bot.send_message, chat_id=chat_id, text=text))
+            metrics.TELEGRAM_SEND.observe(time.perf_counter() - started)
+            self.sent += 1
+        except RetryAfter as e:
+            logging.info(f'Telegram rate limit for chat {chat_id}, retry after {e.retry_after}s')
+            retry_in = e.retry_after
+        except (TimedOut, NetworkError) as e:
+            logging.warning(f'Sending to chat {chat_id} failed: {e}')
+            retry_in = RETRY_DELAY * 2 ** attempt
+        except TelegramError as e:
+            logging.warning(f'Dropping message to chat {chat_id}: {e}')
+            self.dropped += 1
+        except Exception:
+            logging.exception(f'Dropping message to chat {chat_id}')
+            self.dropped += 1
+        finally:
+            self._slots.release()
+
+        if retry_in is not None:
+            if attempt < self.max_retries:
+                self.retried += 1
+                chat.messages.appendleft((text, attempt + 1))
+                chat.next_at = max(chat.next_at, time.monotonic() + retry_in)
+            else:
+                logging.warning(f'Dropping message to chat {chat_id} after {attempt + 1} attempts')
+                self.dropped += 1
+
+        chat.busy = False
+        if chat.messages:
+            self._schedule(chat_id, chat)